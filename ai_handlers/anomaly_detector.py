@@ -7,10 +7,16 @@ import config_mgr
 import stats_mgr
 import models_library
 import model_persistence.models_factory
+import model_persistence.models_evictor
+import model_persistence.models_footprint
 import model_persistence.anomaly_calc_factory
 import utils.anomalies_handler
+import utils.metrics_aggregator
+import utils.latency_histograms
 import utils.logger
 DEBUG = False
+# The kinds of metrics that are sent to Kafka for each analyzed metric
+OUTPUT_METRICS_KINDS = ["prediction", "prediction_confidence", "anomaly_score", "anomaly_likelihood", "anomaly_direction"]
 
 
 class AnomalyDetector:
@@ -18,28 +24,36 @@ class AnomalyDetector:
     __threads_lock = Lock()
 
     @staticmethod
-    def get_instance(kafka_producer=None):
+    def get_instance(transport=None):
         if AnomalyDetector.__instance is None:
-            AnomalyDetector(kafka_producer)
+            AnomalyDetector(transport)
         return AnomalyDetector.__instance
 
-    def __init__(self, kafka_producer):
+    def __init__(self, transport):
         AnomalyDetector.__threads_lock.acquire()
         try:
             if AnomalyDetector.__instance is not None:
                 raise Exception("This is a singleton class. Please use the get_instance() method.")
             else:
-                if kafka_producer is None:
-                    raise Exception("On the first call to this class the kafka producer must be given.")
+                if transport is None:
+                    raise Exception("On the first call to this class the transport must be given.")
 
                 AnomalyDetector.__instance = self
-                self._kafka_producer = kafka_producer
+                self._transport = transport
                 self._config_mgr = config_mgr.ConfigMgr.get_instance()
                 self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
                 self._logger = utils.logger.Logger(__file__, "AnomalyDetector")
                 self._models_library = models_library.ModelsLibrary.get_instance()
                 self._models_factory = model_persistence.models_factory.ModelFactory()
-                self._anomalies_handler = utils.anomalies_handler.AnomaliesHandler.get_instance(self._kafka_producer)
+                self._models_evictor = model_persistence.models_evictor.ModelsEvictor(self._models_factory.get_model_types())
+                self._models_footprint = model_persistence.models_footprint.ModelsFootprint(self._models_factory.get_model_types())
+                self._anomalies_handler = utils.anomalies_handler.AnomaliesHandler.get_instance(self._transport)
+                self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+                self._metrics_aggregator = utils.metrics_aggregator.MetricsAggregator()
+                if not self._metrics_aggregator.is_enabled():
+                    self._metrics_aggregator = None
+                if self._models_factory.is_single_model_mode():
+                    self._logger.info("__init__", "Running in single model mode - the anomaly model of each metric also makes its predictions")
                 self._last_logged_message_about_too_many_models = 0
                 self.EXIT_ALL_THREADS_FLAG = False
         finally:
@@ -53,38 +67,100 @@ class AnomalyDetector:
         :return:
         """
 
+        detection_started = time.time()
+        if not isinstance(metric, dict) or "metric_name" not in metric:
+            # i.e. a metric that could not be parsed (the metric's lock can't be looked up without its name)
+            self._logger.warn("detect_anomaly", "Failed to analyze that metric since it is invalid.", metric=lambda: str(base64.b64encode(str(metric))), min_seconds_between=1)
+            return
+
+        # Held while the models of the metric are looked up and run, so they are not saved or unloaded meanwhile (the
+        # other metrics can be analyzed and saved at the same time)
+        metric_lock = self._models_library.get_metric_lock(metric["metric_name"])
+        metric_lock.acquire()
         try:
-            self._logger.debug("detect_anomaly", "Received the metric mentioned.", metric=str(metric))
+            self._logger.debug("detect_anomaly", "Received the metric mentioned.", metric=lambda: str(metric))
+            metric_state = self._models_library.touch_metric(metric["metric_name"])
+            if self._metrics_aggregator is not None:
+                # Only a single (aggregated) value per window of the high frequency metrics is analyzed
+                metric = self._metrics_aggregator.aggregate(metric, metric_state)
+                if metric is None:
+                    return
 
-            if self._models_library.get_instance().get_models_count() < self._config_mgr.get("max_allowed_models"):
+            metric_state.observe_timestamp(metric["metric_timestamp"])
+            if metric_state.anomaly_model is not None and metric_state.anomaly_likelihood_calc is not None and metric_state.prediction_model is not None:
+                # All the models of the metric were already looked up
                 models_number_below_configured_limit = True
             else:
-                models_number_below_configured_limit = False
-                if (time.time() - self._last_logged_message_about_too_many_models) > self._config_mgr.get("minimum_seconds_between_model_over_quota_log_messages"):
-                    self._logger.warn("detect_anomaly", "Currently the number of models/anomaly_likelihood_calculators loaded is exceeds the configured quota. CANNOT CREATE NEW MODELS.", metric=str(metric))
-                    self._last_logged_message_about_too_many_models = time.time()
-
-            anomaly_detection_model = self._models_factory.get_anomaly_model(metric, models_number_below_configured_limit)
+                models_number_below_configured_limit = self._is_below_models_limit(metric)
+                self._lookup_models(metric, metric_state, models_number_below_configured_limit)
+            anomaly_detection_model = metric_state.anomaly_model
+            anomaly_likelihood_calc = metric_state.anomaly_likelihood_calc
+            prediction_model = metric_state.prediction_model
+            self._latency_histograms.observe("models_lookup", time.time() - detection_started)
 
-            self.__threads_lock.acquire()
-            anomaly_likelihood_calc = self._models_factory.get_anomaly_likelihood_calc(metric, models_number_below_configured_limit)
-            self.__threads_lock.release()
-
-            prediction_model = self._models_factory.get_prediction_model(metric, models_number_below_configured_limit)
-            prediction, prediction_made = self._get_prediction(metric, models_number_below_configured_limit, prediction_model)
-            anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score = self._do_anomaly_detection(anomaly_detection_model, anomaly_likelihood_calc, metric, prediction)
-            self._report_found_anomalies(anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score, metric, models_number_below_configured_limit, prediction, prediction_made)
+            if self._models_factory.is_single_model_mode():
+                # A single run of the anomaly model gives both the anomaly score and the prediction
+                model_result = self._run_model(anomaly_detection_model, metric, "model_run") if anomaly_detection_model else None
+            else:
+                model_result = None
+            prediction, prediction_made = self._get_prediction(metric, metric_state, models_number_below_configured_limit, prediction_model, model_result)
+            anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score = self._do_anomaly_detection(anomaly_detection_model, anomaly_likelihood_calc, metric, prediction, prediction_made, model_result)
+            self._report_found_anomalies(anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score, metric, metric_state, models_number_below_configured_limit, prediction, prediction_made)
+            if anomaly_detection_model or prediction_model:
+                self._models_library.mark_metric_dirty(metric["metric_name"])
 
             if self.EXIT_ALL_THREADS_FLAG:
                 return
 
             self._stats_mgr.set("last_metric_timestamp", int(metric["metric_timestamp"]))
             self._stats_mgr.up("metrics_successfully_processed")
+            self._latency_histograms.observe("detect_anomaly", time.time() - detection_started)
 
         except Exception as ex:
-            self._logger.warn("detect_anomaly", "Failed to analyze that metric due to an exception.", metric=str(base64.b64encode(str(metric))), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+            self._logger.warn("detect_anomaly", "Failed to analyze that metric due to an exception.", metric=lambda: str(base64.b64encode(str(metric))), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
+        finally:
+            metric_lock.release()
+
+    def _is_below_models_limit(self, metric):
+        memory_budget = self._models_footprint.get_memory_budget()
+        needed_memory = 0
+        if memory_budget > 0 and self._models_library.get_metric_footprint(metric["metric_name"]) is None:
+            needed_memory = self._models_footprint.estimate_metric_footprint(metric)
+        if self._models_library.get_models_count() < self._config_mgr.get("max_allowed_models") and (memory_budget == 0 or self._models_library.get_models_memory() + needed_memory <= memory_budget):
+            return True
+        if self._models_evictor.make_room_for_metric(metric["metric_name"], needed_memory, memory_budget):
+            return True
+        if (time.time() - self._last_logged_message_about_too_many_models) > self._config_mgr.get("minimum_seconds_between_model_over_quota_log_messages"):
+            self._logger.warn("detect_anomaly", "Currently the number of models/anomaly_likelihood_calculators loaded (or the memory they take) exceeds the configured quota. CANNOT CREATE NEW MODELS. (models_count=" + str(self._models_library.get_models_count()) + ", models_memory_bytes=" + str(self._models_library.get_models_memory()) + ")", metric=str(metric))
+            self._last_logged_message_about_too_many_models = time.time()
+        return False
 
-    def _report_found_anomalies(self, anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score, metric, models_number_below_configured_limit, prediction, prediction_made):
+    def _lookup_models(self, metric, metric_state, models_number_below_configured_limit):
+        """
+        Loads/creates (if allowed) the models of the given metric and keeps their handles in its state (called with the
+        metric's lock held)
+        """
+        metric_state.anomaly_model = self._models_factory.get_anomaly_model(metric, models_number_below_configured_limit)
+        metric_state.anomaly_likelihood_calc = self._models_factory.get_anomaly_likelihood_calc(metric, models_number_below_configured_limit)
+
+        if self._models_factory.is_single_model_mode():
+            metric_state.prediction_model = metric_state.anomaly_model
+        else:
+            metric_state.prediction_model = self._models_factory.get_prediction_model(metric, models_number_below_configured_limit)
+
+        if metric_state.anomaly_model is not None and self._models_library.get_metric_footprint(metric["metric_name"]) is None:
+            self._models_library.set_metric_footprint(metric["metric_name"], self._models_footprint.estimate_metric_footprint(metric))
+        elif metric_state.anomaly_model is None and metric_state.prediction_model is None and metric_state.anomaly_likelihood_calc is None:
+            # A metric that was refused models is not kept (so it's neither a growing state nor an eviction candidate)
+            self._models_library.forget_metric(metric["metric_name"])
+
+    def _get_output_metrics_names(self, metric_state):
+        if metric_state.output_metrics_names is None:
+            metrics_prefix = self._config_mgr.get("metrics_prefix")
+            metric_state.output_metrics_names = dict([(kind, metrics_prefix.replace("{{#anomaly_metric}}", kind) + "." + metric_state.metric_name) for kind in OUTPUT_METRICS_KINDS])
+        return metric_state.output_metrics_names
+
+    def _report_found_anomalies(self, anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score, metric, metric_state, models_number_below_configured_limit, prediction, prediction_made):
         anomaly_reported = False
         if anomaly_detection_made:
             if anomaly_likelihood is not None \
@@ -117,12 +193,17 @@ class AnomalyDetector:
             else:
                 # No alert is needed, no anomaly was detected
                 pass
+            output_metrics_names = self._get_output_metrics_names(metric_state)
+            kafka_send_started = time.time()
             try:
-                self._kafka_producer.send(topic=self._config_mgr.get("anomalies_metrics_kafka_topic"), value=(self._config_mgr.get("metrics_prefix").replace("{{#anomaly_metric}}", "anomaly_score") + "." + metric["metric_name"] + " " + str(anomaly_score) + " " + str(metric["metric_timestamp"])).encode('utf-8'))
-                self._kafka_producer.send(topic=self._config_mgr.get("anomalies_metrics_kafka_topic"), value=(self._config_mgr.get("metrics_prefix").replace("{{#anomaly_metric}}", "anomaly_likelihood") + "." + metric["metric_name"] + " " + str(anomaly_likelihood) + " " + str(metric["metric_timestamp"])).encode('utf-8'))
-                self._kafka_producer.send(topic=self._config_mgr.get("anomalies_metrics_kafka_topic"), value=(self._config_mgr.get("metrics_prefix").replace("{{#anomaly_metric}}", "anomaly_direction") + "." + metric["metric_name"] + " " + str(anomaly_direction) + " " + str(metric["metric_timestamp"])).encode('utf-8'))
+                self._transport.publish_batch(self._config_mgr.get("anomalies_metrics_kafka_topic"), [
+                    (output_metrics_names["anomaly_score"] + " " + str(anomaly_score) + " " + str(metric["metric_timestamp"])).encode('utf-8'),
+                    (output_metrics_names["anomaly_likelihood"] + " " + str(anomaly_likelihood) + " " + str(metric["metric_timestamp"])).encode('utf-8'),
+                    (output_metrics_names["anomaly_direction"] + " " + str(anomaly_direction) + " " + str(metric["metric_timestamp"])).encode('utf-8')
+                ])
             except Exception as ex:
                 self._logger.warn("_report_found_anomalies", "Failed to report anomaly info to kafka  (Value: " + str(metric["metric_value"]) + ", Anomaly score: " + str(anomaly_score) + ", Prediction: " + str(prediction) + ", AnomalyLikelihood: " + str(anomaly_likelihood) + ", AnomalyReported: " + str(anomaly_reported) + ")", metric=str(metric["metric_name"]), exception_message=str(ex.message), exception_type=str(type(ex).__name__))
+            self._latency_histograms.observe("kafka_send", time.time() - kafka_send_started)
         else:
             if models_number_below_configured_limit:
                 self._logger.error("_report_found_anomalies", "Could not load/create a anomaly detection model for this metric", metric=str(metric))
@@ -132,16 +213,24 @@ class AnomalyDetector:
 
         return anomaly_reported
 
-    def _do_anomaly_detection(self, anomaly_detection_model, anomaly_likelihood_calc, metric, prediction):
+    def _run_model(self, model, metric, stage):
+        run_started = time.time()
+        try:
+            return model.run({
+                "timestamp": datetime.fromtimestamp(metric["metric_timestamp"]),
+                "value": metric["metric_value"]
+            })
+        finally:
+            self._latency_histograms.observe(stage, time.time() - run_started)
+
+    def _do_anomaly_detection(self, anomaly_detection_model, anomaly_likelihood_calc, metric, prediction, prediction_made, anomaly_detection_result=None):
         anomaly_detection_made = False
         anomaly_likelihood = None
         anomaly_score = None
         anomaly_direction = 0
         if anomaly_detection_model:
-            anomaly_detection_result = anomaly_detection_model.run({
-                "timestamp": datetime.fromtimestamp(metric["metric_timestamp"]),
-                "value": metric["metric_value"]
-            })
+            if anomaly_detection_result is None:
+                anomaly_detection_result = self._run_model(anomaly_detection_model, metric, "anomaly_run")
 
             try:
                 anomaly_score = anomaly_detection_result.inferences["anomalyScore"]
@@ -152,16 +241,19 @@ class AnomalyDetector:
                 self._logger.warn("_do_anomaly_detection", "Failed to get an anomaly_score due to a KeyError exception. Faking a zero anomaly_score", metric=str(metric))
                 anomaly_score = 0
 
+            anomaly_likelihood_started = time.time()
             anomaly_likelihood = anomaly_likelihood_calc.anomalyProbability(
                 value=metric["metric_value"],
                 anomalyScore=anomaly_score,
                 timestamp=datetime.fromtimestamp(metric["metric_timestamp"])
             )
+            self._latency_histograms.observe("anomaly_likelihood", time.time() - anomaly_likelihood_started)
 
             if anomaly_likelihood is not None \
                     and anomaly_score is not None \
                     and anomaly_likelihood >= self._config_mgr.get("anomaly_likelihood_threshold_for_reporting") \
                     and anomaly_score >= self._config_mgr.get("anomaly_score_threshold_for_reporting") \
+                    and prediction_made \
                     and prediction["confidence_level"] >= self._config_mgr.get("minimum_confidence_for_reporting"):
                 if prediction["value"] > metric["metric_value"]:
                     anomaly_direction = 1
@@ -171,35 +263,43 @@ class AnomalyDetector:
             anomaly_detection_made = True
         return anomaly_detection_made, anomaly_direction, anomaly_likelihood, anomaly_score
 
-    def _get_prediction(self, metric, models_number_below_configured_limit, prediction_model):
-        prediction = {"value": 0, "timestamp": (metric["metric_timestamp"] - self._stats_mgr.get("last_metric_timestamp")) * self._config_mgr.get("prediction_steps")}
+    def _get_prediction(self, metric, metric_state, models_number_below_configured_limit, prediction_model, prediction_result=None):
+        """
+        Runs the prediction model (unless its result is given) and sends the prediction to Kafka. The predicted value is
+        for prediction_steps values ahead, so its timestamp is based on the metric's own cadence (the time between its
+        last two values).
+        :return: Tuple of (prediction or None, whether a prediction was made)
+        """
+        prediction_steps = self._config_mgr.get("prediction_steps")
+        prediction = None
         prediction_made = False
         if prediction_model:
-            prediction_result = prediction_model.run({
-                "timestamp": datetime.fromtimestamp(metric["metric_timestamp"]),
-                "value": metric["metric_value"]
-            })
+            if prediction_result is None:
+                prediction_result = self._run_model(prediction_model, metric, "prediction_run")
 
             try:
-                if "multiStepBestPredictions" in prediction_result.inferences and self._stats_mgr.get("last_metric_timestamp") > 0:
-                    prediction_value = prediction_result.inferences["multiStepBestPredictions"][self._config_mgr.get("prediction_steps")]
+                if "multiStepBestPredictions" in prediction_result.inferences and metric_state.cadence is not None:
+                    prediction_value = prediction_result.inferences["multiStepBestPredictions"][prediction_steps]
                     prediction = {
-                        "timestamp": metric["metric_timestamp"] + ((metric["metric_timestamp"] - self._stats_mgr.get("last_metric_timestamp")) * self._config_mgr.get("prediction_steps")),
+                        "timestamp": metric["metric_timestamp"] + metric_state.cadence * prediction_steps,
                         "value": prediction_value,
-                        "confidence_level": prediction_result.inferences["multiStepPredictions"][self._config_mgr.get("prediction_steps")][prediction_value]
+                        "confidence_level": prediction_result.inferences["multiStepPredictions"][prediction_steps][prediction_value]
                     }
                     prediction_made = True
-                else:
-                    prediction = None
             except KeyError:
-                self._logger.warn("_get_prediction", "Failed to get a prediction due to a KeyError exception. Faking a zero prediction", metric=str(metric))
-                prediction = {"value": 0, "timestamp": (metric["metric_timestamp"] - self._stats_mgr.get("last_metric_timestamp")) * self._config_mgr.get("prediction_steps")}
+                self._logger.warn("_get_prediction", "Failed to get a prediction due to a KeyError exception", metric=str(metric))
 
-            try:
-                self._kafka_producer.send(topic=self._config_mgr.get("predictions_metrics_kafka_topic"), value=(self._config_mgr.get("metrics_prefix").replace("{{#anomaly_metric}}", "prediction") + "." + metric["metric_name"] + " " + str(prediction["value"]) + " " + str(prediction["timestamp"])).encode('utf-8'))
-                self._kafka_producer.send(topic=self._config_mgr.get("predictions_metrics_kafka_topic"), value=(self._config_mgr.get("metrics_prefix").replace("{{#anomaly_metric}}", "prediction_confidence") + "." + metric["metric_name"] + " " + str(prediction["confidence_level"]) + " " + str(prediction["timestamp"])).encode('utf-8'))
-            except Exception as ex:
-                self._logger.warn("_get_prediction", "Failed to report prediction to kafka  (Value: " + str(metric["metric_value"]) + ", Prediction: " + str(prediction) + ")", metric=str(metric["metric_name"]), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+            if prediction_made:
+                output_metrics_names = self._get_output_metrics_names(metric_state)
+                kafka_send_started = time.time()
+                try:
+                    self._transport.publish_batch(self._config_mgr.get("predictions_metrics_kafka_topic"), [
+                        (output_metrics_names["prediction"] + " " + str(prediction["value"]) + " " + str(prediction["timestamp"])).encode('utf-8'),
+                        (output_metrics_names["prediction_confidence"] + " " + str(prediction["confidence_level"]) + " " + str(prediction["timestamp"])).encode('utf-8')
+                    ])
+                except Exception as ex:
+                    self._logger.warn("_get_prediction", "Failed to report prediction to kafka  (Value: " + str(metric["metric_value"]) + ", Prediction: " + str(prediction) + ")", metric=str(metric["metric_name"]), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+                self._latency_histograms.observe("kafka_send", time.time() - kafka_send_started)
 
         else:
             if models_number_below_configured_limit:
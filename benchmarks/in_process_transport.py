@@ -0,0 +1,64 @@
+import time
+
+import transports.memory_transport
+
+
+class BenchmarkTransport(transports.memory_transport.MemoryTransport):
+    """
+    A MemoryTransport that hands out the raw metrics put into it at a limited rate (if any), measures how long the
+    analyzer took to handle each metric (or batch) - the time between handing it out and being asked for the next one -
+    and tells the caller once all of them were handed out.
+    """
+
+    def __init__(self, metrics_raw_info, rate=0, on_exhausted=None):
+        """
+        :param metrics_raw_info: List of metrics in the graphite line format
+        :param rate: The maximal number of metrics handed out per second (0 - as fast as the analyzer takes them)
+        :param on_exhausted: Called (once) when the analyzer asks for a metric after all of them were handed out. The
+        analyzer's loops keep asking until they are told to stop, so this is where they should be stopped.
+        """
+        transports.memory_transport.MemoryTransport.__init__(self, queue_size=0, published_kept=0)
+        for metric_raw_info in metrics_raw_info:
+            self.put(metric_raw_info)
+        self._rate = rate
+        self._on_exhausted = on_exhausted
+        self._handed_out_count = 0
+        self._started = None
+        self._handed_out_at = None
+        self.handling_latencies = []
+        self.handed_out_sizes = []
+
+    def _record_handling_done(self):
+        if self._handed_out_at is not None:
+            self.handling_latencies.append(time.time() - self._handed_out_at)
+            self._handed_out_at = None
+
+    def _hand_out(self, max_records):
+        self._record_handling_done()
+        records = transports.memory_transport.MemoryTransport.consume_batch(self, max_records, 0)
+        if len(records) == 0:
+            if self._on_exhausted is not None:
+                on_exhausted = self._on_exhausted
+                self._on_exhausted = None
+                on_exhausted()
+            return records
+        if self._started is None:
+            self._started = time.time()
+        self._handed_out_count += len(records)
+        if self._rate > 0:
+            wait_until_time = self._started + float(self._handed_out_count) / self._rate
+            if wait_until_time > time.time():
+                time.sleep(wait_until_time - time.time())
+        self.handed_out_sizes.append(len(records))
+        self._handed_out_at = time.time()
+        return records
+
+    def consume(self):
+        while True:
+            records = self._hand_out(1)
+            if len(records) == 0:
+                return
+            yield records[0]
+
+    def consume_batch(self, max_records, timeout_ms):
+        return self._hand_out(max_records)
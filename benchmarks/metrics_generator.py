@@ -0,0 +1,57 @@
+import math
+import random
+
+# sine - a daily (period of 1440 values) wave with some noise, random_walk - a bounded random walk, spikes - a noisy
+# flat line with a rare spike, constant - the same value over and over (the cheapest input for the models)
+METRICS_SHAPES = ["sine", "random_walk", "spikes", "constant"]
+
+
+class SyntheticMetricsGenerator:
+    """
+    Generates synthetic metrics in the graphite line format (metric.name.hierarchy value timestamp), interleaved the
+    way they arrive from Kafka: the first value of every metric, then the second value of every metric and so on. The
+    same arguments (and seed) always generate the same metrics.
+    """
+
+    def __init__(self, metrics_count, values_per_metric, interval=60, shape="sine", seed=0, metrics_prefix="benchmark.host"):
+        """
+        :param metrics_count: The number of distinct metrics (the cardinality)
+        :param values_per_metric: The number of values generated for each metric
+        :param interval: The seconds between two consecutive values of the same metric
+        :param shape: One of METRICS_SHAPES
+        :param seed: The seed of the random noise
+        :param metrics_prefix: The prefix of the metrics names (their family). The names are <prefix>_<n>.metric_<n>
+        """
+        if shape not in METRICS_SHAPES:
+            raise ValueError("The shape " + str(shape) + " is invalid. It should be one of: " + ", ".join(METRICS_SHAPES))
+        self.metrics_count = metrics_count
+        self.values_per_metric = values_per_metric
+        self.interval = interval
+        self.shape = shape
+        self.seed = seed
+        self.metrics_names = [metrics_prefix + "_" + str(metric_idx % 10) + ".metric_" + str(metric_idx) for metric_idx in range(0, metrics_count)]
+
+    def _get_value(self, rnd, metric_idx, value_idx, last_value):
+        if self.shape == "constant":
+            return 10.0
+        if self.shape == "random_walk":
+            return min(100.0, max(0.0, last_value + rnd.uniform(-2, 2)))
+        if self.shape == "spikes":
+            return 10.0 + rnd.uniform(-1, 1) + (50.0 if rnd.random() < 0.005 else 0.0)
+        return 50.0 + 40.0 * math.sin(2 * math.pi * (value_idx + metric_idx * 37) / 1440.0) + rnd.uniform(-2, 2)
+
+    def generate(self, start_timestamp=1500000000):
+        """
+        :param start_timestamp: The timestamp of the first value of each metric
+        :return: Generator of metrics in the graphite line format
+        """
+        rnd = random.Random(self.seed)
+        last_values = [50.0] * self.metrics_count
+        for value_idx in range(0, self.values_per_metric):
+            metric_timestamp = str(start_timestamp + value_idx * self.interval)
+            for metric_idx, metric_name in enumerate(self.metrics_names):
+                last_values[metric_idx] = self._get_value(rnd, metric_idx, value_idx, last_values[metric_idx])
+                yield metric_name + " " + repr(round(last_values[metric_idx], 3)) + " " + metric_timestamp
+
+    def __len__(self):
+        return self.metrics_count * self.values_per_metric
@@ -0,0 +1,290 @@
+#!/usr/bin/python2.7
+##########################################################################
+# Pensu Benchmark                                                        #
+# ---------------                                                        #
+#                                                                        #
+# Drives the metrics analyzer in-process (without Kafka) with synthetic  #
+# metrics and reports its throughput, handling latency (overall and per  #
+# stage), model creation time, checkpoint save/load times and memory    #
+# per metric as JSON, so runs can be compared over time.                 #
+#                                                                        #
+# Run from the repository root:                                          #
+# e.g. python -m benchmarks.pensu_benchmark --metrics 50 --values 500    #
+#        --output benchmarks_results.jsonl                               #
+#                                                                        #
+##########################################################################
+
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import config_mgr
+import stats_mgr
+import models_library
+import model_persistence.models_factory
+import model_persistence.models_storage
+import model_params.size_profiles
+import utils.global_state
+import utils.latency_histograms
+import utils.mertrics_parser
+import pensu_metrics_analyzer
+import benchmarks.metrics_generator
+import benchmarks.in_process_transport
+
+
+def get_rss_bytes():
+    """
+    :return: The resident set size of this process (the peak one where /proc is not available)
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    :param sorted_values: A sorted (ascending) list of values
+    :param percentile: The percentile to return (0-100)
+    :return: The value at the given percentile (nearest rank) or None if there are no values
+    """
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(round(percentile / 100.0 * len(sorted_values))) - 1))]
+
+
+def summarize_latencies(latencies):
+    sorted_latencies = sorted(latencies)
+    return {
+        "count": len(sorted_latencies),
+        "avg": sum(sorted_latencies) / len(sorted_latencies) if len(sorted_latencies) > 0 else None,
+        "p50": get_percentile(sorted_latencies, 50),
+        "p90": get_percentile(sorted_latencies, 90),
+        "p99": get_percentile(sorted_latencies, 99),
+        "max": sorted_latencies[-1] if len(sorted_latencies) > 0 else None
+    }
+
+
+def summarize_histogram(histogram, percentiles=(50, 90, 99)):
+    """
+    :param histogram: A histogram as found in LatencyHistograms.get_snapshot()
+    :param percentiles: The percentiles to estimate
+    :return: Dictionary with the count, the average and the estimated percentiles (the upper bound of the bucket each
+    percentile falls in, or None if it falls in the +Inf bucket)
+    """
+    count = sum(histogram["counts"])
+    res = {"count": count, "avg": histogram["sum"] / count if count > 0 else None}
+    for percentile in percentiles:
+        res["p" + str(percentile)] = None
+        cumulative_count = 0
+        for bucket_bound, bucket_count in zip(utils.latency_histograms.BUCKETS_BOUNDS + [None], histogram["counts"]):
+            cumulative_count += bucket_count
+            if count > 0 and cumulative_count >= percentile / 100.0 * count:
+                res["p" + str(percentile)] = bucket_bound
+                break
+    return res
+
+
+def get_dir_size(dir_path):
+    dir_size = 0
+    for root, dirs, files in os.walk(dir_path):
+        for file_name in files:
+            dir_size += os.path.getsize(os.path.join(root, file_name))
+    return dir_size
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class PensuBenchmark:
+    """
+    Runs a single benchmark: feeds the synthetic metrics through MetricsRealtimeAnalyzer's handling loop (using an
+    in-process transport), then measures model creation, checkpoint saving and checkpoint loading directly.
+    """
+
+    def __init__(self, args, save_base_path):
+        self._args = args
+        self._save_base_path = save_base_path
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+        self._metrics_generator = benchmarks.metrics_generator.SyntheticMetricsGenerator(args.metrics, args.values, args.interval, args.shape, args.seed)
+
+    def _get_metrics_dicts(self, metrics_names):
+        metrics_parser = utils.mertrics_parser.MetricsParser()
+        return [metrics_parser.parse_metric_message(metric_name + " 0 0", update_stats=False) for metric_name in metrics_names]
+
+    def _load_metric_models(self, models_factory, metric):
+        models_factory.get_anomaly_model(metric, True)
+        if not models_factory.is_single_model_mode():
+            models_factory.get_prediction_model(metric, True)
+        models_factory.get_anomaly_likelihood_calc(metric, True)
+
+    @staticmethod
+    def _drop_metric_models(models_library_instance, metric_name):
+        for model_type in models_library.MODEL_TYPES:
+            models_library_instance.remove_model(models_library.get_model_key(model_type, metric_name))
+        models_library_instance.remove_anomaly_calc(metric_name)
+        models_library_instance.forget_metric(metric_name)
+
+    def _run_analyzer(self, results):
+        metrics_raw_info = list(self._metrics_generator.generate())
+        transport = benchmarks.in_process_transport.BenchmarkTransport(
+            metrics_raw_info,
+            rate=self._args.rate,
+            on_exhausted=lambda: self._global_state.fire_event(event_name="sigint_received", set_global_status=True)
+        )
+        analyzer = pensu_metrics_analyzer.MetricsRealtimeAnalyzer(transport=transport)
+
+        self._latency_histograms.reset()
+        rss_before = get_rss_bytes()
+        run_started = time.time()
+        analyzer.run_analyzer()
+        run_duration = time.time() - run_started
+        rss_after = get_rss_bytes()
+
+        metrics_loaded = models_library.ModelsLibrary.get_instance().get_anomaly_calc_count()
+        values_per_handling = float(len(metrics_raw_info)) / max(1, len(transport.handed_out_sizes))
+        results["throughput"] = {
+            "values": len(metrics_raw_info),
+            "values_processed": self._stats_mgr.get("metrics_successfully_processed"),
+            "duration_seconds": run_duration,
+            "values_per_second": len(metrics_raw_info) / run_duration if run_duration > 0 else None,
+            "messages_sent": sum(transport.get_published_counts().values()),
+            "messages_sent_per_topic": transport.get_published_counts()
+        }
+        # When using batches, each latency is of a whole batch
+        results["handling_latency_seconds"] = summarize_latencies(transport.handling_latencies)
+        results["handling_latency_seconds"]["values_per_handling"] = values_per_handling
+        snapshot = self._latency_histograms.get_snapshot()
+        results["stages_latency_seconds"] = dict([(stage, summarize_histogram(histogram)) for stage, histogram in snapshot.items()])
+        results["memory"] = {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "metrics_loaded": metrics_loaded,
+            "models_loaded": models_library.ModelsLibrary.get_instance().get_models_count(),
+            "rss_per_metric_bytes": (rss_after - rss_before) / metrics_loaded if metrics_loaded > 0 else None,
+            "estimated_bytes_per_metric": models_library.ModelsLibrary.get_instance().get_models_memory() / metrics_loaded if metrics_loaded > 0 else None
+        }
+
+    def _measure_model_creation(self, results):
+        models_factory = model_persistence.models_factory.ModelFactory()
+        models_library_instance = models_library.ModelsLibrary.get_instance()
+        metrics = self._get_metrics_dicts(["benchmark.model_creation.metric_" + str(metric_idx) for metric_idx in range(0, self._args.model_creation_samples)])
+        creation_durations = []
+        for metric in metrics:
+            creation_started = time.time()
+            self._load_metric_models(models_factory, metric)
+            creation_durations.append(time.time() - creation_started)
+        for metric in metrics:
+            self._drop_metric_models(models_library_instance, metric["metric_name"])
+        results["model_creation_seconds"] = summarize_latencies(creation_durations)
+
+    def _measure_checkpoints(self, results):
+        models_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        models_factory = model_persistence.models_factory.ModelFactory()
+        models_library_instance = models_library.ModelsLibrary.get_instance()
+
+        save_started = time.time()
+        models_storage.save_changed_metrics("benchmark")
+        save_duration = time.time() - save_started
+
+        metrics = self._get_metrics_dicts(self._metrics_generator.metrics_names)
+        for metric in metrics:
+            self._drop_metric_models(models_library_instance, metric["metric_name"])
+        load_durations = []
+        for metric in metrics:
+            load_started = time.time()
+            self._load_metric_models(models_factory, metric)
+            load_durations.append(time.time() - load_started)
+
+        results["checkpoint"] = {
+            "format": self._config_mgr.get("checkpoint_format"),
+            "metrics_saved": self._stats_mgr.get("last_checkpoint_metrics_saved"),
+            "save_duration_seconds": save_duration,
+            "save_seconds_per_metric": save_duration / len(metrics) if len(metrics) > 0 else None,
+            "size_bytes": get_dir_size(self._save_base_path),
+            "load_seconds": summarize_latencies(load_durations)
+        }
+
+    def run(self):
+        config_gist = self._config_mgr.get_gist()
+        results = {}
+        self._run_analyzer(results)
+        if self._args.model_creation_samples > 0:
+            self._measure_model_creation(results)
+        if not self._args.skip_checkpoint:
+            self._measure_checkpoints(results)
+        return {
+            "timestamp": int(time.time()),
+            "git_revision": get_git_revision(),
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(self._args),
+            "config": dict([(key, config_gist[key]) for key in ["models_mode", "checkpoint_format", "prediction_steps", "kafka_consumer_max_poll_records", "model_params_mapping", "model_size_profiles_mapping", "default_model_size_profile"]]),
+            "results": results
+        }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the Pensu metrics analyzer in-process with synthetic metrics. The rest of the configuration (models mode, checkpoint format, model params etc.) is taken from the PENSU_* environment variables the service uses.")
+    parser.add_argument("--metrics", type=int, default=20, help="The number of distinct metrics (default: 20)")
+    parser.add_argument("--values", type=int, default=200, help="The number of values of each metric (default: 200)")
+    parser.add_argument("--interval", type=int, default=60, help="The seconds between two values of the same metric (default: 60)")
+    parser.add_argument("--shape", choices=benchmarks.metrics_generator.METRICS_SHAPES, default="sine", help="The shape of the metrics values (default: sine)")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the metrics values noise (default: 0)")
+    parser.add_argument("--rate", type=float, default=0, help="The maximal number of values per second fed to the analyzer (default: 0 - as fast as it takes them)")
+    parser.add_argument("--batch-size", type=int, default=0, help="Feed the values in batches of up to this many values, like PENSU_KAFKA_CONSUMER_MAX_POLL_RECORDS (default: 0 - one at a time)")
+    parser.add_argument("--size-profile", choices=sorted(model_params.size_profiles.SIZE_PROFILES.keys()), default=None, help="Use this model size profile for all the metrics (default: as set by PENSU_MODEL_SIZE_PROFILES_MAPPING and PENSU_DEFAULT_MODEL_SIZE_PROFILE)")
+    parser.add_argument("--model-creation-samples", type=int, default=5, help="The number of models created to measure the model creation time (default: 5)")
+    parser.add_argument("--skip-checkpoint", action="store_true", help="Do not measure the checkpoint save and load times")
+    parser.add_argument("--log-minimum-severity", type=int, default=2, help="Like PENSU_LOG_MINIMUM_SEVERITY (default: 2 - warnings)")
+    parser.add_argument("--output", default=None, help="A file to append the results to (as a single JSON line). The results are printed anyway.")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    save_base_path = tempfile.mkdtemp(prefix="pensu_benchmark_")
+    try:
+        # The models are saved to a temporary directory and there is no limit on their number. The analysis runs on
+        # this process (the worker processes, if configured, would hide the models' memory and timings).
+        config = config_mgr.ConfigMgr.get_instance()
+        config.set("models_save_base_path", os.path.join(save_base_path, "models"))
+        config.set("anomaly_likelihood_detectors_save_base_path", os.path.join(save_base_path, "anomaly_likelihood_calculators"))
+        config.set("max_allowed_models", max(config.get("max_allowed_models"), len(models_library.MODEL_TYPES) * (args.metrics + args.model_creation_samples)))
+        config.set("worker_processes", 0)
+        config.set("kafka_consumer_max_poll_records", args.batch_size)
+        config.set("log_minimum_severity", args.log_minimum_severity)
+        config.set("topics_list_topic", "")
+        if args.size_profile is not None:
+            config.set("model_size_profiles_mapping", "")
+            config.set("default_model_size_profile", args.size_profile)
+
+        results = PensuBenchmark(args, save_base_path).run()
+    finally:
+        shutil.rmtree(save_base_path, ignore_errors=True)
+
+    print(json.dumps(results, indent=4, sort_keys=True))
+    if args.output is not None:
+        with open(args.output, "a") as output_file:
+            output_file.write(json.dumps(results, sort_keys=True) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -44,14 +44,32 @@ class ConfigMgr:
                     "autosave_models_interval":                              {"type": "int",    "resolve_placeholders": False, "default": 86400,                                               "environ_var": "PENSU_MODELS_AUTOSAVE_INTERVAL"},
                     "ping_listen_host":                                      {"type": "string", "resolve_placeholders": False, "default": "0.0.0.0",                                           "environ_var": "PENSU_PING_LISTEN_HOST"},
                     "ping_listen_port":                                      {"type": "int",    "resolve_placeholders": False, "default": 6666,                                                "environ_var": "PENSU_PING_LISTEN_PORT"},
-                    "log_minimum_severity":                                  {"type": "int",    "resolve_placeholders": False, "default": 1,                                                   "environ_var": "PENSU_LOG_MINIMUM_SEVERITY"},
+                    "log_minimum_severity":                                  {"type": "int",    "resolve_placeholders": False, "default": 3,                                                   "environ_var": "PENSU_LOG_MINIMUM_SEVERITY"},
+                    "latency_histograms_enabled":                            {"type": "int",    "resolve_placeholders": False, "default": 1,                                                   "environ_var": "PENSU_LATENCY_HISTOGRAMS_ENABLED"},
+                    "log_async":                                             {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_LOG_ASYNC"},
+                    "log_async_queue_size":                                  {"type": "int",    "resolve_placeholders": False, "default": 10000,                                               "environ_var": "PENSU_LOG_ASYNC_QUEUE_SIZE"},
                     "log_to_console":                                        {"type": "int",    "resolve_placeholders": False, "default": 1,                                                   "environ_var": "PENSU_LOG_TO_CONSOLE"},
                     "log_to_syslog":                                         {"type": "int",    "resolve_placeholders": False, "default": 1,                                                   "environ_var": "PENSU_LOG_TO_SYSLOG"},
                     "prediction_steps":                                      {"type": "int",    "resolve_placeholders": False, "default": 5,                                                   "environ_var": "PENSU_PREDICTION_STEPS"},
                     "anomaly_likelihood_calculator_filename":                {"type": "string", "resolve_placeholders": False, "default": "pensu_anomaly_likelihood_calculator",               "environ_var": "PENSU_ANOMALYCALC_FILENAME"},
                     "metrics_prefix":                                        {"type": "string", "resolve_placeholders": False, "default": "pensu.{{#anomaly_metric}}.metrics_analyzer",        "environ_var": "PENSU_METRIC_NAMES_TEMPLATE"},
+                    "transport":                                             {"type": "string", "resolve_placeholders": False, "default": "kafka",                                             "environ_var": "PENSU_TRANSPORT"},
+                    "memory_transport_queue_size":                           {"type": "int",    "resolve_placeholders": False, "default": 100000,                                              "environ_var": "PENSU_MEMORY_TRANSPORT_QUEUE_SIZE"},
+                    "carbon_listener_enabled":                               {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_CARBON_LISTENER_ENABLED"},
+                    "carbon_listen_host":                                    {"type": "string", "resolve_placeholders": False, "default": "0.0.0.0",                                           "environ_var": "PENSU_CARBON_LISTEN_HOST"},
+                    "carbon_listen_port":                                    {"type": "int",    "resolve_placeholders": False, "default": 2003,                                                "environ_var": "PENSU_CARBON_LISTEN_PORT"},
+                    "carbon_output_enabled":                                 {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_CARBON_OUTPUT_ENABLED"},
+                    "carbon_output_host":                                    {"type": "string", "resolve_placeholders": False, "default": "graphite",                                          "environ_var": "PENSU_CARBON_OUTPUT_HOST"},
+                    "carbon_output_port":                                    {"type": "int",    "resolve_placeholders": False, "default": 2003,                                                "environ_var": "PENSU_CARBON_OUTPUT_PORT"},
+                    "carbon_output_connections":                             {"type": "int",    "resolve_placeholders": False, "default": 2,                                                   "environ_var": "PENSU_CARBON_OUTPUT_CONNECTIONS"},
+                    "carbon_output_batch_size":                              {"type": "int",    "resolve_placeholders": False, "default": 500,                                                 "environ_var": "PENSU_CARBON_OUTPUT_BATCH_SIZE"},
+                    "carbon_output_buffer_size":                             {"type": "int",    "resolve_placeholders": False, "default": 100000,                                              "environ_var": "PENSU_CARBON_OUTPUT_BUFFER_SIZE"},
+                    "pipeline_enabled":                                      {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_PIPELINE_ENABLED"},
+                    "pipeline_queue_size":                                   {"type": "int",    "resolve_placeholders": False, "default": 1000,                                                "environ_var": "PENSU_PIPELINE_QUEUE_SIZE"},
                     "kafka_consumer_client_id":                              {"type": "string", "resolve_placeholders": True,  "default": "pensu_consumer_{{#instance_id}}_{{#time_started}}", "environ_var": "PENSU_KAFKA_CONSUMER_CLIENT_ID"},
                     "kafka_consumer_session_timeout":                        {"type": "int",    "resolve_placeholders": False, "default": 5000,                                                "environ_var": "PENSU_KAFKA_CONSUMER_SESSION_TIMEOUT_MS"},
+                    "kafka_consumer_group_id":                               {"type": "string", "resolve_placeholders": False, "default": "",                                                  "environ_var": "PENSU_KAFKA_CONSUMER_GROUP_ID"},
+                    "kafka_consumer_max_poll_records":                       {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_KAFKA_CONSUMER_MAX_POLL_RECORDS"},
                     "kafka_consumer_server":                                 {"type": "string", "resolve_placeholders": False, "default": "kafka:9092",                                        "environ_var": "PENSU_KAFKA_CONSUMER_SERVER"},
                     "kafka_producer_client_id":                              {"type": "string", "resolve_placeholders": True,  "default": "pensu_producer_{{#instance_id}}_{{#time_started}}", "environ_var": "PENSU_KAFKA_PRODUCER_CLIENT_ID"},
                     "kafka_producer_server":                                 {"type": "string", "resolve_placeholders": False, "default": "kafka:9092",                                        "environ_var": "PENSU_KAFKA_PRODUCER_SERVER"},
@@ -61,13 +79,32 @@ class ConfigMgr:
                     "anomaly_reports_kafka_topic":                           {"type": "string", "resolve_placeholders": False, "default": "pensu.htm.anomaly_metrics",                         "environ_var": "PENSU_REPORTED_ANOMALIES_KAFKA_TOPIC"},
                     "predictions_metrics_kafka_topic":                       {"type": "string", "resolve_placeholders": False, "default": "pensu.htm.predictions",                             "environ_var": "PENSU_PREDICTION_METRICS_KAFKA_TOPIC"},
                     "anomalies_metrics_kafka_topic":                         {"type": "string", "resolve_placeholders": False, "default": "pensu_anomalies",                                   "environ_var": "PENSU_ANOMALIES_METRICS_KAFKA_TOPIC"},
+                    "metrics_names_cache_size":                              {"type": "int",    "resolve_placeholders": False, "default": 100000,                                              "environ_var": "PENSU_METRICS_NAMES_CACHE_SIZE"},
                     "allowed_to_work_on_metrics_pattern":                    {"type": "re",     "resolve_placeholders": False, "default": ".*",                                                "environ_var": "PENSU_ALLOWED_TO_WORK_ON_METRICS"},
                     "logging_format":                                        {"type": "string", "resolve_placeholders": True,  "default": "timestamp=%s;module=smart-onion_%s;method=%s;severity=%s;state=%s;metric/metric_family=%s;exception_msg=%s;exception_type=%s;message=%s", "environ_var": "PENSU_LOGGING_FORMAT"},
                     "anomaly_score_threshold_for_reporting":                 {"type": "float",  "resolve_placeholders": False, "default": 0.99,                                                "environ_var": "PENSU_ANOMALY_SCORE_THRESHOLD"},
                     "anomaly_likelihood_threshold_for_reporting":            {"type": "float",  "resolve_placeholders": False, "default": 0.99999,                                             "environ_var": "PENSU_ANOMALY_LIKELIHOOD_THRESHOLD"},
                     "minimum_confidence_for_reporting":                      {"type": "float",  "resolve_placeholders": False, "default": 0.9,                                                 "environ_var": "PENSU_MINIMUM_CONFIDENCE_FOR_REPORTING"},
+                    "models_mode":                                           {"type": "string", "resolve_placeholders": False, "default": "separate",                                          "environ_var": "PENSU_MODELS_MODE"},
                     "max_allowed_models":                                    {"type": "int",    "resolve_placeholders": False, "default": 10,                                                  "environ_var": "PENSU_MAX_ALLOWED_MODELS"},
                     "minimum_seconds_between_model_over_quota_log_messages": {"type": "int",    "resolve_placeholders": False, "default": 300,                                                 "environ_var": "PENSU_MIN_SECONDS_BETWEEN_OVER_QUOTA_LOG_MSG"},
+                    "model_params_mapping":                                  {"type": "string", "resolve_placeholders": False, "default": "",                                                  "environ_var": "PENSU_MODEL_PARAMS_MAPPING"},
+                    "model_size_profiles_mapping":                           {"type": "string", "resolve_placeholders": False, "default": "",                                                  "environ_var": "PENSU_MODEL_SIZE_PROFILES_MAPPING"},
+                    "default_model_size_profile":                            {"type": "string", "resolve_placeholders": False, "default": "large",                                             "environ_var": "PENSU_DEFAULT_MODEL_SIZE_PROFILE"},
+                    "aggregation_windows":                                   {"type": "string", "resolve_placeholders": False, "default": "",                                                  "environ_var": "PENSU_AGGREGATION_WINDOWS"},
+                    "max_model_memory_mb":                                   {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_MAX_MODEL_MEMORY_MB"},
+                    "metric_locks_stripes":                                  {"type": "int",    "resolve_placeholders": False, "default": 1024,                                                "environ_var": "PENSU_METRIC_LOCKS_STRIPES"},
+                    "models_eviction_policy":                                {"type": "string", "resolve_placeholders": False, "default": "none",                                              "environ_var": "PENSU_MODELS_EVICTION_POLICY"},
+                    "models_max_idle_seconds":                               {"type": "int",    "resolve_placeholders": False, "default": 3600,                                                "environ_var": "PENSU_MODELS_MAX_IDLE_SECONDS"},
+                    "checkpoints_manifest_filename":                         {"type": "string", "resolve_placeholders": False, "default": "pensu_checkpoints_manifest.jsonl",                  "environ_var": "PENSU_CHECKPOINTS_MANIFEST_FILENAME"},
+                    "checkpoint_format":                                     {"type": "string", "resolve_placeholders": False, "default": "directory",                                         "environ_var": "PENSU_CHECKPOINT_FORMAT"},
+                    "checkpoint_concurrency":                                {"type": "int",    "resolve_placeholders": False, "default": 4,                                                   "environ_var": "PENSU_CHECKPOINT_CONCURRENCY"},
+                    "checkpoint_on_shutdown":                                {"type": "int",    "resolve_placeholders": False, "default": 1,                                                   "environ_var": "PENSU_CHECKPOINT_ON_SHUTDOWN"},
+                    "shutdown_timeout":                                      {"type": "int",    "resolve_placeholders": False, "default": 60,                                                  "environ_var": "PENSU_SHUTDOWN_TIMEOUT"},
+                    "worker_processes":                                      {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_WORKER_PROCESSES"},
+                    "worker_queue_size":                                     {"type": "int",    "resolve_placeholders": False, "default": 10000,                                               "environ_var": "PENSU_WORKER_QUEUE_SIZE"},
+                    "stats_shared_memory":                                   {"type": "int",    "resolve_placeholders": False, "default": 0,                                                   "environ_var": "PENSU_STATS_SHARED_MEMORY"},
+                    "worker_stats_report_interval":                          {"type": "int",    "resolve_placeholders": False, "default": 5,                                                   "environ_var": "PENSU_WORKER_STATS_REPORT_INTERVAL"},
                 }
 
                 self._config = {
@@ -113,6 +150,18 @@ class ConfigMgr:
         else:
             raise ConfigKeyNotFoundException("The config key (b64:" + base64.b64encode(str(key)) + ") could not be found in the configuration keys")
 
+    def set(self, key, value):
+        """
+        Overrides the value of an existing config key. Used by the tools that run the analysis in-process (i.e. the
+        benchmarks) and must be called before the classes that read the key are created.
+        :param key: The config key
+        :param value: The new value (already of the key's type)
+        :return: None
+        """
+        if key not in self._config:
+            raise ConfigKeyNotFoundException("The config key (b64:" + base64.b64encode(str(key)) + ") could not be found in the configuration keys")
+        self._config[key] = value
+
     def get_gist(self):
         res = {}
         for key in self._configs_keys.keys():
@@ -0,0 +1,84 @@
+# The named size profiles of the HTM models. Each profile overrides (on top of the metric family's model params) the
+# dimensions of the spatial pooler, the temporal memory and the value encoder, trading accuracy for CPU and memory.
+# "large" keeps the model params as they are (the original sizes).
+SIZE_PROFILES = {
+    "small": {
+        "modelParams": {
+            "sensorParams": {
+                "encoders": {
+                    "value": {"n": 200}
+                }
+            },
+            "spParams": {
+                "columnCount": 512,
+                "numActiveColumnsPerInhArea": 10
+            },
+            "tmParams": {
+                "columnCount": 512,
+                "inputWidth": 512,
+                "cellsPerColumn": 8,
+                "maxSegmentsPerCell": 32,
+                "maxSynapsesPerSegment": 16,
+                "newSynapseCount": 8,
+                "activationThreshold": 6,
+                "minThreshold": 4
+            }
+        }
+    },
+    "medium": {
+        "modelParams": {
+            "sensorParams": {
+                "encoders": {
+                    "value": {"n": 300}
+                }
+            },
+            "spParams": {
+                "columnCount": 1024,
+                "numActiveColumnsPerInhArea": 20
+            },
+            "tmParams": {
+                "columnCount": 1024,
+                "inputWidth": 1024,
+                "cellsPerColumn": 16,
+                "maxSegmentsPerCell": 64,
+                "maxSynapsesPerSegment": 24,
+                "newSynapseCount": 14,
+                "activationThreshold": 10,
+                "minThreshold": 8
+            }
+        }
+    },
+    "large": {}
+}
+
+# The value encoder's width when the model params don't set it (RandomDistributedScalarEncoder's default)
+DEFAULT_VALUE_ENCODER_N = 400
+
+
+def apply_size_profile(model_params, profile_name):
+    """
+    Applies the given size profile to the given model params. Since the spatial pooler's input is the encoders' output,
+    its inputWidth is changed by as much as the value encoder's width is.
+    :param model_params: OPF model params dictionary (changed in place)
+    :param profile_name: One of SIZE_PROFILES
+    :return: The given model params
+    """
+    profile = SIZE_PROFILES[profile_name]
+    value_encoder = model_params["modelParams"]["sensorParams"]["encoders"].get("value")
+    if value_encoder is None:
+        # Params without a value encoder (i.e. with differently named encoders) keep their encoders as they are
+        _merge(model_params["modelParams"], dict([(key, value) for key, value in profile.get("modelParams", {}).items() if key != "sensorParams"]))
+        return model_params
+
+    value_encoder_n = value_encoder.get("n", DEFAULT_VALUE_ENCODER_N)
+    _merge(model_params, profile)
+    model_params["modelParams"]["spParams"]["inputWidth"] += value_encoder.get("n", DEFAULT_VALUE_ENCODER_N) - value_encoder_n
+    return model_params
+
+
+def _merge(target, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
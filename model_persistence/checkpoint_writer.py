@@ -0,0 +1,107 @@
+import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+import config_mgr
+import stats_mgr
+import utils.global_state
+import utils.logger
+
+
+class CheckpointWriter:
+    """
+    Saves the models of many metrics at once on a bounded pool of threads (checkpoint_concurrency). Used both by the
+    auto save thread (which spreads the saves over its interval) and on shutdown (which saves at full speed).
+    Only one checkpoint runs at a time.
+    """
+
+    def __init__(self, save_metric_func):
+        """
+        :param save_metric_func: Function that gets a metric name, saves its models and returns True on success
+        """
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "CheckpointWriter")
+        self._save_metric_func = save_metric_func
+        self._concurrency = max(1, self._config_mgr.get("checkpoint_concurrency"))
+        self._checkpoint_lock = Lock()
+
+    def write_checkpoint(self, pop_metrics_names_func, return_unsaved_metrics_func, reason, spread_over_seconds=0):
+        """
+        Saves the models of the metrics given by pop_metrics_names_func. Both functions are called with the checkpoint
+        lock held, so a checkpoint that starts while another one is running (i.e. the shutdown checkpoint during an
+        autosave) gets the metrics that the running one did not save.
+        :param pop_metrics_names_func: Function that returns (and forgets) the list of the metric names to save
+        :param return_unsaved_metrics_func: Function that gets the list of the metric names that were not saved (either
+        failed or skipped due to shutdown)
+        :param reason: Why the checkpoint is written (only used for logging)
+        :param spread_over_seconds: If above zero the saves are started evenly over that many seconds and the
+        checkpoint is stopped early if the service is shutting down
+        :return: None
+        """
+
+        self._checkpoint_lock.acquire()
+        try:
+            metrics_names = pop_metrics_names_func()
+            unsaved_metrics = set(metrics_names)
+            try:
+                if len(metrics_names) == 0:
+                    return
+                self._save_metrics(metrics_names, unsaved_metrics, reason, spread_over_seconds)
+            finally:
+                return_unsaved_metrics_func(list(unsaved_metrics))
+        finally:
+            self._checkpoint_lock.release()
+
+    def _save_metrics(self, metrics_names, unsaved_metrics, reason, spread_over_seconds):
+        checkpoint_started = time.time()
+        self._logger.info("write_checkpoint", "Starting the " + reason + " checkpoint of " + str(len(metrics_names)) + " metrics (concurrency=" + str(self._concurrency) + ", spread_over_seconds=" + str(spread_over_seconds) + ")")
+        saved_count = 0
+        failed_count = 0
+        next_progress_report_percent = 10
+        pool = ThreadPool(min(self._concurrency, len(metrics_names)))
+        try:
+            for metric_name, saved in pool.imap_unordered(self._save_metric, self._paced(metrics_names, spread_over_seconds, checkpoint_started)):
+                if saved:
+                    unsaved_metrics.discard(metric_name)
+                    saved_count += 1
+                else:
+                    failed_count += 1
+                done_percent = (saved_count + failed_count) * 100 / len(metrics_names)
+                if done_percent >= next_progress_report_percent:
+                    self._logger.info("write_checkpoint", "The " + reason + " checkpoint is " + str(done_percent) + "% done (saved=" + str(saved_count) + ", failed=" + str(failed_count) + ", seconds_elapsed=" + str(round(time.time() - checkpoint_started, 2)) + ")")
+                    next_progress_report_percent = done_percent - done_percent % 10 + 10
+        finally:
+            pool.close()
+            pool.join()
+
+        checkpoint_duration = time.time() - checkpoint_started
+        self._stats_mgr.set("last_checkpoint_duration_ms", int(checkpoint_duration * 1000))
+        self._stats_mgr.set("last_checkpoint_metrics_saved", saved_count)
+        self._stats_mgr.set("last_checkpoint_metrics_failed", failed_count)
+        self._logger.info("write_checkpoint", "The " + reason + " checkpoint is done (saved=" + str(saved_count) + ", failed=" + str(failed_count) + ", skipped=" + str(len(unsaved_metrics) - failed_count) + ", duration_seconds=" + str(round(checkpoint_duration, 2)) + ")")
+
+    def _save_metric(self, metric_name):
+        # noinspection PyBroadException
+        try:
+            return metric_name, self._save_metric_func(metric_name)
+        except Exception as ex:
+            self._logger.warn("_save_metric", "Failed to save the models of this metric due to an exception", metric=str(metric_name), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+            return metric_name, False
+
+    def _paced(self, metrics_names, spread_over_seconds, checkpoint_started):
+        if spread_over_seconds <= 0:
+            for metric_name in metrics_names:
+                yield metric_name
+            return
+
+        save_pace = float(spread_over_seconds) / len(metrics_names)
+        for metric_idx, metric_name in enumerate(metrics_names):
+            while time.time() < checkpoint_started + metric_idx * save_pace:
+                if self._global_state.get_global_status("sigint_received"):
+                    return
+                time.sleep(max(0, min(1, checkpoint_started + metric_idx * save_pace - time.time())))
+            if self._global_state.get_global_status("sigint_received"):
+                return
+            yield metric_name
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import fcntl
+from threading import Lock
+
+import stats_mgr
+import utils.logger
+
+
+class CheckpointsManifest:
+    """
+    Keeps (in memory) the location, version and size of every saved model and anomaly likelihood calculator, so
+    finding a known checkpoint does not require probing the disk.
+    The manifest is persisted as a journal - every save appends one line to it (so a crash can only lose the line being
+    written) and it is compacted (atomically replaced by a file with a single line per checkpoint) when it grows.
+    """
+
+    def __init__(self, manifest_path):
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "CheckpointsManifest")
+        self._manifest_path = manifest_path
+        self._lock_file_path = manifest_path + ".lock"
+        self._entries = {}
+        # Checkpoints that were looked up on the disk and not found there (so they are not looked up again)
+        self._missing_keys = set()
+        self._journal_lines_count = 0
+        self._threads_lock = Lock()
+
+    @staticmethod
+    def _get_key(path_element, name):
+        return path_element + ":" + name
+
+    def load(self, scan_func):
+        """
+        Loads the manifest from the disk. If there's no manifest yet (i.e. on the first run after an upgrade), it is
+        built by the given scan function and saved.
+        :param scan_func: Function that returns a list of (path_element, name, path, size) tuples of existing checkpoints
+        :return: None
+        """
+
+        self._threads_lock.acquire()
+        try:
+            self._missing_keys = set()
+            if os.path.isfile(self._manifest_path):
+                self._entries = {}
+                self._journal_lines_count = self._read_journal(self._entries)
+                self._logger.info("load", "Loaded the checkpoints manifest (" + str(len(self._entries)) + " checkpoints)")
+            else:
+                self._logger.info("load", "No checkpoints manifest was found at " + self._manifest_path + ". Building it from the existing checkpoints...")
+                self._entries = {}
+                for path_element, name, path, size in scan_func():
+                    self._entries[self._get_key(path_element, name)] = {"path_element": path_element, "name": name, "path": path, "version": 1, "size": size, "saved_at": time.time()}
+                self._compact()
+                self._logger.info("load", "Built the checkpoints manifest (" + str(len(self._entries)) + " checkpoints)")
+        finally:
+            self._threads_lock.release()
+
+    def get(self, path_element, name):
+        """
+        :param path_element: Either "model" or "anomaly_likelihood_calculator"
+        :param name: The key of the model / the metric name of the anomaly likelihood calculator
+        :return: The manifest entry (dict with path, version, size and saved_at) or None if there's no such checkpoint
+        """
+        return self._entries.get(self._get_key(path_element, name))
+
+    def is_known_missing(self, path_element, name):
+        """
+        :param path_element: Either "model" or "anomaly_likelihood_calculator"
+        :param name: The key of the model / the metric name of the anomaly likelihood calculator
+        :return: True if the checkpoint was already looked up on the disk and was not found there
+        """
+        return self._get_key(path_element, name) in self._missing_keys
+
+    def record_missing(self, path_element, name):
+        """
+        Records (in memory only) that a checkpoint was looked up on the disk and was not found there. It's forgotten
+        once the checkpoint is saved or when forget_missing is called.
+        :param path_element: Either "model" or "anomaly_likelihood_calculator"
+        :param name: The key of the model / the metric name of the anomaly likelihood calculator
+        :return: None
+        """
+
+        self._threads_lock.acquire()
+        try:
+            key = self._get_key(path_element, name)
+            if key not in self._entries:
+                self._missing_keys.add(key)
+        finally:
+            self._threads_lock.release()
+
+    def forget_missing(self):
+        """
+        Forgets all the checkpoints recorded as missing, so they are looked up on the disk again (i.e. after being
+        assigned partitions whose previous owner may have saved them)
+        :return: None
+        """
+
+        self._threads_lock.acquire()
+        try:
+            self._missing_keys = set()
+        finally:
+            self._threads_lock.release()
+
+    def record_found(self, path_element, name, path, size):
+        """
+        Records (in memory only) a checkpoint that was found on the disk without being in the manifest, i.e. one saved
+        by another instance (sharing the save volume) after this one loaded the manifest. The instance that saved it
+        already added it to the journal.
+        :param path_element: Either "model" or "anomaly_likelihood_calculator"
+        :param name: The key of the model / the metric name of the anomaly likelihood calculator
+        :param path: Where the checkpoint was found
+        :param size: The size (in bytes) of the checkpoint
+        :return: The manifest entry of the checkpoint
+        """
+
+        self._threads_lock.acquire()
+        try:
+            key = self._get_key(path_element, name)
+            self._missing_keys.discard(key)
+            if key not in self._entries:
+                self._entries[key] = {"path_element": path_element, "name": name, "path": path, "version": 1, "size": size, "saved_at": time.time()}
+            return self._entries[key]
+        finally:
+            self._threads_lock.release()
+
+    def get_total_size(self):
+        return sum([entry["size"] for entry in self._entries.values()])
+
+    def get_count(self):
+        return len(self._entries)
+
+    def record_save(self, path_element, name, path, size):
+        """
+        Records that a checkpoint was saved
+        :param path_element: Either "model" or "anomaly_likelihood_calculator"
+        :param name: The key of the model / the metric name of the anomaly likelihood calculator
+        :param path: Where the checkpoint was saved
+        :param size: The size (in bytes) of the checkpoint
+        :return: None
+        """
+
+        self._threads_lock.acquire()
+        try:
+            key = self._get_key(path_element, name)
+            self._missing_keys.discard(key)
+            previous_entry = self._entries.get(key)
+            entry = {
+                "path_element": path_element,
+                "name": name,
+                "path": path,
+                "version": (previous_entry["version"] + 1) if previous_entry is not None else 1,
+                "size": size,
+                "saved_at": time.time()
+            }
+            self._entries[key] = entry
+            self._append_to_journal(entry)
+            self._journal_lines_count += 1
+            if self._journal_lines_count > 2 * len(self._entries) + 1000:
+                self._compact()
+        except (OSError, IOError) as ex:
+            self._logger.warn("record_save", "Failed to update the checkpoints manifest", metric=str(name), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+        finally:
+            self._threads_lock.release()
+
+    def _read_journal(self, entries):
+        lines_count = 0
+        with open(self._manifest_path, "r") as manifest_file:
+            for line in manifest_file:
+                lines_count += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Probably a line that was being written when the service crashed
+                    continue
+                entries[self._get_key(entry["path_element"], entry["name"])] = entry
+        return lines_count
+
+    def _append_to_journal(self, entry):
+        with open(self._lock_file_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self._manifest_path, "a") as manifest_file:
+                    manifest_file.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _compact(self):
+        manifest_dir = os.path.dirname(self._manifest_path)
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+
+        with open(self._lock_file_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Other processes (i.e. worker processes) may have added entries that this process does not know about
+                if os.path.isfile(self._manifest_path):
+                    entries = {}
+                    self._read_journal(entries)
+                    for key, entry in self._entries.items():
+                        if key not in entries or entries[key]["saved_at"] <= entry["saved_at"]:
+                            entries[key] = entry
+                    self._entries = entries
+
+                temp_manifest_path = self._manifest_path + ".tmp"
+                with open(temp_manifest_path, "w") as manifest_file:
+                    for entry in self._entries.values():
+                        manifest_file.write(json.dumps(entry) + "\n")
+                    manifest_file.flush()
+                    os.fsync(manifest_file.fileno())
+                os.rename(temp_manifest_path, self._manifest_path)
+                self._journal_lines_count = len(self._entries)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
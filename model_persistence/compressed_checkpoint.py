@@ -0,0 +1,77 @@
+import struct
+import zlib
+
+from nupic.frameworks.opf.htm_prediction_model import HTMPredictionModel
+from nupic.algorithms.anomaly_likelihood import AnomalyLikelihood
+
+# A compressed checkpoint holds all the models and the anomaly likelihood calculator of a single metric in one file:
+#   MAGIC + zlib.compress(<component> <component> ...)
+# where each component is:
+#   name length (unsigned short) + name + data length (unsigned long long) + data (capnp packed serialization)
+
+MAGIC = "PENSU-CKPT-1\n"
+ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT = "anomaly_likelihood_calculator"
+_TRAVERSAL_LIMIT_IN_WORDS = 1 << 63
+
+
+class CompressedCheckpointCorruptedException(Exception):
+    pass
+
+
+def _get_component_class(component_name):
+    if component_name == ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT:
+        return AnomalyLikelihood
+    return HTMPredictionModel
+
+
+def dumps(components, compression_level=6):
+    """
+    Serializes the given models/anomaly likelihood calculator into a compressed checkpoint
+    :param components: Dictionary of component name (model type or ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT) to object
+    :param compression_level: zlib compression level (1-9)
+    :return: The compressed checkpoint (string)
+    """
+
+    serialized_components = []
+    for component_name, component in components.items():
+        proto = _get_component_class(component_name).getSchema().new_message()
+        component.write(proto)
+        data = proto.to_bytes_packed()
+        serialized_components.append(struct.pack("!H", len(component_name)) + component_name + struct.pack("!Q", len(data)) + data)
+    return MAGIC + zlib.compress("".join(serialized_components), compression_level)
+
+
+def loads(checkpoint):
+    """
+    Deserializes a compressed checkpoint created by dumps()
+    :param checkpoint: The compressed checkpoint (string)
+    :return: Dictionary of component name (model type or ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT) to object
+    """
+
+    if not checkpoint.startswith(MAGIC):
+        raise CompressedCheckpointCorruptedException("The checkpoint does not start with the expected header")
+    try:
+        data = zlib.decompress(checkpoint[len(MAGIC):])
+    except zlib.error as ex:
+        raise CompressedCheckpointCorruptedException("Failed to decompress the checkpoint (" + str(ex) + ")")
+
+    components = {}
+    offset = 0
+    while offset < len(data):
+        if offset + 2 > len(data):
+            raise CompressedCheckpointCorruptedException("The checkpoint is truncated")
+        component_name_length = struct.unpack("!H", data[offset:offset + 2])[0]
+        offset += 2
+        component_name = data[offset:offset + component_name_length]
+        offset += component_name_length
+        if offset + 8 > len(data):
+            raise CompressedCheckpointCorruptedException("The checkpoint is truncated")
+        component_data_length = struct.unpack("!Q", data[offset:offset + 8])[0]
+        offset += 8
+        if offset + component_data_length > len(data):
+            raise CompressedCheckpointCorruptedException("The checkpoint is truncated")
+        component_class = _get_component_class(component_name)
+        proto = component_class.getSchema().from_bytes_packed(data[offset:offset + component_data_length], traversal_limit_in_words=_TRAVERSAL_LIMIT_IN_WORDS)
+        components[component_name] = component_class.read(proto)
+        offset += component_data_length
+    return components
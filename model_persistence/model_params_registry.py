@@ -0,0 +1,127 @@
+import copy
+import importlib
+import re
+from threading import Lock
+
+import config_mgr
+import stats_mgr
+import model_params.size_profiles
+import utils.logger
+
+
+class ModelParamsRegistry:
+    """
+    Resolves the model params of each metric family once and caches them. The params module of a family is chosen by
+    the first regex in model_params_mapping (format: "regex=>module;regex=>module") that matches the family name. If none
+    matches, a module named after the family is used if it exists (i.e. model_params/anomaly_model_params/my_family.py)
+    and otherwise the default one.
+    The params are then resized by the size profile (see model_params/size_profiles.py) chosen by the first regex in
+    model_size_profiles_mapping (same format: "regex=>profile;regex=>profile") that matches the family name, or by
+    default_model_size_profile if none matches.
+    The cached params are never handed out - every caller gets its own copy which it may change freely.
+    """
+
+    __instance = None
+    __threads_lock = Lock()
+
+    @staticmethod
+    def get_instance():
+        if ModelParamsRegistry.__instance is None:
+            ModelParamsRegistry()
+        return ModelParamsRegistry.__instance
+
+    def __init__(self):
+        ModelParamsRegistry.__threads_lock.acquire()
+        try:
+            if ModelParamsRegistry.__instance is not None:
+                raise Exception("This is a singleton class. Please use the get_instance() method.")
+            else:
+                ModelParamsRegistry.__instance = self
+                self._config_mgr = config_mgr.ConfigMgr.get_instance()
+                self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+                self._logger = utils.logger.Logger(__file__, "ModelParamsRegistry")
+                self._families_mapping = ModelParamsRegistry._parse_families_mapping(self._config_mgr.get("model_params_mapping"))
+                self._size_profiles_mapping = ModelParamsRegistry._parse_families_mapping(self._config_mgr.get("model_size_profiles_mapping"), mapping_name="model size profiles mapping", value_name="profile_name")
+                self._default_size_profile = self._config_mgr.get("default_model_size_profile").strip().lower()
+                for size_profile in [self._default_size_profile] + [size_profile for pattern, size_profile in self._size_profiles_mapping]:
+                    if size_profile not in model_params.size_profiles.SIZE_PROFILES:
+                        raise config_mgr.ConfigValueInvalidException("The model size profile " + size_profile + " is invalid. It should be one of: " + ", ".join(sorted(model_params.size_profiles.SIZE_PROFILES.keys())))
+                self._params_keys_by_family = {}
+                self._params_by_module = {}
+                self._sized_params = {}
+        finally:
+            ModelParamsRegistry.__threads_lock.release()
+
+    @staticmethod
+    def _parse_families_mapping(families_mapping, mapping_name="model params mapping", value_name="module_name"):
+        res = []
+        for mapping in families_mapping.split(";"):
+            if mapping.strip() == "":
+                continue
+            if "=>" not in mapping:
+                raise config_mgr.ConfigValueInvalidException("The " + mapping_name + " '" + mapping + "' is invalid. It should be in the format regex=>" + value_name)
+            pattern, value = mapping.rsplit("=>", 1)
+            try:
+                res.append((re.compile(pattern.strip()), value.strip()))
+            except re.error:
+                raise config_mgr.ConfigValueInvalidException("The regex in the " + mapping_name + " '" + mapping + "' is invalid")
+        return res
+
+    def get_model_params(self, metric_family, model_type):
+        """
+        :param metric_family: The metric family (the metric name without its last part)
+        :param model_type: Whether it's a prediction model or one for anomaly detection
+        :return: A copy of the OPF model params dictionary to use for that metric family
+        """
+
+        params_key = self._params_keys_by_family.get((model_type, metric_family))
+        if params_key is None:
+            params_key = self._resolve_params(metric_family, model_type)
+        return copy.deepcopy(self._sized_params[params_key])
+
+    def get_size_profile(self, metric_family):
+        """
+        :param metric_family: The metric family (the metric name without its last part)
+        :return: The name of the size profile of the models of that metric family
+        """
+        for pattern, size_profile in self._size_profiles_mapping:
+            if pattern.match(metric_family):
+                return size_profile
+        return self._default_size_profile
+
+    def _resolve_params(self, metric_family, model_type):
+        ModelParamsRegistry.__threads_lock.acquire()
+        try:
+            params_key = (self._resolve_module(metric_family, model_type), self.get_size_profile(metric_family))
+            if params_key not in self._sized_params:
+                self._sized_params[params_key] = model_params.size_profiles.apply_size_profile(copy.deepcopy(self._params_by_module[params_key[0]]), params_key[1])
+            self._params_keys_by_family[(model_type, metric_family)] = params_key
+            return params_key
+        finally:
+            ModelParamsRegistry.__threads_lock.release()
+
+    def _resolve_module(self, metric_family, model_type):
+        """
+        Finds (and loads, if it was not loaded yet) the model params module of the given metric family. Called with the
+        lock held.
+        :return: The import name of the module
+        """
+        module_name = None
+        for pattern, mapped_module_name in self._families_mapping:
+            if pattern.match(metric_family):
+                module_name = mapped_module_name
+                break
+        if module_name is None:
+            module_name = metric_family.replace(" ", "_").replace("-", "_")
+
+        import_name = "model_params." + model_type + "_model_params." + module_name
+        if import_name not in self._params_by_module:
+            try:
+                self._params_by_module[import_name] = copy.deepcopy(importlib.import_module(import_name).MODEL_PARAMS)
+                self._logger.debug("_resolve_module", "Loaded model params from " + str(import_name), metric=str(metric_family))
+            except ImportError:
+                self._logger.debug("_resolve_module", "No model params exist for that metric family. Using default module params.", metric=str(metric_family))
+                import_name = "model_params." + model_type + "_model_params.default"
+                if import_name not in self._params_by_module:
+                    self._params_by_module[import_name] = copy.deepcopy(importlib.import_module(import_name).MODEL_PARAMS)
+        return import_name
@@ -0,0 +1,78 @@
+import time
+
+import models_library
+import model_persistence.models_storage
+import config_mgr
+import stats_mgr
+import utils.logger
+
+EVICTION_POLICIES = ["none", "lru", "idle"]
+# The number of metrics that may fail to be evicted (busy or failed to save) before giving up on making room
+MAX_FAILED_EVICTIONS = 8
+
+
+class ModelsEvictor:
+    """
+    Makes room for the models of new metrics when the number of loaded models reaches max_allowed_models (or their
+    memory reaches the budget set by max_model_memory_mb, see ModelsFootprint) by hibernating (saving and unloading)
+    the models of the least recently used metrics. Hibernated models are loaded back from the disk by the models
+    factory the next time their metric arrives.
+    The policy is set by models_eviction_policy:
+        none - Never evict. The models of new metrics will not be created (the original behaviour)
+        lru  - Evict the least recently used metrics
+        idle - Evict the least recently used metrics but only if they were not used for models_max_idle_seconds
+    """
+
+    def __init__(self, model_types):
+        """
+        :param model_types: The types of the models kept for each metric (see ModelFactory.get_model_types)
+        """
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "ModelsEvictor")
+        self._models_library = models_library.ModelsLibrary.get_instance()
+        self._model_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        self._model_types = model_types
+        self._eviction_policy = self._config_mgr.get("models_eviction_policy").strip().lower()
+        if self._eviction_policy not in EVICTION_POLICIES:
+            raise config_mgr.ConfigValueInvalidException("The value " + self._eviction_policy + " for models_eviction_policy is invalid. It should be one of: " + ", ".join(EVICTION_POLICIES))
+
+    def make_room_for_metric(self, metric_name, needed_memory=0, memory_budget=0):
+        """
+        Evicts the models of other metrics (according to the eviction policy) until there's room for the models of the
+        given metric.
+        :param metric_name: The metric name (metric.entire.hierarchy) that needs models
+        :param needed_memory: The (estimated) number of bytes the models of the metric need
+        :param memory_budget: The number of bytes all the loaded models may take (0 for no limit)
+        :return: True if the models of the given metric are loaded or can now be created, False otherwise
+        """
+
+        # A metric that has some of its models loaded still needs room for the missing ones
+        if all([self._models_library.model_exists(models_library.get_model_key(model_type, metric_name)) for model_type in self._model_types]):
+            return True
+
+        if self._eviction_policy == "none":
+            return False
+
+        failed_evictions = 0
+        while self._models_library.get_models_count() >= self._config_mgr.get("max_allowed_models") or (memory_budget > 0 and self._models_library.get_models_memory() + needed_memory > memory_budget):
+            least_recently_used_metric = self._models_library.get_least_recently_used_metric()
+            if least_recently_used_metric is None or least_recently_used_metric[0] == metric_name:
+                return False
+
+            evicted_metric_name, last_access = least_recently_used_metric
+            if self._eviction_policy == "idle" and (time.time() - last_access) < self._config_mgr.get("models_max_idle_seconds"):
+                return False
+
+            # Not waiting for the evicted metric's lock, since the thread holding it may be waiting for this one's
+            if not self._model_storage.unload_metric(evicted_metric_name, wait=False):
+                # The metric is tried again once the others were, so it does not block the eviction of the others
+                self._models_library.requeue_metric(evicted_metric_name)
+                failed_evictions += 1
+                if failed_evictions >= MAX_FAILED_EVICTIONS:
+                    return False
+                continue
+            self._stats_mgr.up("models_evicted")
+            self._logger.debug("make_room_for_metric", "Hibernated the models of this metric to make room for the models of " + str(metric_name), metric=str(evicted_metric_name))
+
+        return True
@@ -1,10 +1,8 @@
 from nupic.frameworks.opf.model_factory import ModelFactory as NupicModelFactory
 from nupic.algorithms.anomaly_likelihood import AnomalyLikelihood
-from threading import Lock
-import importlib
-import os
 
 import model_persistence.models_storage
+import model_persistence.model_params_registry
 import model_persistence.anomaly_calc_factory
 import models_library
 import config_mgr
@@ -12,25 +10,34 @@ import stats_mgr
 import utils.logger
 
 DEBUG = False
+# separate - an anomaly model and a prediction model per metric. single - the anomaly model (TemporalAnomaly) of each
+# metric makes the predictions as well
+MODELS_MODES = ["separate", "single"]
 
 
 class ModelFactory:
     def __init__(self):
         self._config_mgr = config_mgr.ConfigMgr.get_instance()
         self.__loaded_models = models_library.ModelsLibrary.get_instance()
-        self.__create_model_thread_lock = Lock()
         self.__model_storage_manager = model_persistence.models_storage.ModelsStorage.get_instance()
         self.__anomaly_likelihood_calculator_factory = model_persistence.anomaly_calc_factory.AnomalyCalcFactory()
-        self._anomaly_likelihood_calculator_filename = self._config_mgr.get("anomaly_likelihood_calculator_filename")
+        self.__model_params_registry = model_persistence.model_params_registry.ModelParamsRegistry.get_instance()
         self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
         self._logger = utils.logger.Logger(__file__, "ModelFactory")
+        self.models_mode = self._config_mgr.get("models_mode").strip().lower()
+        if self.models_mode not in MODELS_MODES:
+            raise config_mgr.ConfigValueInvalidException("The value " + self.models_mode + " for models_mode is invalid. It should be one of: " + ", ".join(MODELS_MODES))
+        # In single model mode the existing anomaly checkpoints are used as is (their models were created with the same
+        # classifier params and already make multi step predictions) while the prediction checkpoints are left untouched
+        # on the disk (so switching back to separate models resumes them)
+        self.__model_types = ["anomaly"] if self.models_mode == "single" else models_library.MODEL_TYPES
 
     @staticmethod
     def __create_model(model_params, prediction_steps):
         """
         Given a model params dictionary, create a CLA Model. Automatically enables
         inference for value.
-        :param model_params: Model params dict
+        :param model_params: Model params dict (a copy that belongs to the caller, since it is changed here)
         :param prediction_steps: The steps ahead to configure this model to predict
         :return: OPF Model object
         """
@@ -41,14 +48,26 @@ class ModelFactory:
             return model
         return None
 
+    def __load_compressed_checkpoint(self, metric):
+        if self.__model_storage_manager.checkpoint_exists(metric["metric_name"], path_element="compressed"):
+            try:
+                self.__model_storage_manager.load_compressed_checkpoint(metric["metric_name"], model_types=self.__model_types)
+                self._logger.debug("__load_compressed_checkpoint", "LOADED MODELS FROM A COMPRESSED CHECKPOINT", metric=str(metric["metric_name"]))
+            except Exception as ex:
+                self._logger.warn("__load_compressed_checkpoint", "Failed to load the models from the compressed checkpoint", metric=str(metric["metric_name"]), exception_message=str(ex.message), exception_type=str(type(ex).__name__))
+
     def __get_model(self, metric, model_type, models_number_below_configured_limit):
-        model_prefix = "_" + model_type
         result_model = None
-        model_fqdn = model_prefix + "." + metric["metric_name"]
+        model_fqdn = models_library.get_model_key(model_type, metric["metric_name"])
         if not self.__loaded_models.model_exists(model_fqdn):
-            self.__create_model_thread_lock.acquire()
+            # The models of the other metrics can be created meanwhile
+            metric_lock = self.__loaded_models.get_metric_lock(metric["metric_name"])
+            metric_lock.acquire()
             try:
-                if not self.__loaded_models.model_exists(model_fqdn) and os.path.isdir(self.__model_storage_manager.get_save_path(model_fqdn)):
+                if not self.__loaded_models.model_exists(model_fqdn) and models_number_below_configured_limit:
+                    self.__load_compressed_checkpoint(metric)
+
+                if not self.__loaded_models.model_exists(model_fqdn) and self.__model_storage_manager.checkpoint_exists(model_fqdn):
                     if models_number_below_configured_limit:
                         try:
                             self.__loaded_models.add_model_for_metric(model_fqdn, NupicModelFactory.loadFromCheckpoint(self.__model_storage_manager.get_save_path(model_fqdn)))
@@ -57,7 +76,7 @@ class ModelFactory:
                             self.__loaded_models.add_model_for_metric(model_fqdn, self.__create_model(self.get_model_params_from_metric_name(metric["metric_family"], model_type), self._config_mgr.get("prediction_steps")))
                             self._logger.warn("__get_model", "Failed to create a " + model_type + " model from disk", exception_message=str(ex.message), exception_type=str(type(ex).__name__))
 
-                if not self.__loaded_models.model_exists(model_fqdn) and not os.path.isdir(self.__model_storage_manager.get_save_path(model_fqdn)):
+                if not self.__loaded_models.model_exists(model_fqdn) and not self.__model_storage_manager.checkpoint_exists(model_fqdn):
                     if models_number_below_configured_limit:
                         model_params = self.get_model_params_from_metric_name(metric["metric_family"], model_type)
                         prediction_steps = self._config_mgr.get("prediction_steps")
@@ -65,41 +84,28 @@ class ModelFactory:
                         self.__loaded_models.add_model_for_metric(model_fqdn, model_to_add)
                         self._logger.debug("__get_model", model_type.capitalize() + " model created from params", metric=str(metric["metric_name"]))
             finally:
-                self.__create_model_thread_lock.release()
+                metric_lock.release()
         if self.__loaded_models.model_exists(model_fqdn):
             result_model = self.__loaded_models.get_model(model_fqdn)
-            self._logger.debug("__get_model", model_type.capitalize() + " model loaded from cache", metric=str(metric["metric_name"]))
+            self._logger.debug("__get_model", lambda: model_type.capitalize() + " model loaded from cache", metric=metric["metric_name"])
         return result_model
 
     def get_model_params_from_metric_name(self, metric_family, model_type):
         """
-        Given a gym name, assumes a matching model params python module exists within
-        the model_params directory and attempts to import it.
-        :param metric_family: Gym name, used to guess the model params module name.
+        Returns the model params for the given metric family (see ModelParamsRegistry for how they're chosen)
+        :param metric_family: The metric family, used to choose the model params module.
         :param model_type: A prefix to the actual model name. Can be used to indicate whether it's a prediction model or one for anomaly detection
-        :return: OPF Model params dictionary
+        :return: OPF Model params dictionary (a copy that belongs to the caller)
         """
-
-        import_name = model_type + "_model_params.%s" % (
-            metric_family.replace(" ", "_").replace("-", "_")
-        )
-        self._logger.debug("get_model_params_from_metric_name", "Importing model params from " + str(import_name), metric=str(metric_family))
-        try:
-            imported_model_params = importlib.import_module(import_name).MODEL_PARAMS
-        except ImportError:
-            # Using default model params
-            import_name = "model_params." + model_type + "_model_params.default"
-            imported_model_params = importlib.import_module(import_name).MODEL_PARAMS
-            self._logger.debug("get_model_params_from_metric_name", "No model params exist for that metric family. Using default module params.", metric=str(metric_family))
-
-        return imported_model_params
+        return self.__model_params_registry.get_model_params(metric_family, model_type)
 
     def get_anomaly_likelihood_calc(self, metric, models_number_below_configured_limit):
         anomaly_likelihood_calc = None
-        if not self.__loaded_models.anomaly_calc_exists(metric["metric_name"]):
-            anomaly_likelihood_calculators_path = self.__model_storage_manager.get_save_path(metric["metric_name"], path_element="anomaly_likelihood_calculator")
+        if not self.__loaded_models.anomaly_calc_exists(metric["metric_name"]) and models_number_below_configured_limit:
+            self.__load_compressed_checkpoint(metric)
 
-            if os.path.isfile(os.path.join(anomaly_likelihood_calculators_path, self._anomaly_likelihood_calculator_filename)):
+        if not self.__loaded_models.anomaly_calc_exists(metric["metric_name"]):
+            if self.__model_storage_manager.checkpoint_exists(metric["metric_name"], path_element="anomaly_likelihood_calculator"):
                 if models_number_below_configured_limit:
                     try:
                         if models_number_below_configured_limit:
@@ -122,6 +128,15 @@ class ModelFactory:
         model_type = "anomaly"
         return self.__get_model(metric, model_type, models_number_below_configured_limit)
 
+    def get_model_types(self):
+        """
+        :return: The types of the models kept for each metric (only the anomaly model in single model mode)
+        """
+        return self.__model_types
+
+    def is_single_model_mode(self):
+        return self.models_mode == "single"
+
     def get_prediction_model(self, metric, models_number_below_configured_limit):
         model_type = "prediction"
         return self.__get_model(metric, model_type, models_number_below_configured_limit)
@@ -0,0 +1,62 @@
+import model_persistence.models_storage
+import model_persistence.model_params_registry
+import config_mgr
+
+# The bytes kept per potential synapse of the spatial pooler (a permanence and an index)
+SP_BYTES_PER_POTENTIAL_SYNAPSE = 8
+# The bytes kept per cell of the temporal memory, including the segments and synapses a cell typically grows (the
+# maximum - maxSegmentsPerCell * maxSynapsesPerSegment - is rarely reached)
+TM_BYTES_PER_CELL = 384
+# An anomaly likelihood calculator keeps a window of up to 8640 (timestamp, value, score) records
+ANOMALY_LIKELIHOOD_CALC_ESTIMATED_SIZE = 8640 * 150
+
+
+class ModelsFootprint:
+    """
+    Estimates how much memory the models and the anomaly likelihood calculator of a metric take, for enforcing the
+    models memory budget (max_model_memory_mb). The size of the metric's last (uncompressed) checkpoint is used when the
+    checkpoints manifest knows it, and otherwise a rough estimate based on the size of the spatial pooler and the
+    temporal memory in the metric's model params.
+    """
+
+    def __init__(self, model_types):
+        """
+        :param model_types: The types of the models kept for each metric (see ModelFactory.get_model_types)
+        """
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._model_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        self._model_params_registry = model_persistence.model_params_registry.ModelParamsRegistry.get_instance()
+        self._model_types = model_types
+        self._estimates_by_family = {}
+
+    def get_memory_budget(self):
+        """
+        :return: The number of bytes the models of this process may take (max_model_memory_mb split between the worker
+        processes), or 0 if there's no limit
+        """
+        return self._config_mgr.get("max_model_memory_mb") * 1024 * 1024 / max(1, self._config_mgr.get("worker_processes"))
+
+    def estimate_metric_footprint(self, metric):
+        """
+        :param metric: The parsed metric
+        :return: The estimated number of bytes taken by the models and the anomaly likelihood calculator of the metric
+        """
+        checkpoint_size = self._model_storage.get_checkpoint_size(metric["metric_name"], self._model_types)
+        if checkpoint_size is not None:
+            return checkpoint_size
+
+        estimate = self._estimates_by_family.get(metric["metric_family"])
+        if estimate is None:
+            estimate = ANOMALY_LIKELIHOOD_CALC_ESTIMATED_SIZE
+            for model_type in self._model_types:
+                estimate += ModelsFootprint._estimate_model_size(self._model_params_registry.get_model_params(metric["metric_family"], model_type))
+            self._estimates_by_family[metric["metric_family"]] = estimate
+        return estimate
+
+    @staticmethod
+    def _estimate_model_size(model_params):
+        sp_params = model_params["modelParams"]["spParams"]
+        tm_params = model_params["modelParams"]["tmParams"]
+        sp_size = int(sp_params["columnCount"] * sp_params["inputWidth"] * sp_params.get("potentialPct", 0.5) * SP_BYTES_PER_POTENTIAL_SYNAPSE)
+        tm_size = tm_params["columnCount"] * tm_params["cellsPerColumn"] * TM_BYTES_PER_CELL
+        return sp_size + tm_size
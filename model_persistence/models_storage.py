@@ -4,14 +4,17 @@ from threading import Lock
 from datetime import datetime
 
 import models_library
+import model_persistence.checkpoint_writer
+import model_persistence.checkpoints_manifest
+import model_persistence.compressed_checkpoint
 import config_mgr
 import stats_mgr
 import utils.global_state
 import utils.logger
 
-autosave_thread_lock = Lock()
-create_model_thread_lock = Lock()
-create_anomaly_likelihood_calc_thread_lock = Lock()
+
+CHECKPOINT_FORMATS = ["directory", "compressed"]
+COMPRESSED_CHECKPOINT_SUFFIX = ".pensu.z"
 
 
 class ModelsStorage:
@@ -38,21 +41,89 @@ class ModelsStorage:
                 self.models_save_base_path = self._config_mgr.get("models_save_base_path")
                 self.anomaly_likelihood_calculator_filename = self._config_mgr.get("anomaly_likelihood_calculator_filename")
                 self.anomaly_likelihood_detectors_save_base_path = self._config_mgr.get("anomaly_likelihood_detectors_save_base_path")
+                self.checkpoint_format = self._config_mgr.get("checkpoint_format").strip().lower()
+                if self.checkpoint_format not in CHECKPOINT_FORMATS:
+                    raise config_mgr.ConfigValueInvalidException("The value " + self.checkpoint_format + " for checkpoint_format is invalid. It should be one of: " + ", ".join(CHECKPOINT_FORMATS))
                 self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
                 self._logger = utils.logger.Logger(__file__, "ModelsStorage")
+                self._checkpoint_writer = model_persistence.checkpoint_writer.CheckpointWriter(self.save_metric)
+                self._checkpoints_manifest = None
+                if self._config_mgr.get("checkpoints_manifest_filename").strip() != "":
+                    self._checkpoints_manifest = model_persistence.checkpoints_manifest.CheckpointsManifest(os.path.join(self.models_save_base_path, self._config_mgr.get("checkpoints_manifest_filename")))
+                    self._checkpoints_manifest.load(self._scan_checkpoints)
         finally:
             ModelsStorage.__threads_lock.release()
 
     def get_save_path(self, metric, path_element="model"):
         """
-        This method returns the save path of the module or anomaly likelihood detector. (based on the current
-        configuration and the metric in question)
+        This method returns the save path of the module or anomaly likelihood detector. (based on the checkpoints
+        manifest, or if it's not there yet, on the current configuration and the metric in question)
         :param metric: The metric name (metric.entire.hierarchy) of the metric to return the save path for.
         :param path_element: Whether to return the model save path or the anomaly likelihood detector's path
         :return: String with the save path of the requested metric's model/anomaly detector
         """
 
+        if self._checkpoints_manifest is not None:
+            checkpoint_info = self._get_checkpoint_info(path_element, metric)
+            if checkpoint_info is not None:
+                return checkpoint_info["path"]
+        return self._probe_save_path(metric, path_element)
+
+    def checkpoint_exists(self, metric, path_element="model"):
+        """
+        :param metric: The key of the model / the metric name of the anomaly likelihood calculator
+        :param path_element: Whether to check for a model or an anomaly likelihood detector
+        :return: True if there's a saved checkpoint of the requested model/anomaly detector
+        """
+
+        if self._checkpoints_manifest is not None:
+            return self._get_checkpoint_info(path_element, metric) is not None
+        return self._probe_checkpoint_exists(metric, path_element)
+
+    def _probe_checkpoint_exists(self, metric, path_element):
+        if path_element == "compressed":
+            return os.path.isfile(self._probe_save_path(metric, path_element))
         if path_element == "model":
+            return os.path.isdir(self._probe_save_path(metric, path_element))
+        return os.path.isfile(os.path.join(self._probe_save_path(metric, path_element), self.anomaly_likelihood_calculator_filename))
+
+    def _get_checkpoint_info(self, path_element, metric):
+        """
+        :return: The checkpoints manifest entry of the requested checkpoint or None if there's no such checkpoint. A
+        checkpoint that is missing from the manifest is looked up on the disk, since it may have been saved by another
+        instance that shares the save volume (i.e. the previous owner of a rebalanced partition) after the manifest was
+        loaded. Checkpoints that are not found there either are not looked up again until forget_checkpoint_misses.
+        """
+        checkpoint_info = self._checkpoints_manifest.get(path_element, metric)
+        if checkpoint_info is None and not self._checkpoints_manifest.is_known_missing(path_element, metric):
+            save_path = None
+            if self._probe_checkpoint_exists(metric, path_element):
+                save_path = self._probe_save_path(metric, path_element)
+            elif path_element == "anomaly_likelihood_calculator":
+                # The probed path of a directory that holds only the anomaly likelihood calculator ends with .root
+                unrooted_save_path = os.path.join(self.anomaly_likelihood_detectors_save_base_path, metric.replace(".", "/"))
+                if os.path.isfile(os.path.join(unrooted_save_path, self.anomaly_likelihood_calculator_filename)):
+                    save_path = unrooted_save_path
+            if save_path is not None:
+                checkpoint_info = self._checkpoints_manifest.record_found(path_element, metric, save_path, self._get_checkpoint_size_on_disk(path_element, save_path))
+            else:
+                self._checkpoints_manifest.record_missing(path_element, metric)
+        return checkpoint_info
+
+    def forget_checkpoint_misses(self):
+        """
+        Makes checkpoints that were not found on the disk be looked up there again, since another instance sharing
+        the save volume (i.e. the previous owner of a partition assigned to this one) may have saved them since.
+        :return: None
+        """
+        if self._checkpoints_manifest is not None:
+            self._checkpoints_manifest.forget_missing()
+
+    def _probe_save_path(self, metric, path_element):
+        if path_element == "compressed":
+            # The compressed checkpoint of a.b.c is saved as a/b/c.pensu.z so it never collides with a.b.c.d's one
+            return os.path.join(self.models_save_base_path, metric.replace(".", "/") + COMPRESSED_CHECKPOINT_SUFFIX)
+        elif path_element == "model":
             save_path = self.models_save_base_path
             save_path = os.path.join(save_path, metric.replace(".", "/"))
 
@@ -75,64 +146,269 @@ class ModelsStorage:
         else:
             raise Exception("Unrecognized path element code")
 
+    def save_model(self, metric, model):
+        """
+        Saves the given model to its save path
+        :param metric: The key of the model (as kept in the models library)
+        :param model: The model to save
+        :return: True if the model was saved successfully, False otherwise
+        """
+        model_save_path = self.get_save_path(metric=metric, path_element="model")
+        try:
+            model.save(model_save_path)
+            self._record_checkpoint("model", metric, model_save_path)
+            return True
+        except Exception as ex:
+            self._logger.warn("save_model", "Could NOT save model at " + model_save_path + " due to an exception", metric=str(metric), exception_message=str(ex.message), exception_type=type(ex).__name__)
+            return False
+
+    def save_anomaly_likelihood_calc(self, metric, anomaly_likelihood_calculator):
+        """
+        Saves the given anomaly likelihood calculator to its save path
+        :param metric: The metric name (metric.entire.hierarchy) of the anomaly likelihood calculator
+        :param anomaly_likelihood_calculator: The anomaly likelihood calculator to save
+        :return: True if the anomaly likelihood calculator was saved successfully, False otherwise
+        """
+        anomaly_likelihood_calculators_path = self.get_save_path(metric=metric, path_element="anomaly_likelihood_calculator")
+        try:
+            if not os.path.exists(anomaly_likelihood_calculators_path):
+                os.makedirs(anomaly_likelihood_calculators_path)
+            with open(os.path.join(anomaly_likelihood_calculators_path, self.anomaly_likelihood_calculator_filename), "wb") as anomaly_likelihood_calc_file:
+                anomaly_likelihood_calculator.writeToFile(anomaly_likelihood_calc_file)
+            self._record_checkpoint("anomaly_likelihood_calculator", metric, anomaly_likelihood_calculators_path)
+            return True
+        except (OSError, IOError) as ex:
+            self._logger.warn("save_anomaly_likelihood_calc", "Could NOT save anomaly likelihood calc for that metric at " + anomaly_likelihood_calculators_path + " due to an exception", metric=str(metric), exception_message=str(ex.message), exception_type=type(ex).__name__)
+            return False
+
+    def save_compressed_checkpoint(self, metric_name):
+        """
+        Saves the models and the anomaly likelihood calculator (those that are currently loaded) of the given metric
+        to a single compressed file. The file is written to a temporary file first and then renamed, so a crash during
+        the save leaves the previous checkpoint intact.
+        :param metric_name: The metric name (metric.entire.hierarchy) of the metric to save
+        :return: True if the checkpoint was saved successfully, False otherwise
+        """
+
+        components = {}
+        for model_type in models_library.MODEL_TYPES:
+            model = self.__models_library.get_model(models_library.get_model_key(model_type, metric_name))
+            if model is not None:
+                components[model_type] = model
+        anomaly_likelihood_calculator = self.__models_library.get_anomaly_calc(metric_name)
+        if anomaly_likelihood_calculator is not None:
+            components[model_persistence.compressed_checkpoint.ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT] = anomaly_likelihood_calculator
+        if len(components) == 0:
+            return True
+
+        checkpoint_path = self.get_save_path(metric_name, path_element="compressed")
+        temp_checkpoint_path = checkpoint_path + ".tmp" + str(os.getpid())
+        try:
+            checkpoint = model_persistence.compressed_checkpoint.dumps(components)
+            if not os.path.isdir(os.path.dirname(checkpoint_path)):
+                os.makedirs(os.path.dirname(checkpoint_path))
+            with open(temp_checkpoint_path, "wb") as checkpoint_file:
+                checkpoint_file.write(checkpoint)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.rename(temp_checkpoint_path, checkpoint_path)
+            self._record_checkpoint("compressed", metric_name, checkpoint_path)
+            return True
+        except Exception as ex:
+            self._logger.warn("save_compressed_checkpoint", "Could NOT save the compressed checkpoint at " + checkpoint_path + " due to an exception", metric=str(metric_name), exception_message=str(ex.message), exception_type=type(ex).__name__)
+            if os.path.isfile(temp_checkpoint_path):
+                os.remove(temp_checkpoint_path)
+            return False
+
+    def load_compressed_checkpoint(self, metric_name, model_types=models_library.MODEL_TYPES):
+        """
+        Loads the models and the anomaly likelihood calculator of the given metric from its compressed checkpoint into
+        the models library (only those that are not loaded already)
+        :param metric_name: The metric name (metric.entire.hierarchy) of the metric to load
+        :param model_types: The types of the models to load (models of other types in the checkpoint are ignored)
+        :return: None
+        """
+
+        with open(self.get_save_path(metric_name, path_element="compressed"), "rb") as checkpoint_file:
+            components = model_persistence.compressed_checkpoint.loads(checkpoint_file.read())
+        for component_name, component in components.items():
+            if component_name == model_persistence.compressed_checkpoint.ANOMALY_LIKELIHOOD_CALCULATOR_COMPONENT:
+                if not self.__models_library.anomaly_calc_exists(metric_name):
+                    self.__models_library.add_anomaly_calc_for_metric(metric_name, component)
+            elif component_name in model_types:
+                model_key = models_library.get_model_key(component_name, metric_name)
+                if not self.__models_library.model_exists(model_key):
+                    self.__models_library.add_model_for_metric(model_key, component)
+
+    def get_checkpoint_size(self, metric_name, model_types=models_library.MODEL_TYPES):
+        """
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :param model_types: The types of the models to include
+        :return: The total size (in bytes) of the uncompressed checkpoints of the metric's models and anomaly likelihood
+        calculator, as recorded in the checkpoints manifest, or None if they're not all recorded there (or if there's no
+        manifest). Compressed checkpoints are not counted since their size says little about the models' size.
+        """
+
+        if self._checkpoints_manifest is None:
+            return None
+        checkpoint_size = 0
+        for path_element, name in [("model", models_library.get_model_key(model_type, metric_name)) for model_type in model_types] + [("anomaly_likelihood_calculator", metric_name)]:
+            checkpoint_info = self._get_checkpoint_info(path_element, name)
+            if checkpoint_info is None:
+                return None
+            checkpoint_size += checkpoint_info["size"]
+        return checkpoint_size
+
+    def _record_checkpoint(self, path_element, metric, save_path):
+        if self._checkpoints_manifest is not None:
+            self._checkpoints_manifest.record_save(path_element, metric, save_path, self._get_checkpoint_size_on_disk(path_element, save_path))
+
+    def _get_checkpoint_size_on_disk(self, path_element, save_path):
+        if path_element == "model":
+            return self._get_checkpoint_dir_size(save_path)
+        if path_element == "compressed":
+            return os.path.getsize(save_path)
+        return os.path.getsize(os.path.join(save_path, self.anomaly_likelihood_calculator_filename))
+
+    @staticmethod
+    def _get_checkpoint_dir_size(save_path):
+        checkpoint_size = 0
+        for dir_path, dir_names, file_names in os.walk(save_path):
+            # Skip the checkpoints of other metrics that are saved under this one (i.e. a.b.c under a.b)
+            dir_names[:] = [dir_name for dir_name in dir_names if dir_name != ".root" and not os.path.isfile(os.path.join(dir_path, dir_name, "model.pkl"))]
+            for file_name in file_names:
+                checkpoint_size += os.path.getsize(os.path.join(dir_path, file_name))
+        return checkpoint_size
+
+    def _scan_checkpoints(self):
+        """
+        Finds all the checkpoints that were saved (by older versions) without being recorded in a checkpoints manifest
+        :return: List of (path_element, name, path, size) tuples
+        """
+
+        checkpoints = []
+        for dir_path, dir_names, file_names in os.walk(self.models_save_base_path):
+            for file_name in file_names:
+                if file_name.endswith(COMPRESSED_CHECKPOINT_SUFFIX):
+                    name = os.path.join(os.path.relpath(dir_path, self.models_save_base_path), file_name[:-len(COMPRESSED_CHECKPOINT_SUFFIX)])
+                    checkpoints.append(("compressed", os.path.normpath(name).replace(os.sep, "."), os.path.join(dir_path, file_name), os.path.getsize(os.path.join(dir_path, file_name))))
+            if "model.pkl" in file_names:
+                name = os.path.relpath(dir_path, self.models_save_base_path)
+                if os.path.basename(name) == ".root":
+                    name = os.path.dirname(name)
+                checkpoints.append(("model", name.replace(os.sep, "."), dir_path, self._get_checkpoint_dir_size(dir_path)))
+
+        # A (path_element, name) that appears twice (with and without .root) will be set to the later one (with .root)
+        for dir_path, dir_names, file_names in os.walk(self.anomaly_likelihood_detectors_save_base_path):
+            if self.anomaly_likelihood_calculator_filename in file_names:
+                name = os.path.relpath(dir_path, self.anomaly_likelihood_detectors_save_base_path)
+                if os.path.basename(name) == ".root":
+                    name = os.path.dirname(name)
+                checkpoints.append(("anomaly_likelihood_calculator", name.replace(os.sep, "."), dir_path, os.path.getsize(os.path.join(dir_path, self.anomaly_likelihood_calculator_filename))))
+        return checkpoints
+
+    def unload_metric(self, metric_name, wait=True):
+        """
+        Saves the models and the anomaly likelihood calculator of the given metric and removes them from the models
+        library. They will be loaded back from the disk the next time they are needed. If they could not be saved they
+        are kept loaded (so their trained state is not lost).
+        :param metric_name: The metric name (metric.entire.hierarchy) of the metric to unload
+        :param wait: Whether to wait for the metric's lock if it's held (i.e. while the metric is being analyzed)
+        :return: True if the metric was unloaded, False if it was not since its lock was held (and wait is False) or
+        since it could not be saved
+        """
+        metric_lock = self.__models_library.get_metric_lock(metric_name)
+        if not metric_lock.acquire(wait):
+            return False
+        try:
+            if not self.save_metric(metric_name):
+                self._stats_mgr.up("models_unload_failed")
+                self._logger.warn("unload_metric", "Could NOT unload the models of this metric since they could not be saved. They are kept loaded.", metric=str(metric_name))
+                return False
+            for model_type in models_library.MODEL_TYPES:
+                self.__models_library.remove_model(models_library.get_model_key(model_type, metric_name))
+            self.__models_library.remove_anomaly_calc(metric_name)
+            self.__models_library.forget_metric(metric_name)
+            return True
+        finally:
+            metric_lock.release()
+
+    def save_metric(self, metric_name):
+        """
+        Saves the models and the anomaly likelihood calculator (those that are currently loaded) of the given metric.
+        Holds the metric's lock, so the models are not run while they're saved (the other metrics are not held up).
+        :param metric_name: The metric name (metric.entire.hierarchy) of the metric to save
+        :return: True if everything was saved successfully, False otherwise
+        """
+        metric_lock = self.__models_library.get_metric_lock(metric_name)
+        metric_lock.acquire()
+        try:
+            if self.checkpoint_format == "compressed":
+                return self.save_compressed_checkpoint(metric_name)
+
+            res = True
+            saved_model_types = []
+            for model_type in models_library.MODEL_TYPES:
+                model_key = models_library.get_model_key(model_type, metric_name)
+                model = self.__models_library.get_model(model_key)
+                if model is not None:
+                    res = self.save_model(model_key, model) and res
+                    saved_model_types.append(model_type)
+
+            anomaly_likelihood_calculator = self.__models_library.get_anomaly_calc(metric_name)
+            if anomaly_likelihood_calculator is not None:
+                res = self.save_anomaly_likelihood_calc(metric_name, anomaly_likelihood_calculator) and res
+
+            # The estimated memory taken by the metric's models is replaced by the size of their fresh checkpoint
+            if res and self.__models_library.get_metric_footprint(metric_name) is not None:
+                checkpoint_size = self.get_checkpoint_size(metric_name, saved_model_types)
+                if checkpoint_size is not None:
+                    self.__models_library.set_metric_footprint(metric_name, checkpoint_size)
+            return res
+        finally:
+            metric_lock.release()
+
+    def save_changed_metrics(self, reason, spread_over_seconds=0):
+        """
+        Saves the models of all the metrics that were changed since they were last saved (using the checkpoint writer)
+        :param reason: Why the models are saved (only used for logging)
+        :param spread_over_seconds: Passed to the checkpoint writer. See CheckpointWriter.write_checkpoint
+        :return: None
+        """
+        # The dirty metrics are popped (and the unsaved ones are marked again) inside the checkpoint, so a checkpoint
+        # that waits for a running one (i.e. on shutdown) also saves the metrics that the running one skipped
+        self._checkpoint_writer.write_checkpoint(self.__models_library.pop_dirty_metrics, self.__models_library.mark_metrics_dirty, reason, spread_over_seconds)
+
+    def _wait_until(self, wait_until_time):
+        """
+        Sleeps (in up to 1 second intervals) until the given time
+        :param wait_until_time: The time (as returned by time.time()) to wait until
+        :return: False if the service is shutting down, True otherwise
+        """
+        while True:
+            if self._global_state.get_global_status("sigint_received") or self.EXIT_ALL_THREADS_FLAG:
+                return False
+            time_left = wait_until_time - time.time()
+            if time_left <= 0:
+                return True
+            time.sleep(min(1, time_left))
+
     def auto_save_models(self, interval):
         """
-        This method runs on a dedicated thread for automatically saving the currently used loaded_models and anomaly likelihood
-        detectors to files.
+        This method runs on a dedicated thread for automatically saving the models and anomaly likelihood detectors
+        that were changed (i.e. used) since they were last saved. The saves are spread evenly over the interval (and
+        run on the checkpoint writer's bounded pool of threads) and only the saved metrics are touched, so the analysis
+        of the other metrics is not held up.
         :param interval: The number of seconds between each save attempt.
         :return: None
         """
 
-        for i in range(0, interval):
-            if self._global_state.get_global_status("sigint_received"):
-                return
-
-            time.sleep(1)
+        if not self._wait_until(time.time() + interval):
+            return
 
         while True:
-            if self._global_state.get_global_status("sigint_received"):
-                return
+            cycle_started = time.time()
+            self.save_changed_metrics("autosave", spread_over_seconds=interval)
 
-            autosave_thread_lock.acquire()
-            create_model_thread_lock.acquire()
-            models_count = self.__models_library.get_models_count()
-            for model_idx in range(0, models_count):
-                model_obj = self.__models_library.get_model_by_idx(model_idx)
-                metric = model_obj[0]
-                model = model_obj[1]
-                model_save_path = self.get_save_path(metric=metric, path_element="model")
-                try:
-                    model.save(model_save_path)
-                except Exception as ex:
-                    self._logger.warn("auto_save_models", "Could NOT auto save module no." + str(model_idx) + " at " + model_save_path + " due to an exception", metric=str(metric), exception_message=str(ex.message), exception_type=type(ex).__name__)
-
-                if self.EXIT_ALL_THREADS_FLAG:
-                    create_model_thread_lock.release()
-                    return
-            create_model_thread_lock.release()
-
-            create_anomaly_likelihood_calc_thread_lock.acquire()
-            anomaly_detectors_count = self.__models_library.get_anomaly_calc_count()
-            for anomaly_likelihood_calculator_idx in range(0, anomaly_detectors_count):
-                metric, anomaly_likelihood_calculator = self.__models_library.get_anomaly_calc_by_idx(anomaly_likelihood_calculator_idx)
-                anomaly_likelihood_calculators_path = self.get_save_path(metric=metric, path_element="anomaly_likelihood_calculator")
-
-                try:
-                    if not os.path.exists(anomaly_likelihood_calculators_path):
-                        os.makedirs(anomaly_likelihood_calculators_path)
-                    with open(os.path.join(anomaly_likelihood_calculators_path, self.anomaly_likelihood_calculator_filename), "w") as anomaly_likelihood_calc_file:
-                        anomaly_likelihood_calculator.writeToFile(anomaly_likelihood_calc_file)
-                except OSError as ex:
-                    self._logger.warn("auto_save_models", "Could NOT auto save anomaly likelihood calc for that metric at " + anomaly_likelihood_calculators_path + " due to an exception", metric=str(metric), exception_message=str(ex.message), exception_type=type(ex).__name__)
-
-                if self.EXIT_ALL_THREADS_FLAG:
-                    create_anomaly_likelihood_calc_thread_lock.release()
-                    return
-            create_anomaly_likelihood_calc_thread_lock.release()
-            autosave_thread_lock.release()
-
-            for i in range(0, interval):
-                if self.EXIT_ALL_THREADS_FLAG:
-                    return
-
-                time.sleep(1)
+            if not self._wait_until(cycle_started + interval):
+                return
@@ -1,8 +1,80 @@
-from threading import Lock
+import time
+import zlib
+from collections import OrderedDict
+from threading import Lock, RLock
+import config_mgr
 import stats_mgr
 
+MODEL_TYPES = ["anomaly", "prediction"]
+
+
+def get_model_key(model_type, metric_name):
+    """
+    Returns the key under which a model of the given type is kept (in the library and in the models storage)
+    :param model_type: One of MODEL_TYPES
+    :param metric_name: The metric name (metric.entire.hierarchy)
+    :return: String with the model's key
+    """
+    return "_" + model_type + "." + metric_name
+
+
+class MetricState(object):
+    """
+    The per-metric state that is looked up once per received value and passed along the analysis of that value (it
+    inherits from object since __slots__ is ignored by old-style classes)
+    """
+
+    __slots__ = ["metric_name", "anomaly_model", "prediction_model", "anomaly_likelihood_calc", "last_timestamp", "cadence", "output_metrics_names", "values_count", "aggregation_window"]
+
+    def __init__(self, metric_name):
+        self.metric_name = metric_name
+        # Handles of the metric's models (as kept in the models library). None until the models are looked up.
+        self.anomaly_model = None
+        self.prediction_model = None
+        self.anomaly_likelihood_calc = None
+        # The timestamp of the metric's previous value and the number of seconds between its last two values
+        self.last_timestamp = None
+        self.cadence = None
+        # The names of the metrics sent to Kafka for this metric, by kind (i.e. "prediction" or "anomaly_score")
+        self.output_metrics_names = None
+        self.values_count = 0
+        # The values received in the metric's current aggregation window (see MetricsAggregator). Dropped along with
+        # the state when the metric is forgotten.
+        self.aggregation_window = None
+
+    def observe_timestamp(self, timestamp):
+        """
+        Updates the cadence and the last timestamp of the metric with the timestamp of its new value
+        :param timestamp: The timestamp of the metric's new value
+        :return: None
+        """
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            self.cadence = timestamp - self.last_timestamp
+        self.last_timestamp = timestamp
+        self.values_count += 1
+
+
+class StripedLocks:
+    """
+    A fixed number of re-entrant locks, each guarding the keys that hash (by a stable hash) to it. Gives a lock per
+    key (i.e. per metric) without keeping a lock per key around.
+    """
+
+    def __init__(self, stripes_count):
+        self._locks = [RLock() for _ in range(0, max(1, stripes_count))]
+
+    def get_lock(self, key):
+        return self._locks[(zlib.crc32(key) & 0xffffffff) % len(self._locks)]
+
 
 class ModelsLibrary:
+    """
+    Keeps the loaded models, anomaly likelihood calculators and per-metric states. Lookups don't take any lock (a
+    single dict lookup is atomic under the GIL) and the updates take a short library wide lock. Everything that runs
+    the models of a metric, creates them or saves them holds the metric's lock (see get_metric_lock), so different
+    metrics can be analyzed and saved at the same time.
+    """
+
     __instance = None
     __threads_lock = Lock()
 
@@ -21,112 +93,225 @@ class ModelsLibrary:
                 ModelsLibrary.__instance = self
                 self._models = {}
                 self._anomaly_likelihood_detectors = {}
+                self._metrics_last_access = OrderedDict()
+                self._metrics_states = {}
+                self._dirty_metrics = set()
+                self._metrics_footprints = {}
+                self._models_memory = 0
+                self._library_lock = Lock()
+                self._metrics_locks = StripedLocks(config_mgr.ConfigMgr.get_instance().get("metric_locks_stripes"))
                 self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
         finally:
             ModelsLibrary.__threads_lock.release()
 
     def get_model(self, model_name):
-        ModelsLibrary.__threads_lock.acquire()
-        res = None
-        try:
-            if model_name in self._models:
-                res = self._models[model_name]
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        return self._models.get(model_name)
 
     def get_model_by_idx(self, model_idx):
-        ModelsLibrary.__threads_lock.acquire()
-        res = None
-        try:
-            if model_idx < len(self._models):
-                res = self._models.items()[model_idx]
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        models = self._models.items()
+        if model_idx < len(models):
+            return models[model_idx]
+        return None
 
     def model_exists(self, model_name):
-        ModelsLibrary.__threads_lock.acquire()
-        try:
-            res = model_name in self._models
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        return model_name in self._models
 
     def get_models_count(self):
-        ModelsLibrary.__threads_lock.acquire()
-        try:
-            count = len(self._models)
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return count
+        return len(self._models)
 
     def get_anomaly_calc(self, model_name):
-        ModelsLibrary.__threads_lock.acquire()
-        res = None
-        try:
-            if model_name in self._anomaly_likelihood_detectors:
-                res = self._anomaly_likelihood_detectors[model_name]
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        return self._anomaly_likelihood_detectors.get(model_name)
 
     def get_anomaly_calc_by_idx(self, idx):
-        ModelsLibrary.__threads_lock.acquire()
-        res = None
-        try:
-            if idx < len(self._anomaly_likelihood_detectors):
-                res = self._anomaly_likelihood_detectors.items()[idx]
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        anomaly_likelihood_detectors = self._anomaly_likelihood_detectors.items()
+        if idx < len(anomaly_likelihood_detectors):
+            return anomaly_likelihood_detectors[idx]
+        return None
 
     def anomaly_calc_exists(self, model_name):
-        ModelsLibrary.__threads_lock.acquire()
-        try:
-            res = model_name in self._anomaly_likelihood_detectors
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return res
+        return model_name in self._anomaly_likelihood_detectors
 
     def get_anomaly_calc_count(self):
-        ModelsLibrary.__threads_lock.acquire()
-        try:
-            count = len(self._anomaly_likelihood_detectors)
-        finally:
-            ModelsLibrary.__threads_lock.release()
-        return count
+        return len(self._anomaly_likelihood_detectors)
 
     def add_anomaly_calc_for_metric(self, key, anomaly_calc):
-        ModelsLibrary.__threads_lock.acquire()
+        self._library_lock.acquire()
         try:
             self._anomaly_likelihood_detectors[key] = anomaly_calc
             self._stats_mgr.set("anomaly_calculators_loaded", len(self._anomaly_likelihood_detectors))
         finally:
-            ModelsLibrary.__threads_lock.release()
+            self._library_lock.release()
 
     def add_model_for_metric(self, key, model):
-        ModelsLibrary.__threads_lock.acquire()
+        self._library_lock.acquire()
         try:
             self._models[key] = model
             self._stats_mgr.set("models_loaded", len(self._models))
         finally:
-            ModelsLibrary.__threads_lock.release()
+            self._library_lock.release()
 
     def add_models_for_metric(self, key, model, anomaly_calc):
-        ModelsLibrary.__threads_lock.acquire()
+        self._library_lock.acquire()
         try:
             self._anomaly_likelihood_detectors[key] = anomaly_calc
             self._models[key] = model
             self._stats_mgr.set("anomaly_calculators_loaded", len(self._anomaly_likelihood_detectors))
             self._stats_mgr.set("models_loaded", len(self._models))
         finally:
-            ModelsLibrary.__threads_lock.release()
+            self._library_lock.release()
+
+    def remove_model(self, key):
+        self._library_lock.acquire()
+        try:
+            model = self._models.pop(key, None)
+            self._stats_mgr.set("models_loaded", len(self._models))
+        finally:
+            self._library_lock.release()
+        return model
+
+    def remove_anomaly_calc(self, key):
+        self._library_lock.acquire()
+        try:
+            anomaly_calc = self._anomaly_likelihood_detectors.pop(key, None)
+            self._stats_mgr.set("anomaly_calculators_loaded", len(self._anomaly_likelihood_detectors))
+        finally:
+            self._library_lock.release()
+        return anomaly_calc
+
+    def get_metric_lock(self, metric_name):
+        """
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: The (re-entrant) lock to hold while running, creating, saving or unloading the metric's models
+        """
+        return self._metrics_locks.get_lock(metric_name)
+
+    def touch_metric(self, metric_name):
+        """
+        Marks the given metric as the most recently used one
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: The MetricState of the metric (created if the metric was not used yet or was forgotten)
+        """
+        self._library_lock.acquire()
+        try:
+            self._metrics_last_access.pop(metric_name, None)
+            self._metrics_last_access[metric_name] = time.time()
+            metric_state = self._metrics_states.get(metric_name)
+            if metric_state is None:
+                metric_state = MetricState(metric_name)
+                self._metrics_states[metric_name] = metric_state
+            return metric_state
+        finally:
+            self._library_lock.release()
+
+    def requeue_metric(self, metric_name):
+        """
+        Moves the given metric (if it's kept) to the most recently used end, without creating a state for it
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: None
+        """
+        self._library_lock.acquire()
+        try:
+            if self._metrics_last_access.pop(metric_name, None) is not None:
+                self._metrics_last_access[metric_name] = time.time()
+        finally:
+            self._library_lock.release()
+
+    def forget_metric(self, metric_name):
+        """
+        Drops everything that is kept about the given metric (its models should be removed from the library first)
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: None
+        """
+        self._library_lock.acquire()
+        try:
+            self._metrics_last_access.pop(metric_name, None)
+            self._metrics_states.pop(metric_name, None)
+            self._dirty_metrics.discard(metric_name)
+            self._models_memory -= self._metrics_footprints.pop(metric_name, 0)
+            self._stats_mgr.set("models_memory_bytes", self._models_memory)
+        finally:
+            self._library_lock.release()
+
+    def get_metric_footprint(self, metric_name):
+        """
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: The (estimated) number of bytes taken by the metric's models, or None if it was not set
+        """
+        return self._metrics_footprints.get(metric_name)
+
+    def set_metric_footprint(self, metric_name, footprint):
+        """
+        Sets the (estimated) number of bytes taken by the metric's models (see ModelsFootprint). It's counted in the
+        models memory until the metric is forgotten.
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :param footprint: The number of bytes
+        :return: None
+        """
+        self._library_lock.acquire()
+        try:
+            self._models_memory += footprint - self._metrics_footprints.get(metric_name, 0)
+            self._metrics_footprints[metric_name] = footprint
+            self._stats_mgr.set("models_memory_bytes", self._models_memory)
+        finally:
+            self._library_lock.release()
+
+    def get_models_memory(self):
+        """
+        :return: The total (estimated) number of bytes taken by the loaded models
+        """
+        return self._models_memory
+
+    def get_least_recently_used_metric(self):
+        """
+        Returns the least recently used metric and the last time it was used
+        :return: Tuple of (metric name, last access time) or None if no metric was used yet
+        """
+        self._library_lock.acquire()
+        res = None
+        try:
+            for metric_name, last_access in self._metrics_last_access.iteritems():
+                res = (metric_name, last_access)
+                break
+        finally:
+            self._library_lock.release()
+        return res
+
+    def mark_metric_dirty(self, metric_name):
+        """
+        Marks the models of the given metric as changed since they were last saved
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: None
+        """
+        self._library_lock.acquire()
+        try:
+            self._dirty_metrics.add(metric_name)
+        finally:
+            self._library_lock.release()
+
+    def mark_metrics_dirty(self, metrics_names):
+        self._library_lock.acquire()
+        try:
+            self._dirty_metrics.update(metrics_names)
+        finally:
+            self._library_lock.release()
+
+    def pop_dirty_metrics(self):
+        """
+        Returns the metrics whose models were changed since they were last saved and marks them all as clean
+        :return: List of metric names
+        """
+        self._library_lock.acquire()
+        try:
+            dirty_metrics = list(self._dirty_metrics)
+            self._dirty_metrics.clear()
+        finally:
+            self._library_lock.release()
+        return dirty_metrics
 
     def get_metrics_loaded(self):
-        ModelsLibrary.__threads_lock.acquire()
+        self._library_lock.acquire()
         try:
             metrics_loaded = self._models.keys()
         finally:
-            ModelsLibrary.__threads_lock.release()
+            self._library_lock.release()
         return metrics_loaded
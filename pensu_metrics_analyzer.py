@@ -20,10 +20,7 @@ import signal
 import os
 import time
 import threading
-from threading import Lock
-from bottle import Bottle
-import kafka
-import re
+from bottle import Bottle, response
 import config_mgr
 import stats_mgr
 import model_persistence.models_storage
@@ -36,23 +33,33 @@ import utils.mertrics_parser
 import utils.anomalies_handler
 import utils.requested_service_status
 import utils.monitored_topic_reporter
+import utils.metrics_workers_pool
+import utils.partitions_rebalance_listener
+import utils.latency_histograms
+import utils.carbon_listener
+import utils.metrics_pipeline
 import utils.logger
+import transports.transport_factory
+import transports.pipeline_output_transport
 
 # Create a separate class as a logger that all classes will use (singleton) that will log to the screen using print
 
 DEBUG = False
-create_model_thread_lock = Lock()
-create_anomaly_likelihood_calc_thread_lock = Lock()
-autosave_thread_lock = Lock()
 
 
 class MetricsRealtimeAnalyzer:
 
-    def __init__(self):
+    def __init__(self, transport=None):
+        """
+        :param transport: The MetricsTransport to consume the metrics from and publish the results to (created by the
+        transport config key if not given). Passing a MemoryTransport drives the analyzer in-process (i.e. by the
+        benchmarks) without a Kafka server.
+        """
         self._ping_listening_host = None
         self._ping_listening_port = None
         self._analyzer_thread = None
         self._http_server_thread = None
+        self._carbon_listener = None
         self._monitored_topic_reporting_thread = None
 
         self._config_mgr = config_mgr.ConfigMgr.get_instance()
@@ -64,6 +71,7 @@ class MetricsRealtimeAnalyzer:
         self._models_library = models_library.ModelsLibrary.get_instance()
         self._models_factory = model_persistence.models_factory.ModelFactory()
         self._anomaly_calc_factory = model_persistence.anomaly_calc_factory.AnomalyCalcFactory()
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
 
         self._requested_service_status_handler = utils.requested_service_status.RequestedStatus.get_instance()
         self._last_logged_message_about_too_many_models = 0
@@ -71,42 +79,81 @@ class MetricsRealtimeAnalyzer:
         self._logger.info("__init__", "Launching Pensu - Starting the bottle server...")
         self._app = Bottle()
         self._route()
-        self._kafka_producer = None
-        self._kafka_consumer = None
-        self._logger.info("__init__", "Launching Pensu - Generating the kafka producer...")
-        self.generate_kafka_producer()
+        self._transport = transport
+        self._partitions_rebalance_listener = None
+        self._workers_pool = None
+        if self._config_mgr.get("worker_processes") > 0:
+            # The workers must be forked before any other thread is started (i.e. by the kafka producer)
+            self._logger.info("__init__", "Launching Pensu - Starting " + str(self._config_mgr.get("worker_processes")) + " metrics worker processes...")
+            self._workers_pool = utils.metrics_workers_pool.MetricsWorkersPool(self._config_mgr.get("worker_processes"))
+            self._workers_pool.start()
+        if self._transport is None:
+            self._transport = transports.transport_factory.create_transport()
+        if self._config_mgr.get("carbon_listener_enabled") == 1 and self._transport.get_memory_transport() is None:
+            raise config_mgr.ConfigValueInvalidException("The Carbon listener puts the metrics it receives into the in-memory transport, so it can only be enabled (carbon_listener_enabled) when the transport is memory")
+        self._pipeline_enabled = self._config_mgr.get("pipeline_enabled") == 1
+        if self._pipeline_enabled and self._workers_pool is not None:
+            self._logger.info("__init__", "Ignoring pipeline_enabled since the metrics are analyzed by worker processes")
+            self._pipeline_enabled = False
+        if self._pipeline_enabled:
+            # The output stage of the pipeline - the anomaly detector and the handlers publish through it
+            self._transport = transports.pipeline_output_transport.PipelineOutputTransport(self._transport, self._config_mgr.get("pipeline_queue_size"))
+        self._logger.info("__init__", "Launching Pensu - Connecting the transport's producer...")
+        self._transport.connect_producer()
         self._logger.info("__init__", "Launching Pensu - Building the anomalies handler...")
-        self._anomalies_handler = utils.anomalies_handler.AnomaliesHandler.get_instance(self._kafka_producer)
+        self._anomalies_handler = utils.anomalies_handler.AnomaliesHandler.get_instance(self._transport)
         self._logger.info("__init__", "Launching Pensu - Building the anomaly detector...")
-        self._anomaly_detector = ai_handlers.anomaly_detector.AnomalyDetector.get_instance(self._kafka_producer)
+        self._anomaly_detector = ai_handlers.anomaly_detector.AnomalyDetector.get_instance(self._transport)
         self._logger.info("__init__", "Launching Pensu - Building the heartbeats sender...")
-        self._monitored_topic_reporter = utils.monitored_topic_reporter.MonitoredTopicReporter.get_instance(self._kafka_producer)
+        self._monitored_topic_reporter = utils.monitored_topic_reporter.MonitoredTopicReporter.get_instance(self._transport)
         self._logger.info("__init__", "Launching Pensu - Done.")
 
-    def generate_kafka_producer(self):
-        while self._kafka_producer is None:
-            if self._global_state.get_global_status("sigint_received"):
-                return
-
-            try:
-                self._kafka_producer = kafka.producer.KafkaProducer(
-                    bootstrap_servers=self._config_mgr.get("kafka_producer_server"),
-                    client_id=self._config_mgr.get("kafka_producer_client_id")
-                )
-            except Exception as ex:
-                self._logger.warn("generate_kafka_producer", "Waiting (indefinitely in 10 sec intervals) for the Producer Kafka service to become available... (kafka_producer_server=" + self._config_mgr.get("kafka_producer_server") + ", kafka_producer_client_id=" + self._config_mgr.get("kafka_producer_client_id") + ")", exception_type=type(ex).__name__, exception_message=str(ex.message))
-                time.sleep(10)
-
     def _route(self):
         self._app.route('/ping', method="GET", callback=self._ping)
+        self._app.route('/metrics', method="GET", callback=self._metrics)
 
     def _ping(self):
-        return {
+        res = {
             "response": "PONG",
             "instance_id": str(self._config_mgr.get("instance_id")),
             "service_specific_info": self._stats_mgr.get_stats(),
             "config": self._config_mgr.get_gist()
         }
+        if self._workers_pool is not None:
+            res["workers_pool"] = self._workers_pool.get_stats()
+        if self._partitions_rebalance_listener is not None:
+            res["assigned_partitions"] = self._partitions_rebalance_listener.get_assigned_partitions_count()
+        return res
+
+    def _metrics(self):
+        """
+        Exports the stats (counters and gauges) and the per stage latency histograms (of this process and of the worker
+        processes) in the Prometheus text exposition format
+        """
+        counters = {}
+        gauges = {}
+        for stats_metric, value in self._stats_mgr.get_stats().items():
+            if stats_metric in stats_mgr.COUNTERS:
+                counters[stats_metric] = value
+            elif isinstance(value, (int, long, float)):
+                gauges[stats_metric] = value
+        labeled_gauges = {}
+        histograms_snapshots = [self._latency_histograms.get_snapshot()]
+        if self._workers_pool is not None:
+            workers_pool_stats = self._workers_pool.get_stats()
+            for stats_metric, value in workers_pool_stats["totals"].items():
+                if stats_metric in stats_mgr.COUNTERS:
+                    counters["workers_" + stats_metric] = value
+                else:
+                    gauges["workers_" + stats_metric] = value
+            # Gauges that don't add up (i.e. the last metric's timestamp) are exported per worker
+            for worker_idx, worker_stats in sorted(workers_pool_stats["workers"].items()):
+                for stats_metric, value in worker_stats.items():
+                    if stats_metric not in workers_pool_stats["totals"] and isinstance(value, (int, long, float)):
+                        labeled_gauges.setdefault("workers_" + stats_metric, []).append(({"worker": worker_idx}, value))
+            histograms_snapshots.extend(self._workers_pool.get_latency_histograms())
+        response.content_type = "text/plain; version=0.0.4"
+        return utils.latency_histograms.to_prometheus_text(utils.latency_histograms.merge_snapshots(histograms_snapshots), counters, gauges, labeled_gauges)
 
     def _run_http_server(self):
         self._app.run(host=self._ping_listening_host, port=self._ping_listening_port)
@@ -118,37 +165,48 @@ class MetricsRealtimeAnalyzer:
             self._analyzer_thread = threading.Thread(target=self.run_analyzer)
             self._logger.info("run", "Launching the analyzer thread (save_interval=" + str(self._config_mgr.get("autosave_models_interval")) + ";models_save_base_path=" + str(models_save_base_path) + ";models_params_base_path=" + str(models_params_base_path) + ";anomaly_likelihood_detectors_save_base_path=" + str(anomaly_likelihood_detectors_save_base_path) + ")")
             self._analyzer_thread.start()
+            if self._config_mgr.get("carbon_listener_enabled") == 1:
+                self._carbon_listener = utils.carbon_listener.CarbonListener(self._transport.get_memory_transport())
+                self._carbon_listener.start()
             self._http_server_thread = threading.Thread(target=self._run_http_server)
             self._http_server_thread.daemon = True
             self._http_server_thread.start()
             while True:
                 if self._global_state.get_global_status("sigint_received"):
+                    self._shutdown()
                     return
                 time.sleep(5)
         except Exception as ex:
             self._logger.error("run", "Failed to launch the analyzer thread.", exception_type=type(ex).__name__, exception_message=str(ex.message))
             raise ex
 
+    def _shutdown(self):
+        if self._carbon_listener is not None:
+            self._carbon_listener.stop()
+        # Let the analyzer thread finish handling the metric it's working on (it stops when the kafka consumer times out)
+        self._analyzer_thread.join(self._config_mgr.get("kafka_consumer_session_timeout") / 1000 + 5)
+        if self._workers_pool is not None:
+            self._logger.info("_shutdown", "Stopping the metrics worker processes...")
+            self._workers_pool.stop()
+        elif self._config_mgr.get("checkpoint_on_shutdown") == 1:
+            self._logger.info("_shutdown", "Saving the models before shutting down...")
+            self._model_storage.save_changed_metrics("shutdown")
+        self._transport.flush()
+
     def run_analyzer(self):
         save_interval = self._config_mgr.get("autosave_models_interval")
-        while self._kafka_consumer is None:
-            if self._global_state.get_global_status("sigint_received"):
-                return
-            try:
-                self._kafka_consumer = kafka.KafkaConsumer(self._config_mgr.get("raw_metrics_kafka_topic"),
-                                                           bootstrap_servers=self._config_mgr.get("kafka_consumer_server"),
-                                                           client_id=self._config_mgr.get("kafka_consumer_client_id"),
-                                                           consumer_timeout_ms=self._config_mgr.get("kafka_consumer_session_timeout"))
-                self._logger.info("run_analyzer", "Loaded a Kafka consumer successfully. (self._metrics_kafka_topic=" + str(self._config_mgr.get("raw_metrics_kafka_topic")) + ";bootstrap_servers=" + str(self._config_mgr.get("kafka_consumer_server")) + ";client_id=" + str(self._config_mgr.get("kafka_consumer_client_id")) + ")")
-            except Exception as ex:
-                self._logger.warn("run_analyzer", "Waiting on a dedicated thread for the Kafka server to be available  (kafka_consumer_server=" + self._config_mgr.get("kafka_consumer_server") + ", kafka_consumer_client_id=" + self._config_mgr.get("kafka_consumer_client_id") + ")... Going to sleep for 10 seconds", exception_message=str(ex.message), exception_type=str(type(ex).__name__))
-                time.sleep(10)
-
-        # launch the auto-save thread
-        autosave_thread = threading.Thread(target=self._model_storage.auto_save_models, args=[save_interval])
-        autosave_thread.daemon = True
-        self._logger.info("run_analyzer", "Launching auto-save thread (save_interval=" + str(save_interval) + ")")
-        autosave_thread.start()
+        if self._config_mgr.get("kafka_consumer_group_id").strip() != "":
+            # Consumer group mode - this instance will only get the metrics of the partitions assigned to it
+            self._partitions_rebalance_listener = utils.partitions_rebalance_listener.PartitionsRebalanceListener(self._workers_pool)
+        if not self._transport.connect_consumer(self._partitions_rebalance_listener):
+            return
+
+        # launch the auto-save thread (when using worker processes, each worker saves its own models)
+        if self._workers_pool is None:
+            autosave_thread = threading.Thread(target=self._model_storage.auto_save_models, args=[save_interval])
+            autosave_thread.daemon = True
+            self._logger.info("run_analyzer", "Launching auto-save thread (save_interval=" + str(save_interval) + ")")
+            autosave_thread.start()
 
         # launch the thread that will inform the sender on which topic we're listening on
         self._monitored_topic_reporting_thread = threading.Thread(target=self._monitored_topic_reporter.auto_report_monitored_topic)
@@ -157,53 +215,111 @@ class MetricsRealtimeAnalyzer:
         self._monitored_topic_reporting_thread.start()
 
         # handle received metrics
-        self._logger.info("run_analyzer", "Starting the metrics handling loop")
-        self.metrics_handling_loop(self._kafka_consumer)
+        if self._pipeline_enabled:
+            utils.metrics_pipeline.MetricsPipeline(self._transport, self._metrics_parser, self._anomaly_detector, self._partitions_rebalance_listener).run()
+        elif self._config_mgr.get("kafka_consumer_max_poll_records") > 0:
+            self._logger.info("run_analyzer", "Starting the metrics batches handling loop (max_poll_records=" + str(self._config_mgr.get("kafka_consumer_max_poll_records")) + ")")
+            self.metrics_batches_handling_loop(self._transport)
+        else:
+            self._logger.info("run_analyzer", "Starting the metrics handling loop")
+            self.metrics_handling_loop(self._transport)
 
-    def metrics_handling_loop(self, kafka_consumer):
+    def metrics_handling_loop(self, transport):
         while not self._global_state.get_global_status("sigint_received"):
-            for metric in kafka_consumer:
+            for metric in transport.consume():
                 if self._global_state.get_global_status("sigint_received"):
                     return
-                autosave_thread_lock.acquire()
+                metric_handling_started = time.time()
                 # noinspection PyBroadException
                 try:
                     self._stats_mgr.up("raw_metrics_downloaded_from_kafka")
-                    self._logger.debug("run_analyzer", "Received the following metric from Kafka: " + str(metric))
+                    self._logger.debug("run_analyzer", lambda: "Received the following metric from Kafka: " + str(metric))
 
-                    # If this is an anomaly metric created by this service then there's no need to process it again...
-                    if metric.value is None or metric.value.strip() == "" or len(metric.value.split(" ")) != 3:
-                        self._logger.debug("run_analyzer", "Received this malformed metric. Ignoring")
+                    # Malformed metrics and metrics that do not match the allowed_to_work_on_metrics_pattern regex (i.e. the
+                    # anomaly metrics created by this service) are ignored
+                    metric_name = self._metrics_parser.get_allowed_metric_name(metric.value)
+                    if metric_name is None:
+                        self._logger.debug("run_analyzer", lambda: "Ignoring this metric since it's malformed or it DOES NOT match the regex " + self._config_mgr.get("allowed_to_work_on_metrics_pattern").pattern)
                         continue
 
-                    metric_name = metric.value.split(" ")[0]
-                    if re.match(self._config_mgr.get("allowed_to_work_on_metrics_pattern"), str(metric_name)):
-                        self._logger.debug("run_analyzer", "Handling this metric since it matches the regex " + self._config_mgr.get("allowed_to_work_on_metrics_pattern").pattern)
+                    if self._partitions_rebalance_listener is not None:
+                        self._partitions_rebalance_listener.track_metric(metric.topic, metric.partition, metric_name)
+                    if self._workers_pool is not None:
+                        self._workers_pool.dispatch(metric_name, metric.value)
+                    else:
                         parsed_metric = self._metrics_parser.parse_metric_message(metric_raw_info=metric.value)
                         self._anomaly_detector.detect_anomaly(parsed_metric)
-                    else:
-                        self._logger.debug("run_analyzer", "Ignoring this metric since it DOES NOT match the regex " + self._config_mgr.get("allowed_to_work_on_metrics_pattern").pattern)
                 except Exception as ex:
-                    self._logger.warn("run_analyzer", "The following error occurred while parsing the following metric that was pulled from Kafka: " + str(metric), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+                    self._logger.warn("run_analyzer", lambda: "The following error occurred while parsing the following metric that was pulled from Kafka: " + str(metric), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
                 finally:
-                    autosave_thread_lock.release()
+                    self._latency_histograms.observe("handle_metric", time.time() - metric_handling_started)
+
+    def metrics_batches_handling_loop(self, transport):
+        max_poll_records = self._config_mgr.get("kafka_consumer_max_poll_records")
+        while not self._global_state.get_global_status("sigint_received"):
+            metrics_batch = transport.consume_batch(max_records=max_poll_records, timeout_ms=1000)
+            if len(metrics_batch) == 0:
+                continue
+            self.handle_metrics_batch(metrics_batch)
+
+    def handle_metrics_batch(self, metrics_batch):
+        """
+        Filters, parses and analyzes (or dispatches to the workers) a batch of metrics pulled from Kafka. The stats are
+        updated once per batch rather than once per metric.
+        :param metrics_batch: List of records (as returned by MetricsTransport.consume_batch)
+        :return: None
+        """
+
+        batch_handling_started = time.time()
+        try:
+            self._stats_mgr.increase("raw_metrics_downloaded_from_kafka", len(metrics_batch))
+
+            if self._workers_pool is not None:
+                # The metrics are parsed by the workers
+                metrics_to_dispatch = []
+                for metric in metrics_batch:
+                    metric_name = self._metrics_parser.get_allowed_metric_name(metric.value)
+                    if metric_name is None:
+                        continue
+                    if self._partitions_rebalance_listener is not None:
+                        self._partitions_rebalance_listener.track_metric(metric.topic, metric.partition, metric_name)
+                    metrics_to_dispatch.append((metric_name, metric.value))
+                self._logger.debug("handle_metrics_batch", lambda: "Dispatching " + str(len(metrics_to_dispatch)) + " of the " + str(len(metrics_batch)) + " metrics received from Kafka")
+                self._workers_pool.dispatch_batch(metrics_to_dispatch)
+                return
+
+            parsed_metrics = self._metrics_parser.parse_metrics_batch([metric.value for metric in metrics_batch])
+            for metric, parsed_metric in zip(metrics_batch, parsed_metrics):
+                if parsed_metric is None:
+                    continue
+                if self._partitions_rebalance_listener is not None:
+                    self._partitions_rebalance_listener.track_metric(metric.topic, metric.partition, parsed_metric["metric_name"])
+                # noinspection PyBroadException
+                try:
+                    self._anomaly_detector.detect_anomaly(parsed_metric)
+                except Exception as ex:
+                    self._logger.warn("handle_metrics_batch", lambda: "The following error occurred while analyzing the following metric that was pulled from Kafka: " + str(metric.value), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
+        finally:
+            self._latency_histograms.observe("handle_metrics_batch", time.time() - batch_handling_started)
 
     def signal_handler(self, signal_caught, frame):
         self._logger.info("run_analyzer", "The signal " + str(signal_caught) + " was caught from frame " + str(frame))
         self._global_state.fire_event(event_name="sigint_received", set_global_status=True)
 
 
-analyzer_object = MetricsRealtimeAnalyzer()
-signal.signal(signal.SIGINT, analyzer_object.signal_handler)
-env_models_save_base_path = None
-env_models_params_base_path = None
-env_anomaly_likelihood_detectors_save_base_path = None
+if __name__ == "__main__":
+    analyzer_object = MetricsRealtimeAnalyzer()
+    signal.signal(signal.SIGINT, analyzer_object.signal_handler)
+    signal.signal(signal.SIGTERM, analyzer_object.signal_handler)
+    env_models_save_base_path = None
+    env_models_params_base_path = None
+    env_anomaly_likelihood_detectors_save_base_path = None
 
-script_path = os.path.dirname(os.path.realpath(__file__))
+    script_path = os.path.dirname(os.path.realpath(__file__))
 
-sys.argv = [sys.argv[0]]
-analyzer_object.run(
-    models_save_base_path=env_models_save_base_path,
-    models_params_base_path=env_models_params_base_path,
-    anomaly_likelihood_detectors_save_base_path=env_anomaly_likelihood_detectors_save_base_path
-)
+    sys.argv = [sys.argv[0]]
+    analyzer_object.run(
+        models_save_base_path=env_models_save_base_path,
+        models_params_base_path=env_models_params_base_path,
+        anomaly_likelihood_detectors_save_base_path=env_anomaly_likelihood_detectors_save_base_path
+    )
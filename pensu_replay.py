@@ -0,0 +1,189 @@
+#!/usr/bin/python2.7
+##########################################################################
+# Pensu Replay                                                           #
+# ------------                                                           #
+#                                                                        #
+# This tool is part of the Pensu package. It feeds historical metrics    #
+# (from CSV or graphite line format files) through the models at full    #
+# speed, without Kafka, so new metrics can be trained on months of       #
+# history in minutes. The models are saved (to the configured models     #
+# save paths) when it's done and the anomaly scores and predictions are  #
+# written to a local file.                                               #
+#                                                                        #
+# e.g. python pensu_replay.py --format csv --metric-name test.temp       #
+#        --timestamp-format %m/%d/%Y daily-minimum-temperatures-in-me.csv #
+#                                                                        #
+##########################################################################
+
+
+import argparse
+import calendar
+import csv
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import zlib
+
+import config_mgr
+import stats_mgr
+import models_library
+import model_persistence.models_storage
+import ai_handlers.anomaly_detector
+import utils.global_state
+import utils.mertrics_parser
+import utils.logger
+import transports.file_transport
+
+
+FILE_FORMATS = ["auto", "carbon", "csv"]
+
+
+class MetricsReplayer:
+    """
+    Replays the metrics in the given files through the anomaly detector. When replaying on several processes, each
+    process reads all the files but only handles the metrics that belong to it (by a stable hash of their name).
+    """
+
+    def __init__(self, args, worker_idx=0, workers_count=1):
+        self._args = args
+        self._worker_idx = worker_idx
+        self._workers_count = workers_count
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "MetricsReplayer")
+        self._models_library = models_library.ModelsLibrary.get_instance()
+        self._model_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        self._metrics_parser = utils.mertrics_parser.MetricsParser()
+        self._output_file_path = args.output if workers_count == 1 else args.output + "." + str(worker_idx)
+        self._file_transport = transports.file_transport.FileTransport(self._output_file_path)
+        self._anomaly_detector = ai_handlers.anomaly_detector.AnomalyDetector.get_instance(self._file_transport)
+        self._values_replayed = 0
+        self._values_skipped = 0
+        self._metrics_replayed = set()
+
+    def _is_my_metric(self, metric_name):
+        # zlib.crc32 is used (and not hash()) since its value is the same across processes
+        return self._workers_count == 1 or (zlib.crc32(metric_name) & 0xffffffff) % self._workers_count == self._worker_idx
+
+    def _get_file_format(self, file_path):
+        if self._args.format != "auto":
+            return self._args.format
+        return "csv" if file_path.lower().endswith(".csv") else "carbon"
+
+    def _get_csv_metric_name(self, file_path):
+        if self._args.metric_name is not None:
+            return self._args.metric_name
+        return "replay." + os.path.splitext(os.path.basename(file_path))[0].replace(".", "_").replace(" ", "_")
+
+    def _parse_csv_timestamp(self, raw_timestamp):
+        if self._args.timestamp_format == "epoch":
+            return int(float(raw_timestamp))
+        return int(calendar.timegm(time.strptime(raw_timestamp.strip(), self._args.timestamp_format)))
+
+    def read_metrics(self, file_path):
+        """
+        Reads the metrics in the given file (skipping those of other processes)
+        :param file_path: A CSV file (of a single metric) or a file with a metric per line in the graphite line format
+        :return: Generator of metrics in the graphite line format (metric.name.hierarchy value timestamp)
+        """
+
+        if self._get_file_format(file_path) == "carbon":
+            with open(file_path, "r") as metrics_file:
+                for line in metrics_file:
+                    line = line.strip()
+                    if line == "" or line.startswith("#"):
+                        continue
+                    if self._is_my_metric(line.split(" ", 1)[0]):
+                        yield line
+            return
+
+        metric_name = self._get_csv_metric_name(file_path)
+        if not self._is_my_metric(metric_name):
+            return
+        with open(file_path, "rb") as metrics_file:
+            for row_idx, row in enumerate(csv.reader(metrics_file)):
+                try:
+                    metric_timestamp = self._parse_csv_timestamp(row[self._args.timestamp_column])
+                    metric_value = float(row[self._args.value_column])
+                except (ValueError, IndexError):
+                    if row_idx > 0:
+                        # The first row is usually a header
+                        self._values_skipped += 1
+                        self._logger.warn("read_metrics", "Skipping a row that could not be parsed (row=" + str(row_idx + 1) + ", file=" + file_path + ")", metric=metric_name, min_seconds_between=1)
+                    continue
+                yield metric_name + " " + repr(metric_value) + " " + str(metric_timestamp)
+
+    def run(self):
+        replay_started = time.time()
+        for file_path in self._args.files:
+            self._logger.info("run", "Replaying the metrics in " + file_path + " (worker_idx=" + str(self._worker_idx) + ")")
+            for metric_raw_info in self.read_metrics(file_path):
+                if self._global_state.get_global_status("sigint_received"):
+                    break
+                parsed_metric = self._metrics_parser.parse_metric_message(metric_raw_info)
+                if parsed_metric is None:
+                    self._values_skipped += 1
+                    continue
+                self._anomaly_detector.detect_anomaly(parsed_metric)
+                self._metrics_replayed.add(parsed_metric["metric_name"])
+                self._values_replayed += 1
+                if self._values_replayed % 10000 == 0:
+                    self._logger.info("run", "Replayed " + str(self._values_replayed) + " values so far (worker_idx=" + str(self._worker_idx) + ", values_per_second=" + str(int(self._values_replayed / max(0.001, time.time() - replay_started))) + ")")
+
+        if not self._args.no_checkpoint:
+            self._model_storage.save_changed_metrics("replay")
+        self._file_transport.close()
+
+        replay_duration = time.time() - replay_started
+        print("Replayed " + str(self._values_replayed) + " values of " + str(len(self._metrics_replayed)) + " metrics in " + str(round(replay_duration, 2)) + " seconds (worker_idx=" + str(self._worker_idx) + ", values_skipped=" + str(self._values_skipped) + ", anomalies_reported=" + str(self._stats_mgr.get("anomalies_reported")) + ", output_file=" + self._output_file_path + ")")
+
+
+def _signal_handler(signal_caught, frame):
+    utils.global_state.GlobalState.get_instance().fire_event(event_name="sigint_received", set_global_status=True)
+
+
+def _replay_worker_main(args, worker_idx, workers_count):
+    stats_mgr.StatsMgr.get_instance(__file__).reset_counters()
+    signal.signal(signal.SIGINT, _signal_handler)
+    signal.signal(signal.SIGTERM, _signal_handler)
+    MetricsReplayer(args, worker_idx, workers_count).run()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Feeds historical metrics through the Pensu models (without Kafka) and saves the trained models. The models save paths, the models params and the rest of the configuration are taken from the same PENSU_* environment variables the service uses.")
+    parser.add_argument("files", nargs="+", help="The files to replay (in order). A CSV file holds the values of a single metric and any other file holds a metric per line in the graphite line format (metric.name.hierarchy value timestamp).")
+    parser.add_argument("--format", choices=FILE_FORMATS, default="auto", help="The format of the files (default: csv for files with a .csv extension and carbon for the rest)")
+    parser.add_argument("--metric-name", default=None, help="The metric name of the values in the CSV files (default: replay.<file name>)")
+    parser.add_argument("--timestamp-column", type=int, default=0, help="The (zero based) column of the timestamp in the CSV files (default: 0)")
+    parser.add_argument("--value-column", type=int, default=1, help="The (zero based) column of the value in the CSV files (default: 1)")
+    parser.add_argument("--timestamp-format", default="epoch", help="The strptime format (in UTC) of the timestamps in the CSV files or 'epoch' for unix timestamps (default: epoch)")
+    parser.add_argument("--output", default="pensu_replay_output.txt", help="The file to which the anomaly scores, predictions and anomaly reports are written (default: pensu_replay_output.txt). When using several processes each one writes to <output>.<process number>")
+    parser.add_argument("--parallel", type=int, default=1, help="The number of processes to spread the metrics over (default: 1)")
+    parser.add_argument("--no-checkpoint", action="store_true", help="Do not save the models when done")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.parallel <= 1:
+        _replay_worker_main(args, 0, 1)
+        return 0
+
+    # The workers handle the signals themselves (they stop and save their models) so this process just waits for them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    workers = []
+    for worker_idx in range(0, args.parallel):
+        worker = multiprocessing.Process(target=_replay_worker_main, args=(args, worker_idx, args.parallel), name="pensu_replay_worker_" + str(worker_idx))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return 0 if all([worker.exitcode == 0 for worker in workers]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
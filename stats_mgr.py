@@ -1,14 +1,93 @@
 import hashlib
 import time
+import threading
 from threading import Lock
-from multiprocessing import Value
+from multiprocessing.sharedctypes import RawArray
 
 
 class StatsMetricNotFoundException(Exception):
     pass
 
 
+# Counters are only increased (up/increase) and gauges are only set (set)
+COUNTERS = [
+    "anomalies_reported",
+    "metrics_received",
+    "metrics_successfully_processed",
+    "raw_metrics_downloaded_from_kafka",
+    "anomalies_reports_attempted",
+    "models_evicted",
+    "models_unload_failed",
+    "metrics_aggregated",
+    "log_lines_dropped",
+    "carbon_lines_received",
+    "carbon_lines_dropped",
+    "carbon_output_lines_sent",
+    "carbon_output_lines_dropped"
+]
+GAUGES_DEFAULTS = {
+    "last_metric_timestamp": -1,
+    "models_loaded": 0,
+    "models_memory_bytes": 0,
+    "anomaly_calculators_loaded": 0,
+    "last_checkpoint_duration_ms": 0,
+    "last_checkpoint_metrics_saved": 0,
+    "last_checkpoint_metrics_failed": 0,
+    "pipeline_metrics_queue_depth": 0,
+    "pipeline_output_queue_depth": 0
+}
+# Gauges whose values in the worker processes add up to the value of the whole service
+ADDITIVE_GAUGES = ["models_loaded", "models_memory_bytes"]
+# The names under which some of the stats are reported (in /ping) when they differ from their internal names
+STATS_REPORT_NAMES = {
+    "anomaly_calculators_loaded": "anomaly_likelihood_calculators_loaded"
+}
+
+
+class SharedStatsTable:
+    """
+    A table (in shared memory, allocated before forking the worker processes) with a row per worker process to which
+    each worker publishes its counters and gauges, so the master process can read them without any messages passing.
+    Each row is written by a single thread (the worker's stats reporter) so no locks are needed.
+    """
+
+    def __init__(self, rows_count):
+        self._columns = ["published_at"] + COUNTERS + sorted(GAUGES_DEFAULTS.keys())
+        self._rows_count = rows_count
+        self._values = RawArray('d', rows_count * len(self._columns))
+
+    def publish(self, row_idx, stats):
+        """
+        :param row_idx: The row of the publishing worker
+        :param stats: Dictionary with (at least) the values of all the counters and gauges
+        :return: None
+        """
+        row_offset = row_idx * len(self._columns)
+        for column_idx, column in enumerate(self._columns[1:]):
+            self._values[row_offset + column_idx + 1] = stats[column]
+        self._values[row_offset] = time.time()
+
+    def read(self):
+        """
+        :return: Dictionary of row index to dictionary of the published counters and gauges (rows that were never
+        published are skipped)
+        """
+        res = {}
+        for row_idx in range(0, self._rows_count):
+            row_offset = row_idx * len(self._columns)
+            if self._values[row_offset] == 0:
+                continue
+            res[row_idx] = dict([(STATS_REPORT_NAMES.get(column, column), int(self._values[row_offset + column_idx])) for column_idx, column in enumerate(self._columns) if column_idx > 0])
+        return res
+
+
 class StatsMgr:
+    """
+    Keeps the service's stats. To keep the stats calls almost free on the hot path (no locks), every thread increases
+    its own shard of the counters (the shards are summed on read) and the gauges are plain values that are set
+    atomically.
+    """
+
     __instance = None
     __threads_lock = Lock()
 
@@ -31,16 +110,28 @@ class StatsMgr:
                 StatsMgr.__instance = self
                 self._stats = {
                     "time_loaded": time.time(),
-                    "anomalies_reported": Value('i', 0),
-                    "metrics_received": Value('i', 0),
-                    "metrics_successfully_processed": Value('i', 0),
-                    "raw_metrics_downloaded_from_kafka": Value('i', 0),
-                    "anomalies_reports_attempted": Value('i', 0),
-                    "last_metric_timestamp": Value('i', -1),
-                    "models_loaded": Value('i', 0),
-                    "anomaly_calculators_loaded": Value('i', 0),
                     "files": {}
                 }
+                self._create_counters()
+        finally:
+            StatsMgr.__threads_lock.release()
+
+    def _create_counters(self):
+        self._counters_shards = []
+        self._retired_counters = dict([(counter, 0) for counter in COUNTERS])
+        self._thread_local = threading.local()
+        self._gauges = dict(GAUGES_DEFAULTS)
+
+    def reset_counters(self):
+        """
+        Resets all the counters and gauges. This is used by forked worker processes so that they will not report the
+        values inherited from the master process.
+        :return: None
+        """
+        StatsMgr.__threads_lock.acquire()
+        try:
+            self._stats["time_loaded"] = time.time()
+            self._create_counters()
         finally:
             StatsMgr.__threads_lock.release()
 
@@ -49,46 +140,74 @@ class StatsMgr:
         with open(filename, 'rb') as file:
             return file.read()
 
-    def up(self, stats_metric):
-        StatsMgr.__threads_lock.acquire()
+    def _get_counters_shard(self):
         try:
-            if stats_metric in self._stats:
-                self._stats[stats_metric].value += 1
-            else:
-                raise StatsMetricNotFoundException()
-        finally:
-            StatsMgr.__threads_lock.release()
+            return self._thread_local.counters_shard
+        except AttributeError:
+            counters_shard = dict([(counter, 0) for counter in COUNTERS])
+            StatsMgr.__threads_lock.acquire()
+            try:
+                self._counters_shards.append((threading.current_thread(), counters_shard))
+            finally:
+                StatsMgr.__threads_lock.release()
+            self._thread_local.counters_shard = counters_shard
+            return counters_shard
+
+    def up(self, stats_metric):
+        self.increase(stats_metric, 1)
+
+    def increase(self, stats_metric, amount):
+        counters_shard = self._get_counters_shard()
+        if stats_metric in counters_shard:
+            counters_shard[stats_metric] += amount
+        else:
+            raise StatsMetricNotFoundException()
 
     def set(self, stats_metric, value):
-        StatsMgr.__threads_lock.acquire()
-        try:
-            if stats_metric in self._stats:
-                self._stats[stats_metric].value = value
-            else:
-                raise StatsMetricNotFoundException()
-        finally:
-            StatsMgr.__threads_lock.release()
+        if stats_metric in self._gauges:
+            self._gauges[stats_metric] = value
+        else:
+            raise StatsMetricNotFoundException()
 
     def get(self, stats_metric):
+        if stats_metric in self._gauges:
+            return self._gauges[stats_metric]
+        elif stats_metric in COUNTERS:
+            return self.get_counters_and_gauges()[stats_metric]
+        else:
+            raise StatsMetricNotFoundException()
+
+    def get_counters_and_gauges(self):
+        """
+        :return: Dictionary with the current values of all the counters and gauges (keyed by their internal names)
+        """
         StatsMgr.__threads_lock.acquire()
         try:
-            if stats_metric in self._stats:
-                return self._stats[stats_metric].value
-            else:
-                raise StatsMetricNotFoundException()
+            # The shards of threads that ended are folded so they don't pile up
+            live_counters_shards = []
+            for thread, counters_shard in self._counters_shards:
+                if thread.is_alive():
+                    live_counters_shards.append((thread, counters_shard))
+                else:
+                    for counter, value in counters_shard.items():
+                        self._retired_counters[counter] += value
+            self._counters_shards = live_counters_shards
+
+            res = dict(self._gauges)
+            res.update(self._retired_counters)
+            for thread, counters_shard in self._counters_shards:
+                for counter, value in counters_shard.items():
+                    res[counter] += value
+            return res
         finally:
             StatsMgr.__threads_lock.release()
 
     def get_stats(self):
-        return {
+        res = {
             "time_loaded": self._stats["time_loaded"],
             "uptime": time.time() - self._stats["time_loaded"],
-            "anomalies_reports_attempted": self._stats["anomalies_reports_attempted"].value,
-            "anomalies_reported": self._stats["anomalies_reported"].value,
-            "metrics_received": self._stats["metrics_received"].value,
-            "metrics_successfully_processed": self._stats["metrics_successfully_processed"].value,
-            "raw_metrics_downloaded_from_kafka": self._stats["raw_metrics_downloaded_from_kafka"].value,
-            "models_loaded": self._stats["models_loaded"].value,
-            "anomaly_likelihood_calculators_loaded": self._stats["anomaly_calculators_loaded"].value,
             "files": self._stats["files"]
         }
+        for stats_metric, value in self.get_counters_and_gauges().items():
+            res[STATS_REPORT_NAMES.get(stats_metric, stats_metric)] = value
+        return res
@@ -0,0 +1,168 @@
+import socket
+import threading
+import time
+from collections import deque
+
+import config_mgr
+import stats_mgr
+import utils.logger
+import transports.metrics_transport
+
+
+class CarbonOutputTransport(transports.metrics_transport.MetricsTransport):
+    """
+    Wraps another transport and writes the metrics it creates (the anomaly scores and the predictions, which are
+    already in the graphite line format) straight to Carbon instead of publishing them, so they don't go through the
+    broker (and a relay) on their way to Graphite. Everything else (consuming, the anomaly reports, the topics list) is
+    left to the wrapped transport.
+
+    The lines are kept in a bounded buffer and written, many lines per write, by a pool of threads - each with a
+    persistent TCP connection to Carbon of its own. When Carbon is unavailable the lines are kept (until the buffer is
+    full, when the oldest ones are dropped) and the connections are retried with an increasing backoff.
+    """
+
+    def __init__(self, transport):
+        """
+        :param transport: The transport to consume from and to publish everything but the created metrics to
+        """
+        self._transport = transport
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "CarbonOutputTransport")
+        self._carbon_address = (self._config_mgr.get("carbon_output_host"), self._config_mgr.get("carbon_output_port"))
+        self._connections_count = max(1, self._config_mgr.get("carbon_output_connections"))
+        self._batch_size = max(1, self._config_mgr.get("carbon_output_batch_size"))
+        self._metrics_topics = set([self._config_mgr.get("anomalies_metrics_kafka_topic"), self._config_mgr.get("predictions_metrics_kafka_topic")])
+        self._lines = deque(maxlen=max(1, self._config_mgr.get("carbon_output_buffer_size")))
+        self._lines_condition = threading.Condition()
+        self._lines_in_flight = 0
+        self._closed = False
+        self._writer_threads = []
+
+    def connect_producer(self):
+        if not self._transport.connect_producer():
+            return False
+        if len(self._writer_threads) == 0:
+            # The threads are started here (and not in __init__) since the transport may be created before the worker
+            # processes are forked
+            for connection_idx in range(0, self._connections_count):
+                writer_thread = threading.Thread(target=self._write_lines, args=[connection_idx])
+                writer_thread.daemon = True
+                writer_thread.start()
+                self._writer_threads.append(writer_thread)
+            self._logger.info("connect_producer", "Writing the created metrics directly to Carbon (host=" + str(self._carbon_address[0]) + ", port=" + str(self._carbon_address[1]) + ", connections=" + str(self._connections_count) + ")")
+        return True
+
+    def connect_consumer(self, rebalance_listener=None):
+        return self._transport.connect_consumer(rebalance_listener)
+
+    def consume(self):
+        return self._transport.consume()
+
+    def consume_batch(self, max_records, timeout_ms):
+        return self._transport.consume_batch(max_records, timeout_ms)
+
+    def get_memory_transport(self):
+        return self._transport.get_memory_transport()
+
+    def publish(self, topic, value):
+        if topic in self._metrics_topics:
+            self._buffer_lines([value])
+        else:
+            self._transport.publish(topic, value)
+
+    def publish_batch(self, topic, values):
+        if topic in self._metrics_topics:
+            self._buffer_lines(values)
+        else:
+            self._transport.publish_batch(topic, values)
+
+    def _buffer_lines(self, lines):
+        self._lines_condition.acquire()
+        try:
+            dropped_count = max(0, len(self._lines) + len(lines) - self._lines.maxlen)
+            self._lines.extend(lines)
+            self._lines_condition.notify()
+        finally:
+            self._lines_condition.release()
+        if dropped_count > 0:
+            self._stats_mgr.increase("carbon_output_lines_dropped", dropped_count)
+            self._logger.warn("_buffer_lines", "The Carbon output buffer is full. Dropping the oldest lines.", min_seconds_between=10)
+
+    def _take_lines(self):
+        """
+        Waits (up to a second) for lines to write
+        :return: List of up to carbon_output_batch_size lines (empty if there are none)
+        """
+        self._lines_condition.acquire()
+        try:
+            if len(self._lines) == 0:
+                self._lines_condition.wait(1)
+            lines = []
+            while len(lines) < self._batch_size and len(self._lines) > 0:
+                lines.append(self._lines.popleft())
+            self._lines_in_flight += len(lines)
+            return lines
+        finally:
+            self._lines_condition.release()
+
+    def _return_lines(self, lines, written):
+        self._lines_condition.acquire()
+        try:
+            self._lines_in_flight -= len(lines)
+            if not written:
+                # The lines are put back at the front, unless there's no room for them
+                room = self._lines.maxlen - len(self._lines)
+                self._lines.extendleft(reversed(lines[len(lines) - room:] if room < len(lines) else lines))
+                if room < len(lines):
+                    self._stats_mgr.increase("carbon_output_lines_dropped", len(lines) - room)
+            self._lines_condition.notify_all()
+        finally:
+            self._lines_condition.release()
+
+    def _write_lines(self, connection_idx):
+        carbon_socket = None
+        retries = 0
+        while not self._closed:
+            lines = self._take_lines()
+            if len(lines) == 0:
+                continue
+            written = False
+            try:
+                if carbon_socket is None:
+                    carbon_socket = socket.create_connection(self._carbon_address, timeout=10)
+                carbon_socket.sendall("\n".join(lines) + "\n")
+                written = True
+                retries = 0
+                self._stats_mgr.increase("carbon_output_lines_sent", len(lines))
+            except (socket.error, socket.timeout) as ex:
+                self._logger.warn("_write_lines", "Failed to write to Carbon. Retrying in " + str(min(30, 2 ** retries)) + " seconds (connection_idx=" + str(connection_idx) + ", host=" + str(self._carbon_address[0]) + ", port=" + str(self._carbon_address[1]) + ")", exception_type=type(ex).__name__, exception_message=str(ex), min_seconds_between=10)
+                if carbon_socket is not None:
+                    carbon_socket.close()
+                    carbon_socket = None
+            finally:
+                self._return_lines(lines, written)
+            if not written:
+                time.sleep(min(30, 2 ** retries))
+                retries += 1
+        if carbon_socket is not None:
+            carbon_socket.close()
+
+    def flush(self):
+        """
+        Waits (up to shutdown_timeout seconds) for the buffered lines to be written to Carbon
+        :return: None
+        """
+        flush_started = time.time()
+        self._lines_condition.acquire()
+        try:
+            while (len(self._lines) > 0 or self._lines_in_flight > 0) and len(self._writer_threads) > 0 and time.time() - flush_started < self._config_mgr.get("shutdown_timeout"):
+                self._lines_condition.wait(1)
+        finally:
+            self._lines_condition.release()
+        self._transport.flush()
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        self._transport.close()
@@ -0,0 +1,43 @@
+from threading import Lock
+
+import transports.metrics_transport
+
+
+class FileTransport(transports.metrics_transport.MetricsTransport):
+    """
+    A publish only transport that appends every message published to it to a local file (one line per message: the
+    topic followed by the message). Used when the metrics are fed to the models directly (i.e. by pensu_replay.py).
+    """
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._file = open(file_path, "a")
+        self._lock = Lock()
+
+    def publish(self, topic, value):
+        self._lock.acquire()
+        try:
+            self._file.write(str(topic) + " " + value + "\n")
+        finally:
+            self._lock.release()
+
+    def publish_batch(self, topic, values):
+        self._lock.acquire()
+        try:
+            self._file.write("".join([str(topic) + " " + value + "\n" for value in values]))
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._file.close()
+        finally:
+            self._lock.release()
@@ -0,0 +1,97 @@
+import time
+
+import kafka
+
+import config_mgr
+import utils.global_state
+import utils.logger
+import transports.metrics_transport
+
+
+class KafkaTransport(transports.metrics_transport.MetricsTransport):
+    """
+    Consumes the raw metrics from the raw_metrics_kafka_topic topic (as part of the kafka_consumer_group_id consumer
+    group if it's set) and publishes the results with a KafkaProducer
+    """
+
+    def __init__(self, client_id_suffix=""):
+        """
+        :param client_id_suffix: Appended to the configured client ids (i.e. to tell the worker processes apart)
+        """
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "KafkaTransport")
+        self._client_id_suffix = client_id_suffix
+        self._kafka_producer = None
+        self._kafka_consumer = None
+
+    def connect_producer(self):
+        while self._kafka_producer is None:
+            if self._global_state.get_global_status("sigint_received"):
+                return False
+
+            try:
+                self._kafka_producer = kafka.producer.KafkaProducer(
+                    bootstrap_servers=self._config_mgr.get("kafka_producer_server"),
+                    client_id=self._config_mgr.get("kafka_producer_client_id") + self._client_id_suffix
+                )
+            except Exception as ex:
+                self._logger.warn("connect_producer", "Waiting (indefinitely in 10 sec intervals) for the Producer Kafka service to become available... (kafka_producer_server=" + self._config_mgr.get("kafka_producer_server") + ", kafka_producer_client_id=" + self._config_mgr.get("kafka_producer_client_id") + self._client_id_suffix + ")", exception_type=type(ex).__name__, exception_message=str(ex.message))
+                time.sleep(10)
+        return True
+
+    def connect_consumer(self, rebalance_listener=None):
+        while self._kafka_consumer is None:
+            if self._global_state.get_global_status("sigint_received"):
+                return False
+            try:
+                if self._config_mgr.get("kafka_consumer_group_id").strip() == "":
+                    self._kafka_consumer = kafka.KafkaConsumer(self._config_mgr.get("raw_metrics_kafka_topic"),
+                                                               bootstrap_servers=self._config_mgr.get("kafka_consumer_server"),
+                                                               client_id=self._config_mgr.get("kafka_consumer_client_id") + self._client_id_suffix,
+                                                               consumer_timeout_ms=self._config_mgr.get("kafka_consumer_session_timeout"))
+                else:
+                    # Consumer group mode - this instance will only get the metrics of the partitions assigned to it
+                    kafka_consumer = kafka.KafkaConsumer(bootstrap_servers=self._config_mgr.get("kafka_consumer_server"),
+                                                         client_id=self._config_mgr.get("kafka_consumer_client_id") + self._client_id_suffix,
+                                                         group_id=self._config_mgr.get("kafka_consumer_group_id"),
+                                                         consumer_timeout_ms=self._config_mgr.get("kafka_consumer_session_timeout"))
+                    if rebalance_listener is not None:
+                        kafka_consumer.subscribe(topics=[self._config_mgr.get("raw_metrics_kafka_topic")], listener=rebalance_listener)
+                    else:
+                        kafka_consumer.subscribe(topics=[self._config_mgr.get("raw_metrics_kafka_topic")])
+                    self._kafka_consumer = kafka_consumer
+                self._logger.info("connect_consumer", "Loaded a Kafka consumer successfully. (self._metrics_kafka_topic=" + str(self._config_mgr.get("raw_metrics_kafka_topic")) + ";bootstrap_servers=" + str(self._config_mgr.get("kafka_consumer_server")) + ";client_id=" + str(self._config_mgr.get("kafka_consumer_client_id")) + ";group_id=" + str(self._config_mgr.get("kafka_consumer_group_id")) + ")")
+            except Exception as ex:
+                self._logger.warn("connect_consumer", "Waiting on a dedicated thread for the Kafka server to be available  (kafka_consumer_server=" + self._config_mgr.get("kafka_consumer_server") + ", kafka_consumer_client_id=" + self._config_mgr.get("kafka_consumer_client_id") + ")... Going to sleep for 10 seconds", exception_message=str(ex.message), exception_type=str(type(ex).__name__))
+                time.sleep(10)
+        return True
+
+    def consume(self):
+        # The consumer's iteration stops after consumer_timeout_ms without records
+        return iter(self._kafka_consumer)
+
+    def consume_batch(self, max_records, timeout_ms):
+        records_by_partition = self._kafka_consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+        records = []
+        for partition_records in records_by_partition.values():
+            records.extend(partition_records)
+        return records
+
+    def publish(self, topic, value):
+        self._kafka_producer.send(topic=topic, value=value)
+
+    def publish_batch(self, topic, values):
+        # KafkaProducer batches the messages by itself (they are sent in the background)
+        for value in values:
+            self._kafka_producer.send(topic=topic, value=value)
+
+    def flush(self):
+        if self._kafka_producer is not None:
+            self._kafka_producer.flush()
+
+    def close(self):
+        if self._kafka_consumer is not None:
+            self._kafka_consumer.close()
+        if self._kafka_producer is not None:
+            self._kafka_producer.close()
@@ -0,0 +1,112 @@
+import itertools
+import Queue
+from collections import deque
+from threading import Lock
+
+import config_mgr
+import transports.metrics_transport
+
+
+class MemoryTransport(transports.metrics_transport.MetricsTransport):
+    """
+    An in-process stand-in for Kafka. The raw metrics are put (by the benchmarks, tests or an in-process listener)
+    into a bounded queue that the analyzer consumes from, and the published messages are counted per topic and the
+    last ones are kept, so everything runs at full speed on one machine without any outside services.
+    """
+
+    def __init__(self, queue_size=None, published_kept=None):
+        """
+        :param queue_size: The maximal number of records waiting to be consumed. Defaults to
+        memory_transport_queue_size. 0 - unbounded.
+        :param published_kept: The number of the last published messages kept (see get_published). Defaults to
+        memory_transport_queue_size.
+        """
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        if queue_size is None:
+            queue_size = self._config_mgr.get("memory_transport_queue_size")
+        if published_kept is None:
+            published_kept = self._config_mgr.get("memory_transport_queue_size")
+        self._raw_metrics_kafka_topic = self._config_mgr.get("raw_metrics_kafka_topic")
+        self._consumer_timeout = self._config_mgr.get("kafka_consumer_session_timeout") / 1000.0
+        self._records_queue = Queue.Queue(maxsize=queue_size)
+        self._offsets = itertools.count()
+        self._published_lock = Lock()
+        self._published = deque(maxlen=published_kept)
+        self._published_counts = {}
+
+    def put(self, value, topic=None, block=True, timeout=None):
+        """
+        Adds a raw metric to be consumed
+        :param value: The raw metric (in the graphite line format)
+        :param topic: The topic of the record (defaults to raw_metrics_kafka_topic)
+        :param block: Whether to wait for room in the queue when it's full
+        :param timeout: The maximal number of seconds to wait for room in the queue (None - indefinitely)
+        :return: True if the metric was added, False if the queue is full
+        """
+        try:
+            self._records_queue.put(transports.metrics_transport.ConsumerRecord(topic if topic is not None else self._raw_metrics_kafka_topic, 0, next(self._offsets), value), block, timeout)
+            return True
+        except Queue.Full:
+            return False
+
+    def get_memory_transport(self):
+        return self
+
+    def get_queue_depth(self):
+        return self._records_queue.qsize()
+
+    def consume(self):
+        while True:
+            try:
+                yield self._records_queue.get(timeout=self._consumer_timeout)
+            except Queue.Empty:
+                return
+
+    def consume_batch(self, max_records, timeout_ms):
+        try:
+            records = [self._records_queue.get(timeout=timeout_ms / 1000.0)]
+        except Queue.Empty:
+            return []
+        try:
+            while len(records) < max_records:
+                records.append(self._records_queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return records
+
+    def publish(self, topic, value):
+        self._published_lock.acquire()
+        try:
+            self._published.append((topic, value))
+            self._published_counts[topic] = self._published_counts.get(topic, 0) + 1
+        finally:
+            self._published_lock.release()
+
+    def publish_batch(self, topic, values):
+        self._published_lock.acquire()
+        try:
+            self._published.extend([(topic, value) for value in values])
+            self._published_counts[topic] = self._published_counts.get(topic, 0) + len(values)
+        finally:
+            self._published_lock.release()
+
+    def get_published(self, topic=None):
+        """
+        :param topic: The topic to return the messages of (None - all the topics)
+        :return: List of (topic, message) of the last published messages
+        """
+        self._published_lock.acquire()
+        try:
+            return [(message_topic, value) for message_topic, value in self._published if topic is None or message_topic == topic]
+        finally:
+            self._published_lock.release()
+
+    def get_published_counts(self):
+        """
+        :return: Dictionary of topic to the number of messages published to it
+        """
+        self._published_lock.acquire()
+        try:
+            return dict(self._published_counts)
+        finally:
+            self._published_lock.release()
@@ -0,0 +1,73 @@
+from collections import namedtuple
+
+# The fields of kafka's ConsumerRecord that the analyzer uses. The non-kafka transports hand out records of this type.
+ConsumerRecord = namedtuple("ConsumerRecord", ["topic", "partition", "offset", "value"])
+
+
+class MetricsTransport:
+    """
+    The way the raw metrics get in (consume) and the results get out (publish). The analyzer and the classes that
+    report its results (AnomalyDetector, AnomaliesHandler and MonitoredTopicReporter) only use this interface, so the
+    same code runs against Kafka or in-process (see transport_factory.TRANSPORTS).
+    """
+
+    def connect_producer(self):
+        """
+        Makes the transport ready for publishing (waiting for the broker to be available if there is one)
+        :return: False if the service is shutting down before the transport was ready, True otherwise
+        """
+        return True
+
+    def connect_consumer(self, rebalance_listener=None):
+        """
+        Makes the transport ready for consuming (waiting for the broker to be available if there is one)
+        :param rebalance_listener: Notified when the partitions assigned to this instance change (consumer groups only)
+        :return: False if the service is shutting down before the transport was ready, True otherwise
+        """
+        return True
+
+    def consume(self):
+        """
+        :return: Iterator over the received records (having topic, partition and value) that ends once no record was
+        received for kafka_consumer_session_timeout milliseconds
+        """
+        raise NotImplementedError()
+
+    def consume_batch(self, max_records, timeout_ms):
+        """
+        :param max_records: The maximal number of records to return
+        :param timeout_ms: How long to wait for the first record
+        :return: List of the received records (empty if none was received in time)
+        """
+        raise NotImplementedError()
+
+    def publish(self, topic, value):
+        """
+        :param topic: The topic to publish to
+        :param value: The message (bytes)
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def publish_batch(self, topic, values):
+        """
+        Publishes several messages to the same topic
+        :param topic: The topic to publish to
+        :param values: List of messages (bytes)
+        :return: None
+        """
+        for value in values:
+            self.publish(topic, value)
+
+    def get_memory_transport(self):
+        """
+        :return: The MemoryTransport that the raw metrics are consumed from (to put metrics into) or None if the
+        metrics are not consumed from memory
+        """
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
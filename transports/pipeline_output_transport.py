@@ -0,0 +1,78 @@
+import threading
+import time
+import Queue
+
+import stats_mgr
+import utils.latency_histograms
+import utils.logger
+import transports.metrics_transport
+
+
+class PipelineOutputTransport(transports.metrics_transport.MetricsTransport):
+    """
+    The output stage of the metrics pipeline - wraps the analyzer's transport and publishes the messages on a thread
+    of its own (through a bounded queue), so the compute stage doesn't wait for the sends. Everything else is left to
+    the wrapped transport.
+    """
+
+    def __init__(self, transport, queue_size):
+        """
+        :param transport: The transport to publish the messages with
+        :param queue_size: The maximal number of publish requests waiting to be sent (publishing blocks when it's full)
+        """
+        self._transport = transport
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "PipelineOutputTransport")
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+        self._publish_queue = Queue.Queue(maxsize=queue_size)
+        self._publishing_thread = None
+
+    def connect_producer(self):
+        if not self._transport.connect_producer():
+            return False
+        if self._publishing_thread is None:
+            self._publishing_thread = threading.Thread(target=self._publish_loop)
+            self._publishing_thread.daemon = True
+            self._publishing_thread.start()
+        return True
+
+    def connect_consumer(self, rebalance_listener=None):
+        return self._transport.connect_consumer(rebalance_listener)
+
+    def consume(self):
+        return self._transport.consume()
+
+    def consume_batch(self, max_records, timeout_ms):
+        return self._transport.consume_batch(max_records, timeout_ms)
+
+    def get_memory_transport(self):
+        return self._transport.get_memory_transport()
+
+    def publish(self, topic, value):
+        self._publish_queue.put((topic, [value]))
+
+    def publish_batch(self, topic, values):
+        self._publish_queue.put((topic, values))
+
+    def _publish_loop(self):
+        while True:
+            topic, values = self._publish_queue.get()
+            output_started = time.time()
+            # noinspection PyBroadException
+            try:
+                self._transport.publish_batch(topic, values)
+            except Exception as ex:
+                self._logger.warn("_publish_loop", "Failed to publish " + str(len(values)) + " messages to " + str(topic), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
+            finally:
+                self._publish_queue.task_done()
+                self._stats_mgr.set("pipeline_output_queue_depth", self._publish_queue.qsize())
+                self._latency_histograms.observe("pipeline_output", time.time() - output_started)
+
+    def flush(self):
+        if self._publishing_thread is not None:
+            self._publish_queue.join()
+        self._transport.flush()
+
+    def close(self):
+        self.flush()
+        self._transport.close()
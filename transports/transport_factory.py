@@ -0,0 +1,27 @@
+import config_mgr
+import transports.kafka_transport
+import transports.memory_transport
+import transports.carbon_output_transport
+
+# kafka - consume from and publish to Kafka, memory - an in-process queue (see MemoryTransport)
+TRANSPORTS = ["kafka", "memory"]
+
+
+def create_transport(client_id_suffix=""):
+    """
+    Creates the transport configured by the transport config key (wrapped by a CarbonOutputTransport if
+    carbon_output_enabled is set)
+    :param client_id_suffix: Appended to the Kafka client ids (i.e. to tell the worker processes apart)
+    :return: A MetricsTransport
+    """
+    config = config_mgr.ConfigMgr.get_instance()
+    transport_name = config.get("transport").strip().lower()
+    if transport_name == "kafka":
+        transport = transports.kafka_transport.KafkaTransport(client_id_suffix)
+    elif transport_name == "memory":
+        transport = transports.memory_transport.MemoryTransport()
+    else:
+        raise config_mgr.ConfigValueInvalidException("The value " + transport_name + " for transport is invalid. It should be one of: " + ", ".join(TRANSPORTS))
+    if config.get("carbon_output_enabled") == 1:
+        return transports.carbon_output_transport.CarbonOutputTransport(transport)
+    return transport
@@ -5,6 +5,7 @@ from threading import Lock
 import config_mgr
 import stats_mgr
 import utils.logger
+import utils.mertrics_parser
 
 
 class AnomaliesHandler:
@@ -12,16 +13,16 @@ class AnomaliesHandler:
     __threads_lock = Lock()
 
     @staticmethod
-    def get_instance(kafka_producer):
+    def get_instance(transport):
         if AnomaliesHandler.__instance is None:
-            AnomaliesHandler(kafka_producer)
+            AnomaliesHandler(transport)
         return AnomaliesHandler.__instance
 
     @staticmethod
     def get_current_instance():
         return AnomaliesHandler.__instance
 
-    def __init__(self, kafka_producer):
+    def __init__(self, transport):
         AnomaliesHandler.__threads_lock.acquire()
         try:
             if AnomaliesHandler.__instance is not None:
@@ -29,7 +30,7 @@ class AnomaliesHandler:
             else:
                 AnomaliesHandler.__instance = self
                 self._config_mgr = config_mgr.ConfigMgr.get_instance()
-                self._kafka_producer = kafka_producer
+                self._transport = transport
                 self._anomaly_reports_kafka_topic = self._config_mgr.get("anomaly_reports_kafka_topic")
                 self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
                 self._logger = utils.logger.Logger(__file__, "AnomaliesHandler")
@@ -40,12 +41,12 @@ class AnomaliesHandler:
         self._stats_mgr.up("anomalies_reports_attempted")
         anomaly_report = {
             "report_id": str(uuid.uuid4()),
-            "metric": metric,
+            "metric": utils.mertrics_parser.get_full_metric_info(metric),
             "reporter": "pensu",
             "meta_data": anomaly_info
         }
         try:
-            self._kafka_producer.send(topic=self._anomaly_reports_kafka_topic, value=json.dumps(anomaly_report).encode('utf-8'))
+            self._transport.publish(self._anomaly_reports_kafka_topic, json.dumps(anomaly_report).encode('utf-8'))
             self._logger.info("report_anomaly", "Reported the following anomaly to kafka: " + json.dumps(anomaly_report), metric=str(metric))
             self._stats_mgr.up("anomalies_reported")
 
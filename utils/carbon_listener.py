@@ -0,0 +1,88 @@
+import SocketServer
+import threading
+
+import config_mgr
+import stats_mgr
+import utils.global_state
+import utils.logger
+
+
+class _CarbonTCPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        carbon_listener = self.server.carbon_listener
+        for line in self.rfile:
+            # Blocks while the queue is full - the sender is then slowed down by TCP's flow control
+            if not carbon_listener.put_line(line, block=True):
+                return
+
+
+class _CarbonUDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        carbon_listener = self.server.carbon_listener
+        for line in self.request[0].splitlines():
+            # There is no flow control over UDP, so lines that don't fit in the queue are dropped
+            carbon_listener.put_line(line, block=False)
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class CarbonListener:
+    """
+    Receives metrics in the Carbon plaintext protocol (metric.name.hierarchy value timestamp, a metric per line) over
+    TCP and UDP and puts them into the given MemoryTransport, from which the analyzer consumes them like it does from
+    Kafka. Each TCP connection is served by a thread of its own.
+    """
+
+    def __init__(self, transport):
+        """
+        :param transport: The MemoryTransport to put the received metrics into
+        """
+        self._transport = transport
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "CarbonListener")
+        self._servers = []
+
+    def put_line(self, line, block):
+        """
+        :param line: A line received from a client
+        :param block: Whether to wait for room in the transport's queue (until the service is shutting down)
+        :return: False if the service is shutting down, True otherwise
+        """
+        line = line.strip()
+        if line == "":
+            return True
+        self._stats_mgr.up("carbon_lines_received")
+        while not self._global_state.get_global_status("sigint_received"):
+            if self._transport.put(line, block=block, timeout=1):
+                return True
+            if not block:
+                self._stats_mgr.up("carbon_lines_dropped")
+                self._logger.warn("put_line", "The metrics queue is full. Dropping the metrics received over UDP that don't fit in it.", min_seconds_between=10)
+                return True
+        return False
+
+    def start(self):
+        """
+        Starts listening (on carbon_listen_host:carbon_listen_port, both TCP and UDP) on background threads
+        :return: None
+        """
+        listen_address = (self._config_mgr.get("carbon_listen_host"), self._config_mgr.get("carbon_listen_port"))
+        for server_class, handler_class in [(_ThreadingTCPServer, _CarbonTCPHandler), (SocketServer.UDPServer, _CarbonUDPHandler)]:
+            server = server_class(listen_address, handler_class)
+            server.carbon_listener = self
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            self._servers.append(server)
+        self._logger.info("start", "Listening for metrics in the Carbon plaintext protocol (host=" + str(listen_address[0]) + ", port=" + str(listen_address[1]) + ", protocols=TCP,UDP)")
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
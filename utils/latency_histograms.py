@@ -0,0 +1,133 @@
+import bisect
+from threading import Lock
+
+import config_mgr
+
+# The upper bounds (in seconds) of the histograms' buckets. The last (implicit) bucket is +Inf.
+BUCKETS_BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class LatencyHistograms:
+    """
+    Keeps a fixed-buckets histogram of the latency of each stage of the metrics handling (parsing, models lookup,
+    models runs, kafka sends etc.) and exports them (along with the stats counters) in the Prometheus text format.
+    """
+
+    __instance = None
+    __threads_lock = Lock()
+
+    @staticmethod
+    def get_instance():
+        if LatencyHistograms.__instance is None:
+            LatencyHistograms()
+        return LatencyHistograms.__instance
+
+    def __init__(self):
+        LatencyHistograms.__threads_lock.acquire()
+        try:
+            if LatencyHistograms.__instance is not None:
+                raise Exception("This is a singleton class. Please use the get_instance() method.")
+            else:
+                LatencyHistograms.__instance = self
+                self._config_mgr = config_mgr.ConfigMgr.get_instance()
+                self.enabled = self._config_mgr.get("latency_histograms_enabled") == 1
+                self._histograms = {}
+        finally:
+            LatencyHistograms.__threads_lock.release()
+
+    def observe(self, stage, seconds):
+        """
+        Adds a measurement to the histogram of the given stage
+        :param stage: The name of the stage (i.e. "parse" or "anomaly_run")
+        :param seconds: How long the stage took
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        bucket_idx = bisect.bisect_left(BUCKETS_BOUNDS, seconds)
+        LatencyHistograms.__threads_lock.acquire()
+        try:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = {"counts": [0] * (len(BUCKETS_BOUNDS) + 1), "sum": 0.0}
+                self._histograms[stage] = histogram
+            histogram["counts"][bucket_idx] += 1
+            histogram["sum"] += seconds
+        finally:
+            LatencyHistograms.__threads_lock.release()
+
+    def reset(self):
+        """
+        Drops all the measurements. Used by forked worker processes so they will not report the master's measurements.
+        :return: None
+        """
+        LatencyHistograms.__threads_lock.acquire()
+        try:
+            self._histograms = {}
+        finally:
+            LatencyHistograms.__threads_lock.release()
+
+    def get_snapshot(self):
+        """
+        :return: A copy of the histograms - dictionary of stage name to {"counts": [per bucket count], "sum": seconds}
+        """
+        LatencyHistograms.__threads_lock.acquire()
+        try:
+            return dict([(stage, {"counts": list(histogram["counts"]), "sum": histogram["sum"]}) for stage, histogram in self._histograms.items()])
+        finally:
+            LatencyHistograms.__threads_lock.release()
+
+
+def merge_snapshots(snapshots):
+    """
+    :param snapshots: List of snapshots (as returned by LatencyHistograms.get_snapshot)
+    :return: A single snapshot with the sum of the given ones
+    """
+    res = {}
+    for snapshot in snapshots:
+        for stage, histogram in snapshot.items():
+            if stage not in res:
+                res[stage] = {"counts": [0] * (len(BUCKETS_BOUNDS) + 1), "sum": 0.0}
+            res[stage]["counts"] = [total + count for total, count in zip(res[stage]["counts"], histogram["counts"])]
+            res[stage]["sum"] += histogram["sum"]
+    return res
+
+
+def to_prometheus_text(snapshot, counters, gauges, labeled_gauges=None):
+    """
+    Formats the histograms, the counters and the gauges in the Prometheus text exposition format
+    :param snapshot: The histograms snapshot to export
+    :param counters: Dictionary of counter name to (numeric) value. Exported with the _total suffix.
+    :param gauges: Dictionary of gauge name to (numeric) value
+    :param labeled_gauges: Dictionary of gauge name to a list of (labels dictionary, value) tuples
+    :return: String in the Prometheus text exposition format
+    """
+
+    lines = []
+    for counter_name in sorted(counters.keys()):
+        metric_name = "pensu_" + counter_name + "_total"
+        lines.append("# TYPE " + metric_name + " counter")
+        lines.append(metric_name + " " + repr(counters[counter_name]))
+    for gauge_name in sorted(gauges.keys()):
+        metric_name = "pensu_" + gauge_name
+        lines.append("# TYPE " + metric_name + " gauge")
+        lines.append(metric_name + " " + repr(gauges[gauge_name]))
+    for gauge_name in sorted((labeled_gauges or {}).keys()):
+        metric_name = "pensu_" + gauge_name
+        lines.append("# TYPE " + metric_name + " gauge")
+        for labels, value in labeled_gauges[gauge_name]:
+            lines.append(metric_name + "{" + ",".join([label + "=\"" + str(labels[label]) + "\"" for label in sorted(labels.keys())]) + "} " + repr(value))
+
+    if len(snapshot) > 0:
+        lines.append("# HELP pensu_stage_latency_seconds The time it took to handle each stage of the metrics analysis")
+        lines.append("# TYPE pensu_stage_latency_seconds histogram")
+    for stage in sorted(snapshot.keys()):
+        histogram = snapshot[stage]
+        cumulative_count = 0
+        for bucket_bound, count in zip(BUCKETS_BOUNDS + ["+Inf"], histogram["counts"]):
+            cumulative_count += count
+            lines.append("pensu_stage_latency_seconds_bucket{stage=\"" + stage + "\",le=\"" + str(bucket_bound) + "\"} " + str(cumulative_count))
+        lines.append("pensu_stage_latency_seconds_sum{stage=\"" + stage + "\"} " + repr(histogram["sum"]))
+        lines.append("pensu_stage_latency_seconds_count{stage=\"" + stage + "\"} " + str(cumulative_count))
+    return "\n".join(lines) + "\n"
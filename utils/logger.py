@@ -1,4 +1,8 @@
+import os
+import time
 import syslog
+import threading
+import Queue
 from datetime import datetime
 
 
@@ -20,30 +24,146 @@ Severities = [
 ]
 
 
+class _LogWriter:
+    """
+    Writes the formatted log lines to the syslog and/or the console. If log_async is enabled, the lines are put on a
+    bounded queue and written by a background thread (lines are dropped, and counted, when the queue is full) so the
+    analysis never waits for the syslog/console.
+    """
+
+    __instance = None
+    __threads_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        if _LogWriter.__instance is None:
+            _LogWriter()
+        return _LogWriter.__instance
+
+    def __init__(self):
+        _LogWriter.__threads_lock.acquire()
+        try:
+            if _LogWriter.__instance is not None:
+                raise Exception("This is a singleton class. Please use the get_instance() method.")
+            else:
+                _LogWriter.__instance = self
+                self._config_mgr = config_mgr.ConfigMgr.get_instance()
+                self._log_to_syslog = self._config_mgr.get("log_to_syslog") == 1
+                self._log_to_console = self._config_mgr.get("log_to_console") == 1
+                self._async = self._config_mgr.get("log_async") == 1
+                self._lines_queue = None
+                self._writer_pid = None
+        finally:
+            _LogWriter.__threads_lock.release()
+
+    def write(self, log_line):
+        if not self._async:
+            self._write(log_line)
+            return
+
+        # The writer thread does not survive a fork, so each (worker) process starts its own
+        if self._writer_pid != os.getpid():
+            self._start_writer_thread()
+        try:
+            self._lines_queue.put_nowait(log_line)
+        except Queue.Full:
+            stats_mgr.StatsMgr.get_instance(__file__).up("log_lines_dropped")
+
+    def _start_writer_thread(self):
+        _LogWriter.__threads_lock.acquire()
+        try:
+            if self._writer_pid != os.getpid():
+                self._lines_queue = Queue.Queue(maxsize=self._config_mgr.get("log_async_queue_size"))
+                writer_thread = threading.Thread(target=self._writer_loop, args=[self._lines_queue])
+                writer_thread.daemon = True
+                writer_thread.start()
+                self._writer_pid = os.getpid()
+        finally:
+            _LogWriter.__threads_lock.release()
+
+    def _writer_loop(self, lines_queue):
+        while True:
+            self._write(lines_queue.get())
+
+    def _write(self, log_line):
+        if self._log_to_syslog:
+            syslog.syslog(log_line)
+        if self._log_to_console:
+            print(log_line)
+
+
 class Logger:
     def __init__(self, reporting_file, reporting_module):
         self._reporting_file = reporting_file
         self._reporting_module = reporting_module
         self._config_mgr = config_mgr.ConfigMgr.get_instance()
         self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._log_level = self._config_mgr.get("log_minimum_severity")
+        self._logging_format = self._config_mgr.get("logging_format")
+        self._log_writer = _LogWriter.get_instance()
+        self._rate_limits = {}
+        self._rate_limits_lock = threading.Lock()
+
+    def is_enabled_for(self, severity):
+        """
+        :param severity: One of ERROR, WARNING, INFO or DEBUG
+        :return: True if messages of that severity are logged (log_minimum_severity is the most verbose severity logged)
+        """
+        return severity <= self._log_level
+
+    def error(self, method, message, state=None, metric=None, exception_message=None, exception_type=None, min_seconds_between=0):
+        self.log(ERROR, method, message, state, metric, exception_message, exception_type, min_seconds_between)
+
+    def warn(self, method, message, state=None, metric=None, exception_message=None, exception_type=None, min_seconds_between=0):
+        self.log(WARNING, method, message, state, metric, exception_message, exception_type, min_seconds_between)
+
+    def info(self, method, message, state=None, metric=None, exception_message=None, exception_type=None, min_seconds_between=0):
+        self.log(INFO, method, message, state, metric, exception_message, exception_type, min_seconds_between)
+
+    def debug(self, method, message, state=None, metric=None, exception_message=None, exception_type=None, min_seconds_between=0):
+        self.log(DEBUG, method, message, state, metric, exception_message, exception_type, min_seconds_between)
 
-    def error(self, method, message, state=None, metric=None, exception_message=None, exception_type=None):
-        self.log(ERROR, method, message, state, metric, exception_message, exception_type)
+    def log(self, severity, method, message, state=None, metric=None, exception_message=None, exception_type=None, min_seconds_between=0):
+        """
+        Logs the message if its severity is enabled. The message, state and metric may be given as functions (i.e.
+        lambda: "Received " + str(metric)) in which case they are only called (and formatted) if the message is logged.
+        :param min_seconds_between: If above zero, messages from the same method with the same severity are logged at
+        most once per that many seconds (the number of suppressed messages is added to the next logged one)
+        """
 
-    def warn(self, method, message, state=None, metric=None, exception_message=None, exception_type=None):
-        self.log(WARNING, method, message, state, metric, exception_message, exception_type)
+        if severity > self._log_level:
+            return
 
-    def info(self, method, message, state=None, metric=None, exception_message=None, exception_type=None):
-        self.log(INFO, method, message, state, metric, exception_message, exception_type)
+        if min_seconds_between > 0:
+            suppressed_count = self._check_rate_limit(severity, method, min_seconds_between)
+            if suppressed_count is None:
+                return
+        else:
+            suppressed_count = 0
 
-    def debug(self, method, message, state=None, metric=None, exception_message=None, exception_type=None):
-        self.log(DEBUG, method, message, state, metric, exception_message, exception_type)
+        message = message() if callable(message) else message
+        state = state() if callable(state) else state
+        metric = metric() if callable(metric) else metric
+        if suppressed_count > 0:
+            message = message + " (" + str(suppressed_count) + " similar messages were suppressed)"
 
-    def log(self, severity, method, message, state=None, metric=None, exception_message=None, exception_type=None):
-        if severity >= self._config_mgr.get("log_minimum_severity"):
-            log_line = self._config_mgr.get("logging_format") % (datetime.now().isoformat(), "pensu." + self._reporting_module + "." + self._reporting_file, method, Severities[severity], str(state), str(metric), str(exception_message), str(exception_type), message)
+        log_line = self._logging_format % (datetime.now().isoformat(), "pensu." + self._reporting_module + "." + self._reporting_file, method, Severities[severity], str(state), str(metric), str(exception_message), str(exception_type), message)
+        self._log_writer.write(log_line)
 
-            if self._config_mgr.get("log_to_syslog") == 1:
-                syslog.syslog(log_line)
-            if self._config_mgr.get("log_to_console") == 1:
-                print(log_line)
\ No newline at end of file
+    def _check_rate_limit(self, severity, method, min_seconds_between):
+        """
+        :return: None if the message should be suppressed, otherwise the number of messages that were suppressed since
+        the last one that was logged
+        """
+        rate_limit_key = (severity, method)
+        now = time.time()
+        self._rate_limits_lock.acquire()
+        try:
+            last_logged, suppressed_count = self._rate_limits.get(rate_limit_key, (0, 0))
+            if now - last_logged < min_seconds_between:
+                self._rate_limits[rate_limit_key] = (last_logged, suppressed_count + 1)
+                return None
+            self._rate_limits[rate_limit_key] = (now, 0)
+            return suppressed_count
+        finally:
+            self._rate_limits_lock.release()
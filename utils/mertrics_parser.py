@@ -1,46 +1,138 @@
+import time
 import base64
 
 import stats_mgr
 import config_mgr
 import utils.logger
+import utils.latency_histograms
 
 
 class MetricsParser:
+    """
+    Parses metrics in the graphite line format (metric.name.hierarchy value timestamp). Each line is split once, and
+    what is derived from the metric name alone (the interned name, its family and whether it matches
+    allowed_to_work_on_metrics_pattern) is cached per name in a bounded map, since the set of metric names is small and
+    stable compared to the number of values received.
+    """
+
     def __init__(self):
         self._config_mgr = config_mgr.ConfigMgr.get_instance()
         self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
         self._logger = utils.logger.Logger(__file__, "MetricsParser")
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+        self._allowed_to_work_on_metrics_pattern = self._config_mgr.get("allowed_to_work_on_metrics_pattern")
+        self._metrics_names_cache_size = self._config_mgr.get("metrics_names_cache_size")
+        self._metrics_names_cache = {}
+
+    def _get_metric_name_info(self, metric_name):
+        """
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: Tuple of (interned metric name, metric family or None if the name has no dots, whether the metric is
+        allowed to be worked on)
+        """
+        metric_name_info = self._metrics_names_cache.get(metric_name)
+        if metric_name_info is None:
+            if len(self._metrics_names_cache) >= self._metrics_names_cache_size:
+                # The names are cached again as they arrive. A stable set of names never gets here.
+                self._metrics_names_cache = {}
+            metric_name = intern(metric_name)
+            metric_family = metric_name.rsplit(".", 1)[0] if "." in metric_name else None
+            metric_name_info = (metric_name, metric_family, self._allowed_to_work_on_metrics_pattern.match(metric_name) is not None)
+            self._metrics_names_cache[metric_name] = metric_name_info
+        return metric_name_info
+
+    def get_allowed_metric_name(self, metric_raw_info):
+        """
+        Returns the name of the given raw metric if it's well formed (has exactly two spaces) and it matches the
+        allowed_to_work_on_metrics_pattern regex. The line is not split (only its name is extracted).
+        :param metric_raw_info: The raw metric (as received from Kafka)
+        :return: The (interned) metric name or None if the metric should be ignored
+        """
+        if metric_raw_info is None or metric_raw_info.count(" ") != 2:
+            return None
+        metric_name, metric_family, allowed = self._get_metric_name_info(metric_raw_info[:metric_raw_info.index(" ")])
+        return metric_name if allowed else None
+
+    def parse_allowed_metric(self, metric_raw_info, update_stats=True):
+        """
+        Same as parse_metric_message but also returns None (without logging) for metrics that are malformed or do not
+        match the allowed_to_work_on_metrics_pattern regex (those are not counted as received either)
+        """
+        if self.get_allowed_metric_name(metric_raw_info) is None:
+            return None
+        return self.parse_metric_message(metric_raw_info, update_stats=update_stats)
+
+    def parse_metrics_batch(self, metrics_raw_info):
+        """
+        Parses a batch of raw metrics (counting them as received once). As with parse_allowed_metric, every allowed
+        metric is counted as received, including the ones that fail to be parsed.
+        :param metrics_raw_info: List of raw metrics
+        :return: List (in the same order) of the parsed metrics, with None for each metric that could not be parsed or
+        that is not allowed to be worked on
+        """
+        parsed_metrics = []
+        allowed_metrics_count = 0
+        for metric_raw_info in metrics_raw_info:
+            if self.get_allowed_metric_name(metric_raw_info) is None:
+                parsed_metrics.append(None)
+            else:
+                allowed_metrics_count += 1
+                parsed_metrics.append(self.parse_metric_message(metric_raw_info, update_stats=False))
+        self._stats_mgr.increase("metrics_received", allowed_metrics_count)
+        return parsed_metrics
 
-    def parse_metric_message(self, metric_raw_info):
+    def parse_metric_message(self, metric_raw_info, update_stats=True):
+        """
+        Parses a metric in the graphite line format (metric.name.hierarchy value timestamp)
+        :param metric_raw_info: The raw metric
+        :param update_stats: Whether to count the metric as received (batch callers count the whole batch at once)
+        :return: Dictionary with the parsed metric or None if the metric could not be parsed
+        """
+        parse_started = time.time()
         try:
-            self._stats_mgr.up("metrics_received")
-
-            if len(metric_raw_info.split(" ")) == 3:
-                metric_name = metric_raw_info.split(" ")[0]
-                metric_family_raw = metric_name.split(".")
-                if len(metric_family_raw) > 1:
-                    metric_family_hierarchy = metric_family_raw[:(len(metric_family_raw) - 1)]
-                    metric_family = ".".join(metric_family_hierarchy)
-                    metric_item = metric_family_raw[(len(metric_family_raw) - 1)]
-                else:
-                    self._logger.warn("parse_metric_message", "Failed to parse metric (failed to parse metric family. Less than one dot in the family name)", metric=str(base64.b64encode(str(metric_raw_info))))
+            return self._parse_metric_message(metric_raw_info, update_stats)
+        finally:
+            self._latency_histograms.observe("parse", time.time() - parse_started)
+
+    def _parse_metric_message(self, metric_raw_info, update_stats):
+        try:
+            if update_stats:
+                self._stats_mgr.up("metrics_received")
+
+            metric_info = metric_raw_info.split(" ")
+            if len(metric_info) == 3:
+                metric_name, metric_family, allowed = self._get_metric_name_info(metric_info[0])
+                if metric_family is None:
+                    self._logger.warn("parse_metric_message", "Failed to parse metric (failed to parse metric family. Less than one dot in the family name)", metric=lambda: str(base64.b64encode(str(metric_raw_info))), min_seconds_between=1)
                     return
                 try:
-                    metric_value = float(metric_raw_info.split(" ")[1])
+                    metric_value = float(metric_info[1])
                 except:
-                    self._logger.warn("parse_metric_message", "Failed to parse metric info (failed to convert metric value to float)", metric=str(base64.b64encode(str(metric_raw_info))))
+                    self._logger.warn("parse_metric_message", "Failed to parse metric info (failed to convert metric value to float)", metric=lambda: str(base64.b64encode(str(metric_raw_info))), min_seconds_between=1)
                     return
                 try:
-                    metric_timestamp = int(metric_raw_info.split(" ")[2])
+                    metric_timestamp = int(metric_info[2])
                 except:
-                    self._logger.warn("parse_metric_message", "Failed to parse metric info(b64) (failed to convert timestamp value to int)", metric=str(base64.b64encode(str(metric_raw_info))))
+                    self._logger.warn("parse_metric_message", "Failed to parse metric info(b64) (failed to convert timestamp value to int)", metric=lambda: str(base64.b64encode(str(metric_raw_info))), min_seconds_between=1)
                     return
 
             else:
-                self._logger.warn("parse_metric_message", "Failed to parse metric info(b64) (raw message contains more or less than two spaces)", metric=str(base64.b64encode(str(metric_raw_info))))
+                self._logger.warn("parse_metric_message", "Failed to parse metric info(b64) (raw message contains more or less than two spaces)", metric=lambda: str(base64.b64encode(str(metric_raw_info))), min_seconds_between=1)
                 return
 
-            return {"metric_family_hierarchy": metric_family_hierarchy, "metric_family": metric_family, "metric_item": metric_item, "metric_name": metric_name, "metric_value": metric_value, "metric_timestamp": metric_timestamp}
+            # The family hierarchy and the metric item are only needed when reporting an anomaly (see get_full_metric_info)
+            return {"metric_family": metric_family, "metric_name": metric_name, "metric_value": metric_value, "metric_timestamp": metric_timestamp}
 
         except Exception as ex:
             self._logger.warn("parse_metric_message", "An unexpected exception has been thrown while parsing the metric message", exception_type=str(type(ex).__name__), exception_message=str(ex.message))
+
+
+def get_full_metric_info(metric):
+    """
+    :param metric: A metric as returned by MetricsParser.parse_metric_message
+    :return: A copy of the metric with its family hierarchy (list) and item (the last part of its name) added
+    """
+    full_metric_info = dict(metric)
+    full_metric_info["metric_family_hierarchy"] = metric["metric_family"].split(".")
+    full_metric_info["metric_item"] = metric["metric_name"].rsplit(".", 1)[1]
+    return full_metric_info
@@ -0,0 +1,132 @@
+import re
+
+import config_mgr
+import stats_mgr
+
+AGGREGATION_FUNCTIONS = ["mean", "max", "min", "sum", "last"]
+
+
+class _AggregationWindow(object):
+    """
+    The values of a metric received in its current aggregation window (inherits from object since __slots__ is ignored
+    by old-style classes)
+    """
+
+    __slots__ = ["window_start", "metric", "values_count", "aggregate"]
+
+    def __init__(self, window_start, metric):
+        self.window_start = window_start
+        # The first value's parsed metric (its name and family are used for the aggregated one)
+        self.metric = metric
+        self.values_count = 1
+        self.aggregate = metric["metric_value"]
+
+
+class MetricsAggregator:
+    """
+    Downsamples high frequency metrics before they're analyzed: the values of each metric that matches one of the
+    regexes in aggregation_windows (format: "regex=>seconds:function;regex=>seconds:function", the first matching regex
+    wins) are aggregated into windows of that many seconds (aligned to the epoch) and a single value per window (with
+    the window's start as its timestamp) is analyzed. A window is closed when the first value of a later window arrives.
+    Values that arrive late (for an already closed window) are added to the current window.
+    The open window of each metric is kept in its MetricState, so it's dropped (without being analyzed) when the metric
+    is forgotten (i.e. its models are unloaded).
+    """
+
+    def __init__(self):
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._aggregation_rules = MetricsAggregator._parse_aggregation_windows(self._config_mgr.get("aggregation_windows"))
+        self._metrics_names_cache_size = self._config_mgr.get("metrics_names_cache_size")
+        self._rules_by_metric = {}
+
+    @staticmethod
+    def _parse_aggregation_windows(aggregation_windows):
+        res = []
+        for mapping in aggregation_windows.split(";"):
+            if mapping.strip() == "":
+                continue
+            if "=>" not in mapping or ":" not in mapping.rsplit("=>", 1)[1]:
+                raise config_mgr.ConfigValueInvalidException("The aggregation window '" + mapping + "' is invalid. It should be in the format regex=>seconds:function")
+            pattern, window = mapping.rsplit("=>", 1)
+            window_seconds, aggregation_function = window.split(":", 1)
+            aggregation_function = aggregation_function.strip().lower()
+            if aggregation_function not in AGGREGATION_FUNCTIONS:
+                raise config_mgr.ConfigValueInvalidException("The aggregation function in the aggregation window '" + mapping + "' is invalid. It should be one of: " + ", ".join(AGGREGATION_FUNCTIONS))
+            try:
+                window_seconds = int(window_seconds)
+            except ValueError:
+                window_seconds = 0
+            if window_seconds <= 0:
+                raise config_mgr.ConfigValueInvalidException("The window size in the aggregation window '" + mapping + "' is invalid. It should be a positive number of seconds")
+            try:
+                res.append((re.compile(pattern.strip()), window_seconds, aggregation_function))
+            except re.error:
+                raise config_mgr.ConfigValueInvalidException("The regex in the aggregation window '" + mapping + "' is invalid")
+        return res
+
+    def is_enabled(self):
+        return len(self._aggregation_rules) > 0
+
+    def _get_aggregation_rule(self, metric_name):
+        """
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: Tuple of (window seconds, aggregation function) or None if the metric is not aggregated
+        """
+        if metric_name in self._rules_by_metric:
+            return self._rules_by_metric[metric_name]
+        if len(self._rules_by_metric) >= self._metrics_names_cache_size:
+            # The rules are cached again as the metrics arrive. A stable set of names never gets here.
+            self._rules_by_metric = {}
+        aggregation_rule = None
+        for pattern, window_seconds, aggregation_function in self._aggregation_rules:
+            if pattern.match(metric_name):
+                aggregation_rule = (window_seconds, aggregation_function)
+                break
+        self._rules_by_metric[metric_name] = aggregation_rule
+        return aggregation_rule
+
+    def aggregate(self, metric, metric_state):
+        """
+        Adds the given value to its metric's aggregation window. Should be called with the metric's lock held (see
+        ModelsLibrary.get_metric_lock).
+        :param metric: The parsed metric
+        :param metric_state: The MetricState of the metric (holds its current aggregation window)
+        :return: The metric to analyze - the given one if its metric is not aggregated, the aggregated value of the
+        window that the given value closed, or None if the window is still open
+        """
+        aggregation_rule = self._get_aggregation_rule(metric["metric_name"])
+        if aggregation_rule is None:
+            return metric
+
+        window_seconds, aggregation_function = aggregation_rule
+        window_start = metric["metric_timestamp"] - metric["metric_timestamp"] % window_seconds
+        window = metric_state.aggregation_window
+        if window is None:
+            metric_state.aggregation_window = _AggregationWindow(window_start, metric)
+            self._stats_mgr.up("metrics_aggregated")
+            return None
+
+        if window_start <= window.window_start:
+            MetricsAggregator._add_value(window, aggregation_function, metric["metric_value"])
+            self._stats_mgr.up("metrics_aggregated")
+            return None
+
+        metric_state.aggregation_window = _AggregationWindow(window_start, metric)
+        self._stats_mgr.up("metrics_aggregated")
+        aggregated_metric = dict(window.metric)
+        aggregated_metric["metric_value"] = window.aggregate / window.values_count if aggregation_function == "mean" else window.aggregate
+        aggregated_metric["metric_timestamp"] = window.window_start
+        return aggregated_metric
+
+    @staticmethod
+    def _add_value(window, aggregation_function, value):
+        window.values_count += 1
+        if aggregation_function == "mean" or aggregation_function == "sum":
+            window.aggregate += value
+        elif aggregation_function == "max":
+            window.aggregate = max(window.aggregate, value)
+        elif aggregation_function == "min":
+            window.aggregate = min(window.aggregate, value)
+        else:
+            window.aggregate = value
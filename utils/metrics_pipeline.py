@@ -0,0 +1,84 @@
+import threading
+import time
+import Queue
+
+import config_mgr
+import stats_mgr
+import utils.global_state
+import utils.latency_histograms
+import utils.logger
+
+
+class MetricsPipeline:
+    """
+    Splits the handling of the metrics into stages that run concurrently: the fetch stage (on a thread of its own)
+    consumes the raw metrics in batches, filters and parses them and puts them into a bounded queue, the compute stage
+    (on the calling thread) runs the models on them and the output stage (see transports.pipeline_output_transport) publishes the
+    results. The I/O of the fetch and output stages overlaps the models runs and the queues absorb bursts.
+    """
+
+    def __init__(self, transport, metrics_parser, anomaly_detector, partitions_rebalance_listener):
+        """
+        :param transport: The transport to consume the metrics from
+        :param metrics_parser: The MetricsParser to parse the metrics with
+        :param anomaly_detector: The AnomalyDetector to run the models with
+        :param partitions_rebalance_listener: The PartitionsRebalanceListener to track the metrics with (or None)
+        """
+        self._transport = transport
+        self._metrics_parser = metrics_parser
+        self._anomaly_detector = anomaly_detector
+        self._partitions_rebalance_listener = partitions_rebalance_listener
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "MetricsPipeline")
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+        self._metrics_queue = Queue.Queue(maxsize=self._config_mgr.get("pipeline_queue_size"))
+        self._fetch_batch_size = self._config_mgr.get("kafka_consumer_max_poll_records") if self._config_mgr.get("kafka_consumer_max_poll_records") > 0 else 500
+
+    def _fetch_metrics(self):
+        while not self._global_state.get_global_status("sigint_received"):
+            metrics_batch = self._transport.consume_batch(max_records=self._fetch_batch_size, timeout_ms=1000)
+            if len(metrics_batch) == 0:
+                continue
+            fetch_started = time.time()
+            self._stats_mgr.increase("raw_metrics_downloaded_from_kafka", len(metrics_batch))
+            parsed_metrics = self._metrics_parser.parse_metrics_batch([metric.value for metric in metrics_batch])
+            self._latency_histograms.observe("pipeline_fetch", time.time() - fetch_started)
+            for metric, parsed_metric in zip(metrics_batch, parsed_metrics):
+                if parsed_metric is None:
+                    continue
+                if self._partitions_rebalance_listener is not None:
+                    self._partitions_rebalance_listener.track_metric(metric.topic, metric.partition, parsed_metric["metric_name"])
+                # Blocks while the compute stage is behind (so no more metrics are consumed until it catches up)
+                self._metrics_queue.put((parsed_metric, time.time()))
+            self._stats_mgr.set("pipeline_metrics_queue_depth", self._metrics_queue.qsize())
+
+    def run(self):
+        """
+        Starts the fetch stage and runs the compute stage until the service is shutting down (and the metrics that
+        were already fetched are analyzed)
+        :return: None
+        """
+        fetching_thread = threading.Thread(target=self._fetch_metrics)
+        fetching_thread.daemon = True
+        fetching_thread.start()
+        self._logger.info("run", "Started the metrics pipeline (fetch_batch_size=" + str(self._fetch_batch_size) + ", queue_size=" + str(self._config_mgr.get("pipeline_queue_size")) + ")")
+
+        while True:
+            try:
+                parsed_metric, fetched_at = self._metrics_queue.get(timeout=1)
+            except Queue.Empty:
+                if not fetching_thread.is_alive():
+                    return
+                continue
+
+            compute_started = time.time()
+            self._latency_histograms.observe("pipeline_queue_wait", compute_started - fetched_at)
+            # noinspection PyBroadException
+            try:
+                self._anomaly_detector.detect_anomaly(parsed_metric)
+            except Exception as ex:
+                self._logger.warn("run", lambda: "The following error occurred while analyzing the following metric: " + str(parsed_metric), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
+            finally:
+                self._latency_histograms.observe("handle_metric", time.time() - compute_started)
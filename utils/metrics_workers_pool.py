@@ -0,0 +1,266 @@
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+import Queue
+from threading import Lock
+
+import config_mgr
+import stats_mgr
+import model_persistence.models_storage
+import ai_handlers.anomaly_detector
+import utils.global_state
+import utils.mertrics_parser
+import utils.latency_histograms
+import utils.logger
+import transports.transport_factory
+
+
+UNLOAD_METRIC_COMMAND = "unload_metric"
+FORGET_CHECKPOINT_MISSES_COMMAND = "forget_checkpoint_misses"
+
+
+class MetricsWorkersPool:
+    """
+    Spreads the analysis of the metrics over several worker processes. Each metric is always routed (by a stable hash
+    of its name) to the same worker, so each worker owns a disjoint set of models in its own models library and uses
+    its own models storage, stats and transport (to publish its results with).
+    """
+
+    def __init__(self, workers_count):
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "MetricsWorkersPool")
+        self._workers_count = workers_count
+        self._workers = []
+        self._metrics_queues = []
+        self._stats_queue = multiprocessing.Queue()
+        self._workers_stats = {}
+        self._workers_latency_histograms = {}
+        self._shared_stats_table = None
+        if self._config_mgr.get("stats_shared_memory") == 1:
+            self._shared_stats_table = stats_mgr.SharedStatsTable(workers_count)
+        self._workers_stats_lock = Lock()
+
+    def start(self):
+        """
+        Forks the worker processes. Must be called before any thread (i.e. the kafka producer) is started by the master
+        process since only the calling thread survives the fork.
+        :return: None
+        """
+
+        for worker_idx in range(0, self._workers_count):
+            metrics_queue = multiprocessing.Queue(maxsize=self._config_mgr.get("worker_queue_size"))
+            worker = multiprocessing.Process(target=self._worker_main, args=(worker_idx, metrics_queue), name="pensu_worker_" + str(worker_idx))
+            worker.daemon = True
+            worker.start()
+            self._metrics_queues.append(metrics_queue)
+            self._workers.append(worker)
+            self._logger.info("start", "Started metrics worker no." + str(worker_idx) + " (pid=" + str(worker.pid) + ")")
+
+    def get_worker_idx(self, metric_name):
+        # zlib.crc32 is used (and not hash()) since its value is the same across processes and restarts
+        return (zlib.crc32(metric_name) & 0xffffffff) % self._workers_count
+
+    def dispatch(self, metric_name, metric_raw_info):
+        """
+        Sends the raw metric to the worker that owns it. Blocks if that worker's queue is full.
+        :param metric_name: The metric name (metric.entire.hierarchy) used for choosing the worker.
+        :param metric_raw_info: The metric as received from Kafka (graphite line format)
+        :return: None
+        """
+        self._metrics_queues[self.get_worker_idx(metric_name)].put(metric_raw_info)
+
+    def dispatch_batch(self, metrics):
+        """
+        Sends a batch of raw metrics to the workers that own them (one queue operation per worker)
+        :param metrics: List of (metric name, raw metric) tuples
+        :return: None
+        """
+        metrics_by_worker = {}
+        for metric_name, metric_raw_info in metrics:
+            metrics_by_worker.setdefault(self.get_worker_idx(metric_name), []).append(metric_raw_info)
+        for worker_idx, worker_metrics in metrics_by_worker.items():
+            self._metrics_queues[worker_idx].put(worker_metrics)
+
+    def unload_metric(self, metric_name):
+        """
+        Asks the worker that owns the given metric to save its models and remove them from its models library
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: None
+        """
+        self._metrics_queues[self.get_worker_idx(metric_name)].put((UNLOAD_METRIC_COMMAND, metric_name))
+
+    def forget_checkpoint_misses(self):
+        """
+        Asks all the workers to look up again the checkpoints they did not find on the disk
+        :return: None
+        """
+        for metrics_queue in self._metrics_queues:
+            metrics_queue.put((FORGET_CHECKPOINT_MISSES_COMMAND, None))
+
+    def stop(self):
+        """
+        Asks the workers to stop (after saving their models) and waits up to shutdown_timeout seconds for all of them
+        :return: None
+        """
+        for metrics_queue in self._metrics_queues:
+            metrics_queue.put(None)
+        stop_deadline = time.time() + self._config_mgr.get("shutdown_timeout")
+        for worker in self._workers:
+            worker.join(max(0, stop_deadline - time.time()))
+            if worker.is_alive():
+                self._logger.warn("stop", "Worker " + worker.name + " did not stop in time. Terminating it.")
+                worker.terminate()
+
+    def get_stats(self):
+        """
+        Returns the latest stats reported by each of the workers along with the totals of their counters and of their
+        additive gauges (stats_mgr.ADDITIVE_GAUGES).
+        :return: Dictionary with the stats of the workers pool
+        """
+
+        self._workers_stats_lock.acquire()
+        try:
+            while True:
+                try:
+                    worker_idx, worker_stats, worker_latency_histograms = self._stats_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if worker_stats is not None:
+                    self._workers_stats[worker_idx] = worker_stats
+                self._workers_latency_histograms[worker_idx] = worker_latency_histograms
+            if self._shared_stats_table is not None:
+                self._workers_stats.update(self._shared_stats_table.read())
+
+            totals = {}
+            for worker_stats in self._workers_stats.values():
+                for stats_metric, value in worker_stats.items():
+                    if stats_metric in stats_mgr.COUNTERS or stats_metric in stats_mgr.ADDITIVE_GAUGES:
+                        totals[stats_metric] = totals.get(stats_metric, 0) + value
+
+            return {
+                "workers_count": self._workers_count,
+                "workers_alive": len([worker for worker in self._workers if worker.is_alive()]),
+                "metrics_queues_sizes": [self._get_queue_size(metrics_queue) for metrics_queue in self._metrics_queues],
+                "totals": totals,
+                "workers": dict(self._workers_stats)
+            }
+        finally:
+            self._workers_stats_lock.release()
+
+    def get_latency_histograms(self):
+        """
+        :return: List of the latest latency histograms snapshots reported by the workers (call get_stats() first to
+        collect the latest reports)
+        """
+        self._workers_stats_lock.acquire()
+        try:
+            return list(self._workers_latency_histograms.values())
+        finally:
+            self._workers_stats_lock.release()
+
+    @staticmethod
+    def _get_queue_size(metrics_queue):
+        try:
+            return metrics_queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def _worker_main(self, worker_idx, metrics_queue):
+        # The master process is the one that handles the signals and tells the workers to stop (through their queues)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self._stats_mgr.reset_counters()
+        utils.latency_histograms.LatencyHistograms.get_instance().reset()
+        MetricsWorker(worker_idx, metrics_queue, self._stats_queue, self._shared_stats_table).run()
+
+
+class MetricsWorker:
+    """
+    Runs inside a worker process - analyzes the metrics routed to it by the MetricsWorkersPool.
+    """
+
+    def __init__(self, worker_idx, metrics_queue, stats_queue, shared_stats_table=None):
+        self._worker_idx = worker_idx
+        self._metrics_queue = metrics_queue
+        self._stats_queue = stats_queue
+        self._shared_stats_table = shared_stats_table
+        self._config_mgr = config_mgr.ConfigMgr.get_instance()
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._global_state = utils.global_state.GlobalState.get_instance()
+        self._logger = utils.logger.Logger(__file__, "MetricsWorker")
+        self._model_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        self._metrics_parser = utils.mertrics_parser.MetricsParser()
+        self._latency_histograms = utils.latency_histograms.LatencyHistograms.get_instance()
+        self._transport = None
+        self._anomaly_detector = None
+
+    def run(self):
+        self._logger.info("run", "Metrics worker no." + str(self._worker_idx) + " is starting...")
+        # Each worker publishes its results through a transport of its own (the metrics are consumed by the master)
+        self._transport = transports.transport_factory.create_transport(client_id_suffix="_worker_" + str(self._worker_idx))
+        self._transport.connect_producer()
+        self._anomaly_detector = ai_handlers.anomaly_detector.AnomalyDetector.get_instance(self._transport)
+
+        autosave_thread = threading.Thread(target=self._model_storage.auto_save_models, args=[self._config_mgr.get("autosave_models_interval")])
+        autosave_thread.daemon = True
+        autosave_thread.start()
+
+        stats_reporting_thread = threading.Thread(target=self.auto_report_stats)
+        stats_reporting_thread.daemon = True
+        stats_reporting_thread.start()
+
+        while True:
+            metric_raw_info = self._metrics_queue.get()
+            if metric_raw_info is None:
+                self._logger.info("run", "Metrics worker no." + str(self._worker_idx) + " was asked to stop.")
+                self._global_state.fire_event(event_name="sigint_received", set_global_status=True)
+                if self._config_mgr.get("checkpoint_on_shutdown") == 1:
+                    self._model_storage.save_changed_metrics("shutdown")
+                self._transport.flush()
+                self._report_stats()
+                return
+
+            if isinstance(metric_raw_info, tuple):
+                command, metric_name = metric_raw_info
+                if command == UNLOAD_METRIC_COMMAND:
+                    self._model_storage.unload_metric(metric_name)
+                elif command == FORGET_CHECKPOINT_MISSES_COMMAND:
+                    self._model_storage.forget_checkpoint_misses()
+                continue
+
+            if isinstance(metric_raw_info, list):
+                for parsed_metric in self._metrics_parser.parse_metrics_batch(metric_raw_info):
+                    if parsed_metric is not None:
+                        self._analyze_metric(parsed_metric)
+            else:
+                self._analyze_metric(self._metrics_parser.parse_metric_message(metric_raw_info=metric_raw_info))
+
+    def _analyze_metric(self, parsed_metric):
+        metric_handling_started = time.time()
+        # noinspection PyBroadException
+        try:
+            self._anomaly_detector.detect_anomaly(parsed_metric)
+            self._latency_histograms.observe("handle_metric", time.time() - metric_handling_started)
+        except Exception as ex:
+            self._logger.warn("_analyze_metric", lambda: "The following error occurred while analyzing the following metric: " + str(parsed_metric), exception_type=str(type(ex).__name__), exception_message=str(ex.message), min_seconds_between=1)
+
+    def auto_report_stats(self):
+        interval = self._config_mgr.get("worker_stats_report_interval")
+        while not self._global_state.get_global_status("sigint_received"):
+            self._report_stats()
+            time.sleep(interval)
+
+    def _report_stats(self):
+        try:
+            if self._shared_stats_table is not None:
+                # The counters and gauges are read by the master directly from the shared memory
+                self._shared_stats_table.publish(self._worker_idx, self._stats_mgr.get_counters_and_gauges())
+                worker_stats = None
+            else:
+                worker_stats = self._stats_mgr.get_stats()
+            self._stats_queue.put((self._worker_idx, worker_stats, utils.latency_histograms.LatencyHistograms.get_instance().get_snapshot()))
+        except Exception as ex:
+            self._logger.warn("_report_stats", "Failed to report the stats of worker no." + str(self._worker_idx), exception_type=str(type(ex).__name__), exception_message=str(ex.message))
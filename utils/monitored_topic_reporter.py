@@ -10,12 +10,12 @@ class MonitoredTopicReporter:
     __threads_lock = Lock()
 
     @staticmethod
-    def get_instance(kafka_producer):
+    def get_instance(transport):
         if MonitoredTopicReporter.__instance is None:
-            MonitoredTopicReporter(kafka_producer)
+            MonitoredTopicReporter(transport)
         return MonitoredTopicReporter.__instance
 
-    def __init__(self, kafka_producer):
+    def __init__(self, transport):
         MonitoredTopicReporter.__threads_lock.acquire()
         try:
             if MonitoredTopicReporter.__instance is not None:
@@ -25,7 +25,7 @@ class MonitoredTopicReporter:
                 self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
                 self._config_mgr = config_mgr.ConfigMgr.get_instance()
                 self._global_state = utils.global_state.GlobalState.get_instance()
-                self._kafka_producer = kafka_producer
+                self._transport = transport
                 self._topics_list_topic = self._config_mgr.get("topics_list_topic")
                 self._raw_metrics_kafka_topic = self._config_mgr.get("raw_metrics_kafka_topic")
         finally:
@@ -46,7 +46,7 @@ class MonitoredTopicReporter:
             if self._global_state.get_global_status("sigint_received"):
                 return
 
-            self._kafka_producer.send(topic=self._topics_list_topic, value=self._raw_metrics_kafka_topic)
+            self._transport.publish(self._topics_list_topic, self._raw_metrics_kafka_topic)
 
             for i in range(0, interval):
                 if self._global_state.get_global_status("sigint_received"):
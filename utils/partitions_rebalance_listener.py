@@ -0,0 +1,74 @@
+from threading import Lock
+
+import kafka
+
+import stats_mgr
+import model_persistence.models_storage
+import utils.logger
+
+
+class PartitionsRebalanceListener(kafka.ConsumerRebalanceListener):
+    """
+    Used when consuming the metrics as part of a Kafka consumer group. Keeps track of the metrics seen on each of the
+    partitions assigned to this instance so that their models will be saved and unloaded when the partition is
+    assigned to another instance. Models of metrics on newly assigned partitions are loaded from the models storage
+    lazily (by the models factory) when their first metric arrives.
+    """
+
+    def __init__(self, workers_pool=None):
+        self._stats_mgr = stats_mgr.StatsMgr.get_instance(__file__)
+        self._logger = utils.logger.Logger(__file__, "PartitionsRebalanceListener")
+        self._model_storage = model_persistence.models_storage.ModelsStorage.get_instance()
+        self._workers_pool = workers_pool
+        self._metrics_by_partition = {}
+        self._metrics_by_partition_lock = Lock()
+
+    def track_metric(self, topic, partition, metric_name):
+        """
+        Registers the metric as one that is received through the given partition
+        :param topic: The topic of the record the metric was received in
+        :param partition: The partition of the record the metric was received in
+        :param metric_name: The metric name (metric.entire.hierarchy)
+        :return: None
+        """
+        topic_partition = kafka.TopicPartition(topic, partition)
+        metrics = self._metrics_by_partition.get(topic_partition)
+        if metrics is None:
+            self._metrics_by_partition_lock.acquire()
+            try:
+                metrics = self._metrics_by_partition.setdefault(topic_partition, set())
+            finally:
+                self._metrics_by_partition_lock.release()
+        metrics.add(metric_name)
+
+    def get_assigned_partitions_count(self):
+        return len(self._metrics_by_partition)
+
+    def on_partitions_revoked(self, revoked):
+        for topic_partition in revoked:
+            self._metrics_by_partition_lock.acquire()
+            try:
+                metrics = self._metrics_by_partition.pop(topic_partition, set())
+            finally:
+                self._metrics_by_partition_lock.release()
+
+            self._logger.info("on_partitions_revoked", "Partition " + str(topic_partition.partition) + " of topic " + str(topic_partition.topic) + " was revoked. Unloading the models of " + str(len(metrics)) + " metrics.")
+            for metric_name in metrics:
+                if self._workers_pool is not None:
+                    self._workers_pool.unload_metric(metric_name)
+                else:
+                    self._model_storage.unload_metric(metric_name)
+
+    def on_partitions_assigned(self, assigned):
+        self._metrics_by_partition_lock.acquire()
+        try:
+            for topic_partition in assigned:
+                self._metrics_by_partition.setdefault(topic_partition, set())
+        finally:
+            self._metrics_by_partition_lock.release()
+        # The previous owners of these partitions may have saved checkpoints that were not found here before
+        if self._workers_pool is not None:
+            self._workers_pool.forget_checkpoint_misses()
+        else:
+            self._model_storage.forget_checkpoint_misses()
+        self._logger.info("on_partitions_assigned", "The following partitions were assigned to this instance: " + ", ".join([str(topic_partition.topic) + ":" + str(topic_partition.partition) for topic_partition in assigned]))